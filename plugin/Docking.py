@@ -1,15 +1,23 @@
+import asyncio
 import nanome
-from nanome.util import async_callback, ComplexUtils
+from nanome.util import async_callback, Color, ComplexUtils
 import os
 import re
-import tempfile
+from functools import partial
 
 from nanome.util.enums import NotificationTypes
 from nanome.util import Logs
 
-from plugin.smina.calculations import DockingCalculations as Smina
-from plugin.autodock4.calculations import DockingCalculations as Autodock4
-from plugin.menus.DockingMenu import DockingMenu, SettingsMenu
+from plugin.backends import get_backend
+from plugin.events import EventCoalescer
+from plugin.job_store import JobRecord, JobStore
+from plugin.jobs import SessionJobs
+from plugin.menus.DockingMenu import DockingMenu, JobsMenu, SettingsMenu
+from plugin.profiling import profile_job
+from plugin.progress import CombinedProgress
+from plugin.scratch import ScratchSpace
+from plugin.utils import SiteBox, merge_ranked_sdfs, molecule_fingerprint
+from plugin.workspace import SessionWorkspace
 
 __metaclass__ = type
 
@@ -21,6 +29,33 @@ PDBOPTIONS.write_bonds = True
 DEFAULT_TIMEOUT = 300
 TIMEOUT_PER_FRAME = int(os.environ.get('TIMEOUT_PER_FRAME', DEFAULT_TIMEOUT))
 
+# Max number of atoms sent per update when toggling score labels or colors.
+LABEL_UPDATE_CHUNK_SIZE = 5000
+# Docked complexes are uploaded in chunks of at most this many atoms (counting every frame),
+# with at most UPLOAD_MAX_IN_FLIGHT chunks waiting on the client at once.
+UPLOAD_CHUNK_ATOM_COUNT = int(os.environ.get('UPLOAD_CHUNK_ATOM_COUNT', 20000))
+UPLOAD_MAX_IN_FLIGHT = int(os.environ.get('UPLOAD_MAX_IN_FLIGHT', 2))
+# Progressive docking first shows poses from a quick search with these settings,
+# then replaces them in place with the results of the full search.
+PROGRESSIVE_EXHAUSTIVENESS = int(os.environ.get('PROGRESSIVE_EXHAUSTIVENESS', 1))
+PROGRESSIVE_MODES = int(os.environ.get('PROGRESSIVE_MODES', 1))
+# Number of colors in the atom score gradient, from favorable (blue) through neutral (white)
+# to unfavorable (red). Odd, so that a score of 0 is white.
+SCORE_COLOR_STEPS = 33
+
+
+def score_color_table(steps=SCORE_COLOR_STEPS):
+    """Precompute the score gradient, so coloring an atom is a single lookup."""
+    half = (steps - 1) // 2
+    table = []
+    for i in range(steps):
+        fade = int(255 * (1 - abs(i - half) / half))
+        table.append(Color(fade, fade, 255) if i < half else Color(255, fade, fade))
+    return table
+
+
+SCORE_COLOR_TABLE = score_color_table()
+
 
 class Docking(nanome.AsyncPluginInstance):
 
@@ -28,163 +63,609 @@ class Docking(nanome.AsyncPluginInstance):
         super().__init__()
         self.menu = DockingMenu(self)
         self.settings_menu = SettingsMenu(self)
+        self.jobs_menu = JobsMenu(self)
         self.docked_complex_indices = []
+        # complex index -> atoms with score labels, for each docked complex created by the plugin.
+        self.score_label_atoms = {}
+        # complex index -> (atom, original color, score color) for each docked complex with atom scores.
+        self.score_color_atoms = {}
+        self.job_store = JobStore()
+        self.workspace = SessionWorkspace()
+        self.scratch = ScratchSpace()
+        self.complex_list_refresher = EventCoalescer(self.refresh_complex_list)
+        # Docking jobs started from the menu, which run side by side.
+        self.jobs = SessionJobs(on_change=self.on_job_changed)
+        self.job_list_refresher = EventCoalescer(self.refresh_job_list)
+        # Background tasks refining the results of progressive runs, by the indices of their ligands.
+        self.refine_tasks = {}
+        # Number of docking passes running, the workspace is only trimmed when none are.
+        self._running_passes = 0
+        self.__calculations = None
+
+    @property
+    def algorithm(self):
+        return self.__class__.__name__.split('Docking')[0].lower()
+
+    @property
+    def _calculations(self):
+        """Docking engine of this plugin, imported and created on first use."""
+        if self.__calculations is None:
+            self.__calculations = self._create_engine(self)
+        return self.__calculations
+
+    def _create_engine(self, host):
+        """New docking engine, reporting progress to host."""
+        return get_backend(self.algorithm).calculations_class(host)
+
+    @property
+    def refine_task(self):
+        """Most recently started refinement."""
+        return next(reversed(self.refine_tasks.values()), None)
 
     def start(self):
         self.menu.build_menu()
 
+    def on_stop(self):
+        self.complex_list_refresher.cancel()
+        self.job_list_refresher.cancel()
+        self.jobs.cancel_all()
+        self.cancel_refinement()
+        self.workspace.cleanup()
+
     @async_callback
     async def on_run(self):
         # Called when user clicks on the "Run" button in Nanome
         self.menu.enable()
-        complexes = await self.request_complex_list()
-        self.menu.change_complex_list(complexes)
+        self.complex_list_refresher.cancel()
+        await self.refresh_complex_list()
 
     def on_advanced_settings(self):
         # Called when user click on the "Advanced Settings" button in Nanome
         self.settings_menu.enable()
 
-    @async_callback
-    async def on_complex_added(self):
+    def on_complex_added(self):
         # Called when a complex is added to the workspace in Nanome
-        complexes = await self.request_complex_list()
-        self.menu.change_complex_list(complexes)
+        self.complex_list_refresher.trigger()
 
-    @async_callback
-    async def on_complex_removed(self):
+    def on_complex_removed(self):
         # Called when a complex is removed from the workspace in Nanome
-        complexes = await self.request_complex_list()
+        self.complex_list_refresher.trigger()
+
+    async def refresh_complex_list(self):
+        """Update the menu with the current complex list. Bursts of workspace events are coalesced into one call."""
+        # Shielded so that a superseded refresh doesn't cancel the pending request.
+        complexes = await asyncio.shield(self.request_complex_list())
         self.menu.change_complex_list(complexes)
         # If docked complex has been deleted, remove index from list
-        comp_indices = [cmp.index for cmp in complexes]
+        comp_indices = set(cmp.index for cmp in complexes)
         self.docked_complex_indices = [x for x in self.docked_complex_indices if x in comp_indices]
+        self.score_label_atoms = {
+            index: atoms for index, atoms in self.score_label_atoms.items() if index in comp_indices}
+        self.score_color_atoms = {
+            index: atoms for index, atoms in self.score_color_atoms.items() if index in comp_indices}
+
+    def start_job(self, receptors, ligands, site, params):
+        """Start docking in the background as a new job of the session, and return it.
+
+        More than one receptor runs ensemble docking. Other jobs keep running.
+        """
+        ligand_names = ', '.join(comp.full_name for comp in ligands)
+        receptor_names = ', '.join(comp.full_name for comp in receptors)
+        docking_job = self.jobs.create(f'{ligand_names} to {receptor_names}')
+        receptor = list(receptors) if len(receptors) > 1 else receptors[0]
+        docking_job.task = asyncio.ensure_future(
+            self._run_session_job(docking_job, receptor, ligands, site, params))
+        return docking_job
+
+    async def _run_session_job(self, docking_job, receptor, ligands, site, params):
+        try:
+            docking_job.results = await self.run_docking(receptor, ligands, site, params, docking_job) or []
+        except asyncio.CancelledError:
+            docking_job.finish('cancelled')
+        except Exception as e:
+            message = f'{type(e).__name__}: {next(iter(e.args), "Error Occurred. Please Check Logs.")}'
+            Logs.error(message)
+            self.send_notification(NotificationTypes.error, message)
+            docking_job.finish('error', message)
+
+    def on_job_changed(self, docking_job):
+        self.job_list_refresher.trigger()
+
+    async def refresh_job_list(self):
+        """Show status of all jobs, and the combined progress of running jobs on the loading bar."""
+        running = self.jobs.running()
+        self.menu.enable_loading_bar(bool(running))
+        if running:
+            self.update_loading_bar(sum(job.progress for job in running), len(running))
+        self.jobs_menu.update(list(self.jobs))
+
+    async def run_docking(self, receptor, ligands, site, params, docking_job=None):
+        # receptor is a list of complexes for ensemble docking, which ranks the poses of each ligand
+        # across all conformations, tagged with the receptor they were docked against.
+        # A new run supersedes results of the same ligands that are still being refined.
+        self.cancel_refinement(ligands)
+        # Get advanced_settings.
+        params.update(self.settings_menu.get_settings())
+        if not self.is_progressive(params):
+            return await self._run_job(receptor, ligands, site, params, docking_job)
+
+        coarse_params = {
+            **params,
+            'exhaustiveness': PROGRESSIVE_EXHAUSTIVENESS,
+            'modes': min(params.get('modes') or PROGRESSIVE_MODES, PROGRESSIVE_MODES),
+            'progressive_pass': 'coarse',
+        }
+        preliminary = await self._run_job(receptor, ligands, site, coarse_params, docking_job)
+        if preliminary:
+            refine_params = {**params, 'progressive_pass': 'refine'}
+            key = self._refine_key(ligands)
+            task = asyncio.ensure_future(self._refine(receptor, ligands, site, refine_params, preliminary, docking_job))
+            task.add_done_callback(partial(self._refine_done, key))
+            self.refine_tasks[key] = task
+            if docking_job:
+                # Cancelling the job now stops its refinement.
+                docking_job.task = task
+        return preliminary
 
-    async def run_docking(self, receptor, ligands, site, params):
-        # Request complexes to Nanome in this order: [receptor, <site>, ligand, ligand,...]
+    @staticmethod
+    def is_progressive(params):
+        return bool(params.get('progressive')) and (params.get('exhaustiveness') or 0) > PROGRESSIVE_EXHAUSTIVENESS
+
+    @staticmethod
+    def _refine_key(ligands):
+        return frozenset(comp.index for comp in ligands)
+
+    def _refine_done(self, key, task):
+        if self.refine_tasks.get(key) is task:
+            del self.refine_tasks[key]
+
+    def cancel_refinement(self, ligands=None):
+        """Cancel refinements of runs docking any of ligands, or all refinements."""
+        key = self._refine_key(ligands) if ligands is not None else None
+        for refine_key, task in list(self.refine_tasks.items()):
+            if task.done() or (key is not None and not key & refine_key):
+                continue
+            Logs.message('Cancelling refinement of preliminary poses')
+            task.cancel()
+
+    async def _refine(self, receptor, ligands, site, params, preliminary, docking_job=None):
+        """Run the full search of a progressive run, and replace the preliminary complexes with its results."""
+        try:
+            refined = await self._run_job(receptor, ligands, site, params, docking_job, replace=preliminary)
+            if docking_job and refined:
+                docking_job.results = refined
+        except asyncio.CancelledError:
+            if docking_job:
+                docking_job.finish('cancelled')
+        except Exception as e:
+            message = f'{type(e).__name__}: {next(iter(e.args), "Error Occurred. Please Check Logs.")}'
+            Logs.error(message)
+            self.send_notification(NotificationTypes.error, message)
+            if docking_job:
+                docking_job.finish('error', message)
+
+    async def _run_job(self, receptor, ligands, site, params, docking_job=None, replace=None):
+        job = JobRecord(self.algorithm)
+        scratch = self.scratch.job()
+        # Counts the artifacts this job reused, other jobs may use the session workspace at the same time.
+        workspace = self.workspace.job()
+        # Engines that ran the job, ensemble jobs run one per receptor.
+        engines = []
+        # Ligand position -> complex showing its poses while docking, until replaced by its final result.
+        placeholders = {}
+        self._running_passes += 1
+        try:
+            with profile_job(job.job_id) as profile_dir:
+                job.profile_dir = profile_dir
+                return await self._run_docking_job(
+                    job, scratch, workspace, engines, placeholders, receptor, ligands, site, params, replace, docking_job or self)
+        except asyncio.CancelledError:
+            job.finish('cancelled')
+            raise
+        finally:
+            self._running_passes -= 1
+            if placeholders:
+                # Partial poses of ligands without a final result would otherwise stay in the workspace.
+                self.remove_from_workspace(list(placeholders.values()))
+            scratch.cleanup()
+            job.scratch_peak_bytes = scratch.peak_bytes
+            if job.status == 'running':
+                job.finish('error')
+            job.exit_codes = [code for engine in engines for code in getattr(engine, 'exit_codes', [])]
+            job.cache_hits = workspace.hits
+            job.cache_misses = workspace.misses
+            self.job_store.append(job)
+            if docking_job:
+                docking_job.add_record(job, refining=params.get('progressive_pass') == 'coarse')
+            # Artifacts of running passes must stay in place.
+            if not self._running_passes:
+                self.workspace.evict()
+
+    async def _run_docking_job(
+            self, job, scratch, workspace, engines, placeholders, receptor, ligands, site, params, replace=None,
+            host=None):
+        """Dock ligands with engines of their own, which report their progress to host."""
+        receptors = receptor if isinstance(receptor, list) else [receptor]
+        # Request complexes to Nanome in this order: [receptor, ..., <site>, ligand, ligand,...]
         # site not always required.
-        complex_indices = [receptor.index]
+        complex_indices = [x.index for x in receptors]
         if site:
             complex_indices += [site.index]
         complex_indices += [x.index for x in ligands]
-        complexes = await self.request_complexes(complex_indices)
-        receptor = complexes[0]
+        with job.stage('request_complexes'):
+            complexes = await self.request_complexes(complex_indices)
+        receptors = complexes[:len(receptors)]
+        # Results are placed relative to the first receptor, conformations of an ensemble share its frame.
+        receptor = receptors[0]
+        complexes = complexes[len(receptors):]
 
         if site:
-            site = complexes[1]
-            ligands = complexes[2:]
-        else:
+            site = complexes[0]
             ligands = complexes[1:]
+        else:
+            ligands = complexes
 
         ComplexUtils.convert_to_frames(ligands)
 
+        job.inputs = self.calculation_data(receptor, ligands)
+        job.inputs['receptor_count'] = len(receptors)
+        job.params = params
+
         # Make sure receptor is larger than all ligands
-        valid_selections = self.validate_complex_sizes(receptor, ligands)
+        valid_selections = all(self.validate_complex_sizes(comp, ligands) for comp in receptors)
         if not valid_selections:
             msg = "Receptor must be larger than ligands."
             Logs.warning(msg)
             self.send_notification(NotificationTypes.warning, msg)
+            job.finish('invalid')
             return
 
-        # Get advanced_settings.
-        advanced_settings = self.settings_menu.get_settings()
-        params.update(advanced_settings)
-
         output_complexes = []
-        with tempfile.TemporaryDirectory() as temp_dir:
+        with scratch:
             # Convert input complexes into PDBs.
-            receptor_pdb = tempfile.NamedTemporaryFile(delete=False, suffix=".pdb", dir=temp_dir)
-            site_pdb = tempfile.NamedTemporaryFile(delete=False, suffix=".pdb", dir=temp_dir)
-            receptor.io.to_pdb(receptor_pdb.name, PDBOPTIONS)
-            site.io.to_pdb(site_pdb.name, PDBOPTIONS)
-
-            ligand_pdbs = []
-            for lig in ligands:
-                cleaned_name = lig.full_name.replace(' ', '_')
-                ligand_pdb = tempfile.NamedTemporaryFile(delete=False, suffix=".pdb", dir=temp_dir, prefix=f'{cleaned_name}_')
-                ComplexUtils.align_to(lig, receptor)
-                lig.io.to_pdb(ligand_pdb.name, PDBOPTIONS)
-                ligand_pdbs.append(ligand_pdb)
+            # PDBs are stored by content, so unchanged inputs keep the same path between runs.
+            with job.stage('prepare'):
+                receptor_pdbs = [
+                    workspace.intern('receptor', partial(self._write_pdb, comp), '.pdb') for comp in receptors]
+                # Engines only need the box around the site, so it is passed without writing the site to a file.
+                site_box = SiteBox.from_complex(site) if site else None
+
+                for lig in ligands:
+                    ComplexUtils.align_to(lig, receptor)
+                # Duplicate ligands and frames are only docked once.
+                unique_ligands, ligand_map = self.deduplicate_ligands(ligands)
+                ligand_pdbs = []
+                for lig in unique_ligands:
+                    ligand_pdb = workspace.intern('ligand', partial(self._write_pdb, lig), '.pdb')
+                    ligand_pdbs.append(ligand_pdb)
 
             self.log_calculation_data(receptor, ligands, params)
-            frame_count = 0
-            for lig in ligands:
-                frame_count += sum(1 for _ in lig.molecules)
+            frame_count = sum(sum(1 for _ in lig.molecules) for lig in unique_ligands)
+            job.inputs['unique_ligand_count'] = len(unique_ligands)
+            job.inputs['unique_frame_count'] = frame_count
             self.send_notification(NotificationTypes.message, "Docking started")
             timeout = TIMEOUT_PER_FRAME * frame_count
+            # Complexes in the workspace that results of each ligand should replace.
+            previous = list(replace) if replace else [None] * len(ligands)
+
+            async def push_poses(ligand_pdb, partial_sdf):
+                """Show poses of a ligand whose remaining frames are still being docked."""
+                unique_index = ligand_pdbs.index(ligand_pdb)
+                for i, (ligand, mapped_index) in enumerate(zip(ligands, ligand_map)):
+                    if mapped_index != unique_index:
+                        continue
+                    partial_complex = self.build_result_complex(partial_sdf, f'{ligand.full_name} (Docking...)', params)
+                    if partial_complex is None:
+                        continue
+                    if previous[i] is None:
+                        created_complexes = await self.add_result_to_workspace([partial_complex], receptor, site)
+                        previous[i] = placeholders[i] = created_complexes[0]
+                    else:
+                        await self.replace_results([partial_complex], [previous[i]], receptor, site)
+
             try:
-                output_sdfs = await self._calculations.start_docking(
-                    receptor_pdb, ligand_pdbs, site_pdb, temp_dir, timeout=timeout, **params)
+                with job.stage('docking'):
+                    if len(receptors) == 1:
+                        engine = self._create_engine(host or self)
+                        engines.append(engine)
+                        output_sdfs = await engine.start_docking(
+                            receptor_pdbs[0], ligand_pdbs, site_box, scratch, timeout=timeout,
+                            workspace=workspace, on_poses=push_poses, **params)
+                    else:
+                        output_sdfs = await self._dock_ensemble(
+                            engines, receptors, receptor_pdbs, ligand_pdbs, site_box, scratch, timeout, params,
+                            host or self, workspace)
+                    # Engine output is written after the last allocation, so it is only counted if measured here.
+                    scratch.usage()
             except TimeoutError:
                 message = "Docking calculation timed out"
                 self.send_notification(NotificationTypes.error, message)
                 # Logs.error(message)
+                job.timed_out = True
+                job.finish('timeout')
                 return
 
-            for ligand, result in zip(ligands, output_sdfs):
-                docked_complex = nanome.structure.Complex.io.from_sdf(path=result.name)
-                if len(list(docked_complex.molecules)) == 0:
-                    msg = "Docking returned 0 results."
-                    Logs.warning(msg)
-                    self.send_notification(NotificationTypes.warning, msg)
-                    return
-
-                docked_complex.full_name = f'{ligand.full_name} (Docked)'
-                docked_complex = docked_complex.convert_to_frames()
-                # fix metadata sorting
-                if hasattr(self, 'set_scores'):
-                    for molecule in docked_complex.molecules:
-                        self.set_scores(molecule)
-
-                show_atom_labels = params.get('visual_scores', False)
-                if hasattr(self, 'visualize_scores'):
-                    self.visualize_scores(docked_complex, show_atom_labels=show_atom_labels)
-
-                docked_complex.set_current_frame(0)
-                docked_complex.visible = True
-                docked_complex.locked = True
-                output_complexes.append(docked_complex)
-
-        # hide ligands
-        for ligand in ligands:
-            ligand.visible = False
-            ComplexUtils.reset_transform(ligand)
-        self.update_structures_shallow(ligands)
-
-        # Add docked complexes to workspace.
-        await self.add_result_to_workspace(output_complexes, receptor, site)
-        self.send_notification(NotificationTypes.success, "Docking finished")
+            with job.stage('postprocess'):
+                # Every original ligand gets its own docked complex, built from the result of its unique ligand.
+                # Ligands that timed out have no result, and keep None in their place.
+                timed_out_names = []
+                for ligand, unique_index in zip(ligands, ligand_map):
+                    output_sdf = output_sdfs[unique_index]
+                    if output_sdf is None:
+                        timed_out_names.append(ligand.full_name)
+                        output_complexes.append(None)
+                        continue
+                    docked_complex = self.build_result_complex(output_sdf, f'{ligand.full_name} (Docked)', params)
+                    if docked_complex is None:
+                        msg = "Docking returned 0 results."
+                        Logs.warning(msg)
+                        self.send_notification(NotificationTypes.warning, msg)
+                        job.finish('empty')
+                        return
+                    output_complexes.append(docked_complex)
+
+                degraded = {}
+                for engine in engines:
+                    degraded.update(getattr(engine, 'degraded_ligands', {}))
+                job.degraded_ligands = {
+                    ligand.full_name: degraded[ligand_pdbs[unique_index]]
+                    for ligand, unique_index in zip(ligands, ligand_map) if ligand_pdbs[unique_index] in degraded}
+
+        with job.stage('upload'):
+            # hide ligands
+            for ligand in ligands:
+                ligand.visible = False
+                ComplexUtils.reset_transform(ligand)
+            self.update_structures_shallow(ligands)
+
+            # Results replace complexes already shown for their ligand, the rest are added to the workspace.
+            results = [(comp, old) for comp, old in zip(output_complexes, previous) if comp is not None]
+            replaced = [(comp, old) for comp, old in results if old is not None]
+            added = [comp for comp, old in results if old is None]
+            if replaced:
+                await self.replace_results(
+                    [comp for comp, _ in replaced], [old for _, old in replaced], receptor, site)
+                for i, comp in enumerate(output_complexes):
+                    if comp is not None:
+                        placeholders.pop(i, None)
+            if added:
+                created_complexes = await self.add_result_to_workspace(added, receptor, site, host or self)
+                for comp, created in zip(added, created_complexes):
+                    comp.index = created.index
+        if timed_out_names:
+            msg = f"Docking timed out for {', '.join(timed_out_names)}"
+            Logs.warning(msg)
+            self.send_notification(NotificationTypes.warning, msg)
+            job.timed_out = True
+        if job.degraded_ligands:
+            msg = f"Docked with reduced search settings after timing out: {', '.join(job.degraded_ligands)}"
+            Logs.warning(msg)
+            self.send_notification(NotificationTypes.warning, msg)
+        if params.get('progressive_pass') == 'coarse':
+            self.send_notification(NotificationTypes.message, "Showing preliminary poses, refining in background")
+        elif not timed_out_names:
+            self.send_notification(NotificationTypes.success, "Docking finished")
+        job.finish('partial' if timed_out_names else 'success')
         return output_complexes
 
-    async def add_result_to_workspace(self, results, receptor, site):
+    async def _dock_ensemble(
+            self, engines, receptors, receptor_pdbs, ligand_pdbs, site_box, scratch, timeout, params, host=None,
+            workspace=None):
+        """Dock ligands against every receptor concurrently, each with its own engine.
+
+        Returns a merged sdf per ligand, with the poses of all receptors ranked by score.
+        """
+        host = host or self
+        workspace = workspace or self.workspace.job()
+        progress = CombinedProgress(host.update_loading_bar)
+
+        async def dock(receptor, receptor_pdb):
+            engine = self._create_engine(progress.engine(host))
+            engines.append(engine)
+            try:
+                return await engine.start_docking(
+                    receptor_pdb, ligand_pdbs, site_box, scratch, timeout=timeout, workspace=workspace, **params)
+            except TimeoutError:
+                Logs.warning(f'Docking against {receptor.full_name} timed out')
+                return [None] * len(ligand_pdbs)
+
+        tasks = [asyncio.ensure_future(dock(*args)) for args in zip(receptors, receptor_pdbs)]
+        try:
+            receptor_sdfs = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        if all(sdf is None for sdfs in receptor_sdfs for sdf in sdfs):
+            raise TimeoutError('Docking timed out against every receptor')
+
+        merged_sdfs = []
+        for i in range(len(ligand_pdbs)):
+            sources = [(comp.full_name, sdfs[i]) for comp, sdfs in zip(receptors, receptor_sdfs) if sdfs[i]]
+            if not sources:
+                merged_sdfs.append(None)
+                continue
+            merged_sdf = scratch.file(prefix='ensemble', suffix='.sdf')
+            merged_sdfs.append(merge_ranked_sdfs(sources, merged_sdf, engines[0].pose_score, params.get('modes')))
+        return merged_sdfs
+
+    def build_result_complex(self, output_sdf, name, params):
+        """Load engine output as a complex with a frame per pose, and attach scores. Returns None if it has no poses."""
+        docked_complex = nanome.structure.Complex.io.from_sdf(path=output_sdf)
+        if len(list(docked_complex.molecules)) == 0:
+            return None
+
+        docked_complex.full_name = name
+        docked_complex = docked_complex.convert_to_frames()
+        # fix metadata sorting
+        if hasattr(self, 'set_scores'):
+            for molecule in docked_complex.molecules:
+                self.set_scores(molecule)
+
+        show_atom_labels = params.get('visual_scores', False)
+        if hasattr(self, 'visualize_scores'):
+            self.visualize_scores(docked_complex, show_atom_labels=show_atom_labels)
+        if hasattr(self, 'color_scores'):
+            self.color_scores(docked_complex, enabled=params.get('color_scores', False))
+
+        docked_complex.set_current_frame(0)
+        docked_complex.visible = True
+        docked_complex.locked = True
+        return docked_complex
+
+    async def add_result_to_workspace(self, results, receptor, site, host=None):
+        """Upload results placed relative to receptor, reporting upload progress to host if given.
+
+        Jobs report to their own progress, so uploads don't overwrite the combined progress of other jobs.
+        """
+        if not results:
+            return
+        self._place_results(results, receptor, site)
+
+        # Upload in chunks of bounded size, with a limited number of chunks in flight,
+        # so the client is never handed one huge message.
+        chunks = self.chunk_complexes(results, UPLOAD_CHUNK_ATOM_COUNT)
+        semaphore = asyncio.Semaphore(UPLOAD_MAX_IN_FLIGHT)
+        uploaded_count = 0
+        if host:
+            host.update_loading_bar(uploaded_count, len(results))
+
+        async def upload_chunk(chunk):
+            nonlocal uploaded_count
+            async with semaphore:
+                created_chunk = await self.add_to_workspace(chunk)
+            # add_to_workspace doesn't set correct current frame, so set it back to 0.
+            # Also need to manually reset position and rotation
+            for c1, c2 in zip(created_chunk, chunk):
+                c1.position = c2.position
+                c1.rotation = c2.rotation
+                c1.set_current_frame(0)
+            self.update_structures_shallow(created_chunk)
+            uploaded_count += len(chunk)
+            if host:
+                host.update_loading_bar(uploaded_count, len(results))
+            return created_chunk
+
+        # Complex added events caused by our own results are ignored, and the menu is refreshed once afterwards.
+        with self.complex_list_refresher.suppress():
+            created_chunks = await asyncio.gather(*[upload_chunk(chunk) for chunk in chunks])
+        created_complexes = [comp for created_chunk in created_chunks for comp in created_chunk]
+
+        indices = [cmp.index for cmp in created_complexes]
+        self.docked_complex_indices.extend(indices)
+        self._index_scored_atoms(created_complexes, results)
+        return created_complexes
+
+    async def replace_results(self, results, preliminary, receptor, site):
+        """Replace the structure of preliminary docked complexes with results, keeping their index.
+
+        Preliminary complexes deleted by the user are skipped.
+        """
+        if not preliminary:
+            return []
+        complexes = await self.request_complex_list()
+        remaining = set(comp.index for comp in complexes)
+        pairs = [(result, old) for result, old in zip(results, preliminary) if old.index in remaining]
+        if not pairs:
+            return []
+        results = [result for result, _ in pairs]
+        self._place_results(results, receptor, site)
+        for result, old in pairs:
+            result.index = old.index
+        await self.update_structures_deep(results)
+        # Atoms only get their index once they exist in the workspace.
+        updated_complexes = await self.request_complexes([result.index for result in results])
+        for comp in updated_complexes:
+            comp.set_current_frame(0)
+        self.update_structures_shallow(updated_complexes)
+        self._index_scored_atoms(updated_complexes, results)
+        return updated_complexes
+
+    @staticmethod
+    def _place_results(results, receptor, site):
         for comp in results:
             comp.position = receptor.position
             comp.rotation = receptor.rotation
             ComplexUtils.align_to(comp, site)
             comp.boxed = True
-        created_complexes = await self.add_to_workspace(results)
-        # add_to_workspace doesn't set correct current frame, so set it back to 0.
-        # Also need to manually reset position and rotation
-        for c1, c2 in zip(created_complexes, results):
-            c1.position = c2.position
-            c1.rotation = c2.rotation
-            c1.set_current_frame(0)
-        self.update_structures_shallow(created_complexes)
-        indices = [cmp.index for cmp in created_complexes]
-        self.docked_complex_indices.extend(indices)
+
+    def _index_scored_atoms(self, created_complexes, results):
+        # Remember which atoms carry score labels, so they can be toggled without requesting complexes.
+        for comp in created_complexes:
+            self.score_label_atoms[comp.index] = [atom for atom in comp.atoms if atom.label_text]
+        # Created atoms come back without their scores, so match them to the results by order.
+        for comp, result in zip(created_complexes, results):
+            score_color_atoms = []
+            for atom, result_atom in zip(comp.atoms, result.atoms):
+                if hasattr(result_atom, 'score_color'):
+                    atom.atom_color = result_atom.atom_color
+                    score_color_atoms.append((atom, result_atom.default_color, result_atom.score_color))
+            self.score_color_atoms[comp.index] = score_color_atoms
 
     @staticmethod
-    def log_calculation_data(receptor, ligands, params):
-        """Log useful information about parameters and complexes being docked."""
-        frame_count = 0
+    def chunk_complexes(complexes, max_atom_count):
+        """Split complexes into chunks of at most max_atom_count atoms. Larger complexes get a chunk of their own."""
+        chunks = []
+        chunk = []
+        chunk_atom_count = 0
+        for comp in complexes:
+            atom_count = sum(1 for _ in comp.atoms)
+            if chunk and chunk_atom_count + atom_count > max_atom_count:
+                chunks.append(chunk)
+                chunk = []
+                chunk_atom_count = 0
+            chunk.append(comp)
+            chunk_atom_count += atom_count
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    @staticmethod
+    def deduplicate_ligands(ligands):
+        """Remove duplicate frames from each ligand, and find ligands that are identical.
+
+        Ligands are compared by the fingerprints of their frames, so they should already be aligned.
+        Returns list of unique ligands, and for each ligand the index of its unique ligand.
+        """
+        unique_ligands = []
+        ligand_map = []
+        seen_ligands = {}
+        duplicate_frame_count = 0
         for lig in ligands:
-            frame_count += sum(1 for _ in lig.molecules)
-        log_extra = {
+            frame_fingerprints = []
+            for molecule in list(lig.molecules):
+                fingerprint = molecule_fingerprint(molecule)
+                if fingerprint in frame_fingerprints:
+                    lig.remove_molecule(molecule)
+                    duplicate_frame_count += 1
+                else:
+                    frame_fingerprints.append(fingerprint)
+            ligand_key = tuple(frame_fingerprints)
+            if ligand_key not in seen_ligands:
+                seen_ligands[ligand_key] = len(unique_ligands)
+                unique_ligands.append(lig)
+            ligand_map.append(seen_ligands[ligand_key])
+
+        if duplicate_frame_count or len(unique_ligands) < len(ligands):
+            Logs.message(
+                f'Skipping {len(ligands) - len(unique_ligands)} duplicate ligand(s) '
+                f'and {duplicate_frame_count} duplicate frame(s)')
+        return unique_ligands, ligand_map
+
+    @staticmethod
+    def calculation_data(receptor, ligands):
+        """Summarize the size of the complexes being docked."""
+        return {
             'ligand_count': len(ligands),
             'ligand_frame_count': sum(sum(1 for _ in lig.molecules) for lig in ligands),
             'receptor_atom_count': sum(1 for _ in receptor.atoms),
             'ligand_atom_count_avg': int(sum(sum(1 for _ in lig.atoms) for lig in ligands) / len(ligands)),
-            **params
         }
+
+    @classmethod
+    def log_calculation_data(cls, receptor, ligands, params):
+        """Log useful information about parameters and complexes being docked."""
+        log_extra = {**cls.calculation_data(receptor, ligands), **params}
+        frame_count = log_extra['ligand_frame_count']
         Logs.message(
             f'Docking {len(ligands)} ligand(s), containing {frame_count} frame(s)', extra=log_extra)
 
@@ -196,6 +677,10 @@ class Docking(nanome.AsyncPluginInstance):
             return False
         return True
 
+    @staticmethod
+    def _write_pdb(comp, path):
+        comp.io.to_pdb(path, PDBOPTIONS)
+
     def enable_loading_bar(self, enabled=True):
         self.menu.enable_loading_bar(enabled)
 
@@ -206,11 +691,27 @@ class Docking(nanome.AsyncPluginInstance):
         self.menu.update_run_btn_text(new_text)
 
     async def toggle_atom_labels(self, enabled: bool):
-        docked_complexes = await self.request_complexes(self.docked_complex_indices)
-        for comp in docked_complexes:
-            for atom in comp.atoms:
-                atom.labeled = bool(enabled and atom.label_text)
-        await self.update_structures_deep(docked_complexes)
+        """Show or hide score labels on docked complexes, only sending atoms whose state changes."""
+        changed_atoms = []
+        for comp_index in self.docked_complex_indices:
+            for atom in self.score_label_atoms.get(comp_index, []):
+                if atom.labeled != enabled:
+                    atom.labeled = enabled
+                    changed_atoms.append(atom)
+        for i in range(0, len(changed_atoms), LABEL_UPDATE_CHUNK_SIZE):
+            self.update_structures_shallow(changed_atoms[i:i + LABEL_UPDATE_CHUNK_SIZE])
+
+    async def toggle_score_colors(self, enabled: bool):
+        """Switch docked atoms between score colors and their original colors, only sending atoms that change."""
+        changed_atoms = []
+        for comp_index in self.docked_complex_indices:
+            for atom, default_color, score_color in self.score_color_atoms.get(comp_index, []):
+                color = score_color if enabled else default_color
+                if atom.atom_color is not color:
+                    atom.atom_color = color
+                    changed_atoms.append(atom)
+        for i in range(0, len(changed_atoms), LABEL_UPDATE_CHUNK_SIZE):
+            self.update_structures_shallow(changed_atoms[i:i + LABEL_UPDATE_CHUNK_SIZE])
 
 
 class SminaDocking(Docking):
@@ -218,7 +719,50 @@ class SminaDocking(Docking):
     def __init__(self):
         super(SminaDocking, self).__init__()
         self.menu = DockingMenu(self)
-        self._calculations = Smina(self)
+        # ligand complex index -> preview complex showing its in-place scores.
+        self.preview_complexes = {}
+
+    async def preview_scores(self, receptor, ligands, minimize=False):
+        """Score ligands in their current placement, optionally after local minimization.
+
+        Results are shown as a preview complex per ligand, which is replaced in place by later previews.
+        """
+        complexes = await self.request_complexes([receptor.index] + [lig.index for lig in ligands])
+        receptor, ligands = complexes[0], complexes[1:]
+        ComplexUtils.convert_to_frames(ligands)
+        params = self.settings_menu.get_settings()
+
+        receptor_pdb = self.workspace.intern('receptor', partial(self._write_pdb, receptor), '.pdb')
+        ligand_pdbs = []
+        for lig in ligands:
+            ComplexUtils.align_to(lig, receptor)
+            ligand_pdbs.append(self.workspace.intern('ligand', partial(self._write_pdb, lig), '.pdb'))
+
+        label = 'Minimized' if minimize else 'Scored'
+        with self.scratch.job() as scratch:
+            try:
+                output_sdfs = await self._calculations.score_poses(
+                    receptor_pdb, ligand_pdbs, scratch, minimize=minimize)
+            except TimeoutError:
+                self.send_notification(NotificationTypes.error, f"{label} preview timed out")
+                return
+            results = {}
+            for lig, output_sdf in zip(ligands, output_sdfs):
+                result = self.build_result_complex(output_sdf, f'{lig.full_name} ({label})', params)
+                if result is not None:
+                    results[lig.index] = result
+
+        previous = [(index, self.preview_complexes[index]) for index in results if index in self.preview_complexes]
+        replaced = await self.replace_results(
+            [results[index] for index, _ in previous], [comp for _, comp in previous], receptor, receptor)
+        replaced_indices = set(comp.index for comp in replaced)
+        added = [index for index, result in results.items() if result.index not in replaced_indices]
+        created = await self.add_result_to_workspace(
+            [results[index] for index in added], receptor, receptor, self) or []
+        for index, comp in zip(added, created):
+            self.preview_complexes[index] = comp
+        self.send_notification(NotificationTypes.success, f"{label} {len(results)} ligand(s)")
+        return list(results.values())
 
     def set_scores(self, molecule):
         """Clean and Parse score information for provided molecule."""
@@ -252,6 +796,25 @@ class SminaDocking(Docking):
                     atom.label_text = self._truncate(atom.score, 3)
                     atom.labeled = show_atom_labels
 
+    def color_scores(self, ligand_complex, enabled=False):
+        """Map atom scores onto SCORE_COLOR_TABLE, normalized per pose so the strongest term gets the end color.
+
+        Colors are only applied when enabled, otherwise they are kept for toggle_score_colors.
+        """
+        half = (len(SCORE_COLOR_TABLE) - 1) // 2
+        for molecule in ligand_complex.molecules:
+            scored_atoms = [atom for atom in molecule.atoms if hasattr(atom, 'score')]
+            if not scored_atoms:
+                continue
+            scale = max(-molecule.min_atom_score, molecule.max_atom_score)
+            factor = half / scale if scale > 0 else 0
+            colors = [SCORE_COLOR_TABLE[half + round(atom.score * factor)] for atom in scored_atoms]
+            for atom, color in zip(scored_atoms, colors):
+                atom.default_color = atom.atom_color
+                atom.score_color = color
+                if enabled:
+                    atom.atom_color = color
+
     def _truncate(self, f, n):
         """Truncates/pads a float f to n decimal places without rounding."""
         s = '{}'.format(f)
@@ -266,7 +829,6 @@ class Autodock4Docking(Docking):
     def __init__(self):
         super(Autodock4Docking, self).__init__()
         self.menu = DockingMenu(self)
-        self._calculations = Autodock4(self)
 
     def set_scores(self, molecule):
         for associated in molecule.associateds:
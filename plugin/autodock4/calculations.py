@@ -1,150 +1,245 @@
+import asyncio
+import itertools
 import nanome
 import os
+import shutil
 import subprocess
 import sys
-import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-from nanome.api.structure import Complex
-from plugin.utils import get_complex_center
+from plugin.utils import get_pdbqt_atom_types, get_pdbqt_model_count, iter_sdf_lines, sdf_property
 from nanome.util import Logs
 
+try:
+    from openbabel import pybel
+except ImportError:
+    pybel = None
+
+# Receptor is copied into each grid directory, so the generated maps share its name.
+GRID_RECEPTOR_FILENAME = 'receptor.pdbqt'
+# Number of threads running preparation and conversion subprocesses alongside vina.
+PREP_WORKERS = int(os.environ.get('AUTODOCK_PREP_WORKERS', os.cpu_count() or 1))
+
 
 class DockingCalculations():
 
     def __init__(self, plugin):
         self._plugin = plugin
         self.requires_site = False
+        self.exit_codes = []
+        # Running subprocesses, started by worker threads. Stopped runs start no new ones.
+        self._processes = set()
+        self._processes_lock = threading.Lock()
+        self._stopped = False
 
-    async def start_docking(self, receptor_pdb, ligand_pdbs, site_pdb, temp_dir, **params):
+    async def start_docking(self, receptor_pdb, ligand_pdbs, site_box, scratch, workspace, **params):
         start_time = time.time()
         Logs.message("Autodock4 Calculation started.")
-        self.temp_dir = temp_dir
+        self.scratch = scratch
+        self.temp_dir = scratch.path
+        self.workspace = workspace
+        self.exit_codes = []
+        self._stopped = False
         modes = params.get('modes')
         exhaustiveness = params.get('exhaustiveness')
         deterministic = params.get('deterministic')
 
-        # Get site center vector from site_pdb
-        site_comp = Complex.io.from_pdb(path=site_pdb.name)
-        site_center = get_complex_center(site_comp)
-
-        # Start Ligand/ Receptor prep
-        receptor_file_pdbqt = self._prepare_receptor(receptor_pdb)
+        site_center = site_box.center
 
-        ligand_files_pdbqt = []
-        for lig_pdb in ligand_pdbs:
-            lig_file_pdbqt = self._prepare_ligands(lig_pdb)
-            ligand_files_pdbqt.append(lig_file_pdbqt)
-
-        output_files = []
-        # Run vina, and convert output from pdbqt into a Complex object.
-        for lig_file in ligand_files_pdbqt:
-            # Prepare Grid and Docking parameters.
-            autogrid_input_gpf = self._prepare_grid_params(receptor_file_pdbqt, lig_file, site_center)
+        # Receptor and ligand preparation run in a worker pool.
+        loop = asyncio.get_event_loop()
+        self._loop = loop
+        pool = ThreadPoolExecutor(max_workers=PREP_WORKERS)
+        run = partial(loop.run_in_executor, pool)
+        receptor_task = run(self._prepare_receptor, receptor_pdb)
+        ligand_tasks = [run(self._prepare_ligands, lig_pdb) for lig_pdb in ligand_pdbs]
+        try:
+            receptor_file_pdbqt = await receptor_task
+            ligand_files_pdbqt = await asyncio.gather(*ligand_tasks)
+            # Prepare Grid parameters and run autogrid once for the whole batch. The maps cover
+            # the atom types of every ligand, so all vina runs can share them.
+            grid_dir = await run(self._prepare_grid, receptor_file_pdbqt, ligand_files_pdbqt, site_center)
             # autodock_input_dpf = self._prepare_docking_params(receptor_file_pdbqt, ligands_file_pdbqt)
 
-            # Run autogrid which creates .map files and saves in the temp folder.
-            self._start_autogrid4(autogrid_input_gpf)
-
-            result_pdbqt = self._start_vina(
-                receptor_file_pdbqt, lig_file, num_modes=modes, exhaustiveness=exhaustiveness,
-                deterministic=deterministic)
-            with open(result_pdbqt.name) as f:
-                result_sdf = self.convert_pdbqt_to_sdf(f)
-                output_files.append(result_sdf)
+            # Run vina on all ligands at once, and convert output from pdbqt into a Complex object.
+            result_files_pdbqt = await run(
+                self._dock_ligands, grid_dir, ligand_files_pdbqt, modes, exhaustiveness, deterministic)
+            # Vina output is written after the last scratch allocation, so measure it now.
+            scratch.usage()
+            output_files = await run(self.convert_pdbqts_to_sdfs, result_files_pdbqt)
+            scratch.usage()
+        except asyncio.CancelledError:
+            # Worker threads can't be interrupted, so stop the subprocesses they are waiting on
+            # before the scratch directory is removed from under them.
+            self._stop_processes()
+            raise
+        finally:
+            for task in [receptor_task, *ligand_tasks]:
+                task.cancel()
+            pool.shutdown(wait=False)
         end_time = time.time()
         Logs.message("Autodock4 Calculation finished in {} seconds.".format(round(end_time - start_time, 2)))
-        return output_files
+        return list(output_files)
+
+    @staticmethod
+    def pose_score(record):
+        """Total score of a pose in converted vina output, lower is better."""
+        remark = sdf_property(record, 'REMARK')
+        try:
+            return float(remark.split()[4])
+        except (AttributeError, IndexError, ValueError):
+            return None
+
+    def _dock_ligands(self, grid_dir, ligand_files, modes, exhaustiveness, deterministic):
+        """Dock ligands in one vina batch, returning result pdbqts in the same order as ligand_files."""
+        unique_ligands = list(dict.fromkeys(ligand_files))
+        pending = unique_ligands
+        if deterministic:
+            # Seeded runs are reproducible, so results can be reused while inputs are unchanged.
+            pending = [
+                lig for lig in unique_ligands
+                if not self.workspace.exists('vina_output', self._vina_deps(grid_dir, lig, modes, exhaustiveness), '.pdbqt')]
+        batch_results = self._start_vina(grid_dir, pending, modes, exhaustiveness, deterministic) if pending else {}
+
+        results = {}
+        for lig in unique_ligands:
+            if deterministic:
+                deps = self._vina_deps(grid_dir, lig, modes, exhaustiveness)
+                build = partial(self._move_vina_result, batch_results.get(lig))
+                results[lig] = self.workspace.artifact('vina_output', deps, build, '.pdbqt')
+            else:
+                results[lig] = batch_results[lig]
+                if not os.path.exists(results[lig]):
+                    Logs.warning(f'Vina produced no output for {os.path.basename(lig)}')
+                    open(results[lig], 'w').close()
+        return [results[lig] for lig in ligand_files]
+
+    @staticmethod
+    def _vina_deps(grid_dir, lig_file, modes, exhaustiveness):
+        return (grid_dir, lig_file, modes, exhaustiveness)
+
+    @staticmethod
+    def _move_vina_result(result_pdbqt, path):
+        if not result_pdbqt or not os.path.exists(result_pdbqt):
+            raise RuntimeError('Vina did not produce a result')
+        os.replace(result_pdbqt, path)
 
     def _prepare_receptor(self, pdb_file):
         """Convert pdb file into pdbqt."""
-        receptor_file_pdbqt = tempfile.NamedTemporaryFile(delete=False, suffix=".pdbqt", dir=self.temp_dir)
-        rec_args = [
-            'conda', 'run', '-n', 'adfr-suite',
-            'prepare_receptor',
-            '-r', pdb_file.name,
-            '-o', receptor_file_pdbqt.name,
-        ]
-        subprocess.run(rec_args, cwd=self.temp_dir)
-        return receptor_file_pdbqt
+        def build(receptor_file_pdbqt):
+            rec_args = [
+                'conda', 'run', '-n', 'adfr-suite',
+                'prepare_receptor',
+                '-r', pdb_file,
+                '-o', receptor_file_pdbqt,
+            ]
+            self._run_subprocess(rec_args)
+        return self.workspace.artifact('receptor_pdbqt', [pdb_file], build, '.pdbqt')
 
     def _prepare_ligands(self, ligands_file_pdb):
         """Convert pdb file into pdbqt."""
-        ligands_file_pdbqt = tempfile.NamedTemporaryFile(delete=False, suffix=".pdbqt", dir=self.temp_dir)
-        lig_args = [
-            'conda', 'run', '-n', 'adfr-suite',
-            'prepare_ligand',
-            '-l', ligands_file_pdb.name,
-            '-o', ligands_file_pdbqt.name,
-            '-A', 'hydrogens',
-            '-v'
-        ]
-        subprocess.run(lig_args, cwd=self.temp_dir)
-        return ligands_file_pdbqt
+        def build(ligands_file_pdbqt):
+            lig_args = [
+                'conda', 'run', '-n', 'adfr-suite',
+                'prepare_ligand',
+                '-l', ligands_file_pdb,
+                '-o', ligands_file_pdbqt,
+                '-A', 'hydrogens',
+                '-v'
+            ]
+            self._run_subprocess(lig_args)
+        return self.workspace.artifact('ligand_pdbqt', [ligands_file_pdb], build, '.pdbqt')
+
+    def _prepare_grid(self, receptor_file_pdbqt, ligand_files_pdbqt, site_center):
+        """Create directory containing the receptor, its grid parameter file, and autogrid maps.
+
+        Maps are generated for the union of atom types across all ligands.
+        """
+        ligand_types = sorted(set().union(*(get_pdbqt_atom_types(lig) for lig in ligand_files_pdbqt)))
+        # The grid box is sized to include the largest ligand.
+        sizing_ligand = max(ligand_files_pdbqt, key=lambda lig: (os.path.getsize(lig), lig))
 
-    def _prepare_grid_params(self, receptor_file_pdbqt, ligands_file_pdbqt, site_center):
+        def build(grid_dir):
+            shutil.copyfile(receptor_file_pdbqt, os.path.join(grid_dir, GRID_RECEPTOR_FILENAME))
+            autogrid_input_gpf = self._prepare_grid_params(grid_dir, sizing_ligand, site_center, ligand_types)
+            self._start_autogrid4(autogrid_input_gpf, grid_dir)
+        center = tuple(round(coord, 3) for coord in site_center.unpack())
+        deps = [receptor_file_pdbqt, sizing_ligand, ligand_types, center]
+        return self.workspace.artifact_dir('grid', deps, build)
+
+    def _prepare_grid_params(self, grid_dir, ligands_file_pdbqt, site_center, ligand_types=None):
         prepare_gpf4_script = os.path.join(os.path.dirname(__file__), 'py2', 'prepare_gpf4.py')
-        autogrid_output_gpf = tempfile.NamedTemporaryFile(delete=False, suffix=".gpf", dir=self.temp_dir)
+        autogrid_output_gpf = os.path.join(grid_dir, 'grid.gpf')
 
         # Write reference gpf file to set gridcenter to site
         gridcenter_line = f"gridcenter {' '.join([str(round(coord, 3)) for coord in site_center.unpack()])}"
-        reference_file = tempfile.NamedTemporaryFile(suffix=".gpf", dir=self.temp_dir)
-        with open(reference_file.name, 'w') as f:
+        reference_file = os.path.join(grid_dir, 'reference.gpf')
+        with open(reference_file, 'w') as f:
             f.write(gridcenter_line)
 
         grid_args = [
             'conda', 'run', '-n', 'adfr-suite',
             'python', prepare_gpf4_script,
-            '-l', ligands_file_pdbqt.name,
-            '-r', receptor_file_pdbqt.name,
-            '-o', autogrid_output_gpf.name,
-            '-i', reference_file.name
+            '-l', ligands_file_pdbqt,
+            '-r', GRID_RECEPTOR_FILENAME,
+            '-o', autogrid_output_gpf,
+            '-i', reference_file
         ]
-        subprocess.run(grid_args, cwd=self.temp_dir)
+        if ligand_types:
+            # Overrides the types read from the ligand file.
+            grid_args.extend(['-p', f"ligand_types={','.join(ligand_types)}"])
+        self._run_subprocess(grid_args, cwd=grid_dir)
         return autogrid_output_gpf
 
     def _prepare_docking_params(self, receptor_file_pdbqt, ligands_file_pdbqt):
         # Prepare Docking parameters
         prepare_dpf42_script = os.path.join(os.path.dirname(__file__), 'py2', 'prepare_dpf42.py')
-        autodock_input_dpf = tempfile.NamedTemporaryFile(delete=False, suffix=".dpf", dir=self.temp_dir)
+        autodock_input_dpf = self.scratch.file(suffix=".dpf")
         dock_args = [
             'conda', 'run', '-n', 'adfr-suite',
             'python', prepare_dpf42_script,
-            '-l', ligands_file_pdbqt.name,
-            '-r', receptor_file_pdbqt.name,
-            '-o', autodock_input_dpf.name
+            '-l', ligands_file_pdbqt,
+            '-r', receptor_file_pdbqt,
+            '-o', autodock_input_dpf
         ]
         nanome.util.Logs.debug("Prepare grid and docking parameter files")
-        subprocess.run(dock_args, cwd=self.temp_dir)
+        self._run_subprocess(dock_args)
         return autodock_input_dpf
 
-    def _start_autogrid4(self, autogrid_input_gpf):
+    def _start_autogrid4(self, autogrid_input_gpf, grid_dir):
         # Start Grid
-        autogrid_log = tempfile.NamedTemporaryFile(delete=False, suffix=".glg", dir=self.temp_dir)
+        autogrid_log = os.path.join(grid_dir, 'grid.glg')
         args = [
             'conda', 'run', '-n', 'adfr-suite',
-            'autogrid4', '-p', autogrid_input_gpf.name, '-l', autogrid_log.name
+            'autogrid4', '-p', autogrid_input_gpf, '-l', autogrid_log
         ]
         nanome.util.Logs.debug("Start Autogrid")
-        subprocess.run(args, cwd=self.temp_dir)
+        self._run_subprocess(args, cwd=grid_dir)
         generated_filepaths = [
-            f'{self.temp_dir}/{filename}' for filename in os.listdir(self.temp_dir)
+            f'{grid_dir}/{filename}' for filename in os.listdir(grid_dir)
             if filename.endswith('.map') or filename.endswith('.fld')
         ]
         return generated_filepaths
 
-    def _start_vina(self, receptor_file_pdbqt, ligand_file_pdbqt, num_modes=5, exhaustiveness=8, deterministic=False):
+    def _start_vina(self, grid_dir, ligand_files_pdbqt, num_modes=5, exhaustiveness=8, deterministic=False):
+        """Dock all ligands against the maps in grid_dir with a single vina process.
+
+        Returns dict mapping each ligand file to its result pdbqt.
+        """
         # Start VINA Docking, using the autodock4 scoring.
         vina_binary = os.path.join(os.path.dirname(__file__), 'vina_1.2.2_linux_x86_64')
         # map files created by autogrid call, and are found using the receptor file name.
-        maps_identifier = receptor_file_pdbqt.name.split('.pdbqt')[0]
-        dock_results = tempfile.NamedTemporaryFile(delete=False, dir=self.temp_dir, suffix='.pdbqt')
+        maps_identifier = os.path.join(grid_dir, GRID_RECEPTOR_FILENAME.split('.pdbqt')[0])
+        output_dir = self.scratch.mkdir(prefix='vina_')
         args = [
             vina_binary,
             '--scoring', 'ad4',
             '--maps', maps_identifier,
-            '--ligand', ligand_file_pdbqt.name,
-            '--out', dock_results.name,
+            '--batch', *ligand_files_pdbqt,
+            '--dir', output_dir,
             '--exhaustiveness', str(exhaustiveness),
             '--num_modes', str(num_modes)
         ]
@@ -153,15 +248,26 @@ class DockingCalculations():
             args.extend(['--seed', seed])
 
         nanome.util.Logs.message("Autodock4 calculation started.")
-        process = subprocess.Popen(args, cwd=self.temp_dir, stdout=subprocess.PIPE)
-        self.handle_loading_bar(process, 1)
-        process.wait()
+        # Context manager closes the stdout pipe once vina exits.
+        process = self._start_process(args, cwd=self.temp_dir, stdout=subprocess.PIPE)
+        try:
+            with process:
+                self.handle_loading_bar(process, len(ligand_files_pdbqt))
+                self.exit_codes.append(process.wait())
+        finally:
+            self._end_process(process)
+        # In batch mode vina writes <ligand name>_out.pdbqt for each ligand.
+        dock_results = {}
+        for ligand_file in ligand_files_pdbqt:
+            ligand_name = os.path.splitext(os.path.basename(ligand_file))[0]
+            dock_results[ligand_file] = os.path.join(output_dir, f'{ligand_name}_out.pdbqt')
         return dock_results
 
     def handle_loading_bar(self, process, ligand_count):
         """Render loading bar from stdout on the menu.
 
         stdout has a loading bar of asterisks. Every asterisk represents about 2% completed
+        Runs in a worker thread, so menu updates are handed back to the event loop.
         """
         star_count = 0
         stars_per_complex = 51
@@ -170,11 +276,93 @@ class DockingCalculations():
         for c in iter(lambda: process.stdout.read(1), b''):
             if c.decode() == '*':
                 star_count += 1
-                self._plugin.update_loading_bar(star_count, total_stars)
+                self._loop.call_soon_threadsafe(self._plugin.update_loading_bar, star_count, total_stars)
             sys.stdout.buffer.write(c)
 
     def convert_pdbqt_to_sdf(self, pdbqt_file):
-        output_file = tempfile.NamedTemporaryFile(delete=False, dir=self.temp_dir, suffix=".sdf")
-        cmd = ['obabel', '-ipdbqt', pdbqt_file.name, f'-O{output_file.name}']
-        subprocess.run(cmd, cwd=self.temp_dir)
+        return self.convert_pdbqts_to_sdfs([pdbqt_file])[0]
+
+    def convert_pdbqts_to_sdfs(self, pdbqt_files):
+        """Convert all pdbqt files to sdf in one pass, returning sdf paths in the same order.
+
+        Uses the openbabel python bindings in process when available, otherwise a single obabel call.
+        """
+        unique_files = list(dict.fromkeys(pdbqt_files))
+        if pybel:
+            converted = {pdbqt_file: self._pybel_convert(pdbqt_file) for pdbqt_file in unique_files}
+        else:
+            converted = self._obabel_convert(unique_files)
+        return [converted[pdbqt_file] for pdbqt_file in pdbqt_files]
+
+    def _pybel_convert(self, pdbqt_file):
+        output_file = self.scratch.file(suffix=".sdf")
+        writer = pybel.Outputfile('sdf', output_file, overwrite=True)
+        try:
+            for mol in pybel.readfile('pdbqt', pdbqt_file):
+                writer.write(mol)
+        finally:
+            writer.close()
+        return output_file
+
+    def _obabel_convert(self, pdbqt_files):
+        """Convert with one obabel process, then split the sdf it pipes to stdout back per input file.
+
+        Falls back to converting every file on its own when the records can't be matched to their files.
+        """
+        cmd = ['obabel', '-ipdbqt', *pdbqt_files, '-osdf']
+        result = self._run_subprocess(cmd, stdout=subprocess.PIPE, text=True)
+
+        # obabel writes one record per MODEL, in input order, but drops models it can't read.
+        # Then the records of later files would be assigned to the wrong ones.
+        records = list(iter_sdf_lines(result.stdout.splitlines(keepends=True)))
+        model_counts = [get_pdbqt_model_count(pdbqt_file) for pdbqt_file in pdbqt_files]
+        if len(records) != sum(model_counts):
+            Logs.warning(
+                f'obabel converted {len(records)} of {sum(model_counts)} poses, converting result files one by one.')
+            return {pdbqt_file: self._obabel_convert_file(pdbqt_file) for pdbqt_file in pdbqt_files}
+
+        records = iter(records)
+        converted = {}
+        for pdbqt_file, model_count in zip(pdbqt_files, model_counts):
+            output_file = self.scratch.file(suffix=".sdf")
+            with open(output_file, 'w') as f:
+                f.writelines(itertools.islice(records, model_count))
+            converted[pdbqt_file] = output_file
+        return converted
+
+    def _obabel_convert_file(self, pdbqt_file):
+        output_file = self.scratch.file(suffix=".sdf")
+        self._run_subprocess(['obabel', '-ipdbqt', pdbqt_file, f'-O{output_file}'])
         return output_file
+
+    def _run_subprocess(self, args, cwd=None, **kwargs):
+        """Run command, in the temp dir by default, recording its exit code."""
+        process = self._start_process(args, cwd=cwd or self.temp_dir, **kwargs)
+        try:
+            with process:
+                stdout, stderr = process.communicate()
+        finally:
+            self._end_process(process)
+        self.exit_codes.append(process.returncode)
+        return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+
+    def _start_process(self, args, **kwargs):
+        """Start a subprocess that is killed if docking is cancelled."""
+        with self._processes_lock:
+            if self._stopped:
+                raise RuntimeError('Docking was cancelled')
+            process = subprocess.Popen(args, **kwargs)
+            self._processes.add(process)
+        return process
+
+    def _end_process(self, process):
+        with self._processes_lock:
+            self._processes.discard(process)
+
+    def _stop_processes(self):
+        """Kill running subprocesses, and refuse to start new ones."""
+        with self._processes_lock:
+            self._stopped = True
+            for process in self._processes:
+                if process.poll() is None:
+                    process.kill()
@@ -0,0 +1,70 @@
+"""Registry of docking backends.
+
+Backends are registered by import path, and only imported the first time they are used,
+so a plugin process never loads engines it doesn't run. Modules listed in
+$DOCKING_BACKEND_MODULES (comma separated) are imported before the registry is first read,
+so they can call register_backend to add engines without changing run.py.
+"""
+import importlib
+import os
+
+BACKEND_MODULES = [name for name in os.environ.get('DOCKING_BACKEND_MODULES', '').split(',') if name]
+
+
+def _import_attr(path):
+    """Import 'module:attribute' path."""
+    module_name, attr = path.split(':')
+    return getattr(importlib.import_module(module_name), attr)
+
+
+class Backend:
+    """Docking engine, with the plugin class that runs it."""
+
+    def __init__(self, name, display_name, plugin_class, calculations):
+        self.name = name
+        self.display_name = display_name
+        self._plugin_class = plugin_class
+        self._calculations = calculations
+
+    @property
+    def plugin_class(self):
+        return _import_attr(self._plugin_class)
+
+    @property
+    def calculations_class(self):
+        return _import_attr(self._calculations)
+
+
+_backends = {}
+_discovered = False
+
+
+def register_backend(name, display_name, plugin_class, calculations):
+    """Register engine by name. plugin_class and calculations are 'module:attribute' import paths."""
+    _backends[name] = Backend(name, display_name, plugin_class, calculations)
+
+
+def _discover():
+    global _discovered
+    if _discovered:
+        return
+    _discovered = True
+    for module_name in BACKEND_MODULES:
+        importlib.import_module(module_name)
+
+
+def backend_names():
+    _discover()
+    return list(_backends)
+
+
+def get_backend(name):
+    _discover()
+    if name not in _backends:
+        raise ValueError(f"Unknown docking algorithm '{name}', expected one of {', '.join(_backends)}")
+    return _backends[name]
+
+
+register_backend('smina', 'Smina', 'plugin.Docking:SminaDocking', 'plugin.smina.calculations:DockingCalculations')
+register_backend(
+    'autodock4', 'Autodock4', 'plugin.Docking:Autodock4Docking', 'plugin.autodock4.calculations:DockingCalculations')
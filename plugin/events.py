@@ -0,0 +1,55 @@
+import asyncio
+from contextlib import contextmanager
+
+from nanome.util import Logs
+
+# Seconds to wait for more events before refreshing.
+DEFAULT_COALESCE_DELAY = 0.25
+
+
+class EventCoalescer:
+    """Collapse bursts of triggers into a single call of an async callback.
+
+    Every trigger restarts the delay, and cancels the callback if it is already
+    running, so only the most recent trigger results in a completed call.
+    """
+
+    def __init__(self, callback, delay=DEFAULT_COALESCE_DELAY):
+        self._callback = callback
+        self.delay = delay
+        self._task = None
+        self._suppressed = 0
+
+    def trigger(self):
+        if self._suppressed:
+            return
+        self.cancel()
+        self._task = asyncio.ensure_future(self._run())
+
+    def cancel(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+
+    async def _run(self):
+        try:
+            await asyncio.sleep(self.delay)
+            await self._callback()
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            Logs.error('Error while handling coalesced event')
+
+    @contextmanager
+    def suppress(self):
+        """Ignore triggers while active, then trigger once on exit."""
+        self._suppressed += 1
+        try:
+            yield
+        finally:
+            self._suppressed -= 1
+            self.trigger()
+
+    async def wait(self):
+        """Wait for the pending call, if any, to finish."""
+        if self._task:
+            await asyncio.gather(self._task, return_exceptions=True)
@@ -0,0 +1,228 @@
+"""Append-only history of docking jobs, used for performance analytics.
+
+Every call to `Docking.run_docking` produces one JSON line in `jobs.jsonl`.
+Files are rotated once they reach JOB_HISTORY_MAX_BYTES, keeping
+JOB_HISTORY_BACKUPS older files around (jobs.jsonl.1, jobs.jsonl.2, ...).
+
+Run `python -m plugin.job_store report` for latency percentiles by algorithm and size bucket.
+"""
+import argparse
+import json
+import math
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+from nanome.util import Logs
+
+DEFAULT_JOB_HISTORY_DIR = os.path.join(os.path.expanduser('~'), '.nanome_docking')
+JOB_HISTORY_DIR = os.environ.get('JOB_HISTORY_DIR', DEFAULT_JOB_HISTORY_DIR)
+JOB_HISTORY_MAX_BYTES = int(os.environ.get('JOB_HISTORY_MAX_BYTES', 5 * 1024 * 1024))
+JOB_HISTORY_BACKUPS = int(os.environ.get('JOB_HISTORY_BACKUPS', 5))
+JOB_HISTORY_FILENAME = 'jobs.jsonl'
+
+# Upper bounds (inclusive) of ligand frame count for each size bucket.
+SIZE_BUCKETS = [(1, '1'), (4, '2-4'), (16, '5-16'), (64, '17-64')]
+LARGEST_SIZE_BUCKET = '65+'
+
+
+def size_bucket(frame_count):
+    """Group jobs by total number of ligand frames docked."""
+    for upper_bound, label in SIZE_BUCKETS:
+        if frame_count <= upper_bound:
+            return label
+    return LARGEST_SIZE_BUCKET
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of values. Returns None for empty input."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(math.ceil(pct / 100.0 * len(ordered))), 1)
+    return ordered[rank - 1]
+
+
+class JobRecord:
+    """Durable record of a single docking run."""
+
+    def __init__(self, algorithm, inputs=None, params=None):
+        self.job_id = uuid.uuid4().hex
+        self.algorithm = algorithm
+        self.inputs = dict(inputs or {})
+        self.params = dict(params or {})
+        self.stages = {}
+        self.exit_codes = []
+        self.status = 'running'
+        self.timed_out = False
+        # Ligand name -> reduced search settings it was docked with after timing out.
+        self.degraded_ligands = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.scratch_peak_bytes = 0
+        # Directory the profile of the job was written to, when profiling is enabled.
+        self.profile_dir = None
+        self.started_at = time.time()
+        self.finished_at = None
+
+    @contextmanager
+    def stage(self, name):
+        """Time a stage of the job. Repeated stages accumulate."""
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start_time
+            self.stages[name] = round(self.stages.get(name, 0.0) + elapsed, 4)
+
+    def finish(self, status):
+        self.status = status
+        self.finished_at = time.time()
+
+    @property
+    def duration(self):
+        end_time = self.finished_at or time.time()
+        return round(end_time - self.started_at, 4)
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'algorithm': self.algorithm,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'duration': self.duration,
+            'status': self.status,
+            'timed_out': self.timed_out,
+            'degraded_ligands': self.degraded_ligands,
+            'exit_codes': self.exit_codes,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'scratch_peak_bytes': self.scratch_peak_bytes,
+            'profile_dir': self.profile_dir,
+            'inputs': self.inputs,
+            'params': self.params,
+            'stages': self.stages,
+        }
+
+
+class JobStore:
+    """JSONL job history with size based rotation."""
+
+    def __init__(self, directory=JOB_HISTORY_DIR, max_bytes=JOB_HISTORY_MAX_BYTES, backup_count=JOB_HISTORY_BACKUPS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.path = os.path.join(directory, JOB_HISTORY_FILENAME)
+
+    def append(self, record):
+        """Write record to the end of the history. Failures are logged, never raised."""
+        data = record.to_dict() if isinstance(record, JobRecord) else record
+        line = json.dumps(data, default=str) + '\n'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if self._should_rotate(len(line)):
+                self._rotate()
+            with open(self.path, 'a') as f:
+                f.write(line)
+        except OSError as e:
+            Logs.warning(f'Unable to write job history: {e}')
+
+    def _should_rotate(self, incoming_bytes):
+        if not self.max_bytes or not os.path.exists(self.path):
+            return False
+        return os.path.getsize(self.path) + incoming_bytes > self.max_bytes
+
+    def _rotate(self):
+        if self.backup_count <= 0:
+            os.remove(self.path)
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f'{self.path}.{i}'
+            if os.path.exists(src):
+                os.replace(src, f'{self.path}.{i + 1}')
+        os.replace(self.path, f'{self.path}.1')
+
+    def _history_files(self):
+        """History files, oldest first."""
+        backups = [f'{self.path}.{i}' for i in range(self.backup_count, 0, -1)]
+        return [path for path in backups + [self.path] if os.path.exists(path)]
+
+    def iter_records(self):
+        for path in self._history_files():
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        Logs.warning(f'Skipping malformed job history line in {path}')
+
+    def query(self, algorithm=None, status=None, since=None):
+        """Return records matching all provided filters."""
+        results = []
+        for record in self.iter_records():
+            if algorithm and record.get('algorithm') != algorithm:
+                continue
+            if status and record.get('status') != status:
+                continue
+            if since and (record.get('started_at') or 0) < since:
+                continue
+            results.append(record)
+        return results
+
+    def latency_report(self, records=None):
+        """p50/p95 job duration grouped by (algorithm, size bucket)."""
+        if records is None:
+            records = self.query(status='success')
+        groups = {}
+        for record in records:
+            frame_count = record.get('inputs', {}).get('ligand_frame_count', 0)
+            key = (record.get('algorithm'), size_bucket(frame_count))
+            groups.setdefault(key, []).append(record['duration'])
+
+        report = []
+        for (algorithm, bucket), durations in sorted(groups.items(), key=lambda item: (str(item[0][0]), item[0][1])):
+            report.append({
+                'algorithm': algorithm,
+                'size_bucket': bucket,
+                'count': len(durations),
+                'p50': percentile(durations, 50),
+                'p95': percentile(durations, 95),
+            })
+        return report
+
+
+def format_report(report):
+    header = f"{'algorithm':<12}{'frames':>8}{'jobs':>8}{'p50 (s)':>12}{'p95 (s)':>12}"
+    lines = [header, '-' * len(header)]
+    for row in report:
+        lines.append(
+            f"{str(row['algorithm']):<12}{row['size_bucket']:>8}{row['count']:>8}"
+            f"{row['p50']:>12.2f}{row['p95']:>12.2f}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query the docking job history.')
+    parser.add_argument('command', choices=['report', 'dump'], help='report: latency percentiles, dump: raw records')
+    parser.add_argument('--dir', default=JOB_HISTORY_DIR, help='Job history directory')
+    parser.add_argument('--algorithm', default=None, help='Only include jobs run with this algorithm')
+    parser.add_argument('--status', default=None, help='Only include jobs with this status (report defaults to success)')
+    parser.add_argument('--since-hours', type=float, default=None, help='Only include jobs started in the last N hours')
+    args = parser.parse_args(argv)
+
+    store = JobStore(args.dir)
+    since = time.time() - args.since_hours * 3600 if args.since_hours else None
+    if args.command == 'dump':
+        for record in store.query(args.algorithm, args.status, since):
+            print(json.dumps(record))
+        return
+    records = store.query(args.algorithm, args.status or 'success', since)
+    print(format_report(store.latency_report(records)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Docking jobs started in this session.
+
+Several jobs can run at once. Each one has its own engines, progress and results,
+and the job list menu shows their status.
+"""
+import asyncio
+import itertools
+import os
+import time
+
+# Finished jobs kept in the job list, the oldest are dropped first.
+JOB_LIST_MAX_FINISHED = int(os.environ.get('JOB_LIST_MAX_FINISHED', 10))
+
+RUNNING_STATUSES = ('running', 'refining')
+
+
+class SessionJob:
+    """A docking run started from the menu.
+
+    Engines of the job report their progress here instead of to the plugin.
+    """
+
+    def __init__(self, job_id, description, on_change=None):
+        self.job_id = job_id
+        self.description = description
+        self.status = 'running'
+        self.detail = ''
+        self.current = 0
+        self.total = 0
+        self.results = []
+        # JobRecord of every pass of the job, progressive jobs run two.
+        self.records = []
+        self.task = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self._on_change = on_change
+
+    @property
+    def running(self):
+        return self.status in RUNNING_STATUSES
+
+    @property
+    def progress(self):
+        return self.current / self.total if self.total else 0.0
+
+    def update_loading_bar(self, current, total):
+        self.current = current
+        self.total = total
+        self._changed()
+
+    def update_run_btn_text(self, new_text):
+        self.detail = new_text
+        self._changed()
+
+    def add_record(self, record, refining=False):
+        """Take the status of a finished pass of the job."""
+        self.records.append(record)
+        self.current = self.total = 0
+        self.detail = ''
+        if refining and record.status == 'success':
+            self.status = 'refining'
+            self._changed()
+        else:
+            self.finish(record.status)
+
+    def finish(self, status, detail=''):
+        self.status = status
+        self.detail = detail
+        self.finished_at = time.time()
+        self._changed()
+
+    def cancel(self):
+        if self.task and not self.task.done():
+            self.task.cancel()
+
+    def _changed(self):
+        if self._on_change:
+            self._on_change(self)
+
+
+class SessionJobs:
+    """Jobs of the session in the order they were started."""
+
+    def __init__(self, on_change=None, max_finished=JOB_LIST_MAX_FINISHED):
+        self._on_change = on_change
+        self.max_finished = max_finished
+        self._jobs = {}
+        self._job_ids = itertools.count(1)
+
+    def __iter__(self):
+        return iter(list(self._jobs.values()))
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def create(self, description):
+        job = SessionJob(next(self._job_ids), description, self._changed)
+        self._jobs[job.job_id] = job
+        self._changed(job)
+        return job
+
+    def running(self):
+        return [job for job in self if job.running]
+
+    def cancel_all(self):
+        for job in self:
+            job.cancel()
+
+    async def wait(self):
+        tasks = [job.task for job in self if job.task]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _changed(self, job):
+        finished = [job_id for job_id, job in self._jobs.items() if not job.running]
+        for job_id in finished[:max(len(finished) - self.max_finished, 0)]:
+            del self._jobs[job_id]
+        if self._on_change:
+            self._on_change(job)
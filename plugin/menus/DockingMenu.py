@@ -10,12 +10,15 @@ from plugin.utils import get_complex_center
 
 BASE_DIR = os.path.dirname(__file__)
 ICONS_DIR = os.path.join(BASE_DIR, 'icons')
-ICONS = {icon.rsplit('.')[0]: os.path.join(ICONS_DIR, icon) for icon in os.listdir(ICONS_DIR)}
 
 SETTINGS_JSON_PATH = os.path.join(BASE_DIR, 'jsons', 'docking_settings.json')
 MENU_JSON_PATH = os.path.join(BASE_DIR, 'jsons', 'docking_menu.json')
 
 
+def icon_path(name):
+    return os.path.join(ICONS_DIR, f'{name}.png')
+
+
 class DockingMenu():
 
     def __init__(self, docking_plugin):
@@ -25,7 +28,8 @@ class DockingMenu():
         algo_name = self._plugin.__class__.__name__.split('Docking')[0]
         self._menu.title = f'{algo_name} Docking'
 
-        self._selected_receptor = None
+        # More than one receptor runs ensemble docking.
+        self._selected_receptors = []
         self._selected_ligands = []
         self._selected_site = None
         self._modes = 5
@@ -35,6 +39,9 @@ class DockingMenu():
         self._replace = False
         self._scoring = False
         self._visual_scores = False
+        # complex index -> (ligand, receptor, site) dropdown items.
+        self._complex_items = {}
+        self._complex_list_state = None
 
         # Run button
         self.ln_run_button = self._menu.root.find_node("RunButton")
@@ -45,6 +52,14 @@ class DockingMenu():
         self.ln_loading_bar = self._menu.root.find_node("LoadingBar")
         self.loading_bar = self.ln_loading_bar.get_content()
 
+    @property
+    def _selected_receptor(self):
+        return self._selected_receptors[0] if self._selected_receptors else None
+
+    @_selected_receptor.setter
+    def _selected_receptor(self, receptor):
+        self._selected_receptors = [receptor] if receptor else []
+
     def close_menu(self, menu):
         Logs.message("Menu closed")
         if hasattr(self, 'site_sphere') and self.site_sphere:
@@ -86,18 +101,9 @@ class DockingMenu():
                 Logs.warning("Trying to run docking without having one receptor, one site and at least one ligand selected")
                 return
 
-        self.loading_bar.percentage = 0
-        self.enable_loading_bar()
-        self.make_plugin_usable(False)
-        try:
-            await self._plugin.run_docking(self._selected_receptor, ligands, site, self.get_params())
-        except Exception as e:
-            message = f'{type(e).__name__}: {next(iter(e.args), "Error Occurred. Please Check Logs.")}'
-            Logs.error(message)
-            self._plugin.send_notification(NotificationTypes.error, message)
-
-        self.make_plugin_usable(True)
-        self.enable_loading_bar(False)
+        # Jobs run in the background, so the next one can be set up while they dock.
+        docking_job = self._plugin.start_job(self._selected_receptors, ligands, site, self.get_params())
+        Logs.message(f"Docking job {docking_job.job_id} started")
 
     def make_plugin_usable(self, state=True):
         self._run_button.unusable = (not state) or self.refresh_run_btn_unusable(update=False)
@@ -123,15 +129,34 @@ class DockingMenu():
         return self._run_button.unusable
 
     def change_complex_list(self, complex_list):
-        """When complex list is updated, repopulate dropdowns."""
-        ligand_list = []
-        receptor_list = []
-        site_list = []
+        """When complex list is updated, repopulate dropdowns.
 
-        ligand_list = self.create_complex_dropdown_items(complex_list)
-        receptor_list = self.create_complex_dropdown_items(complex_list)
-        site_list = self.create_complex_dropdown_items(complex_list)
+        Dropdown items are reused for complexes that were already listed,
+        and nothing is sent if the list did not change.
+        """
+        complex_list_state = [(comp.index, comp.full_name) for comp in complex_list]
+        if complex_list_state == self._complex_list_state:
+            return
+        self._complex_list_state = complex_list_state
 
+        complex_items = {}
+        for comp in complex_list:
+            items = self._complex_items.get(comp.index)
+            if items is None:
+                items = tuple(self.create_complex_dropdown_items([comp] * 3))
+                # Ligands and receptors should allow multiple selections
+                items[0].close_on_selected = False
+                items[1].close_on_selected = False
+            for item in items:
+                item.name = comp.full_name
+                item.complex = comp
+                item.selected = False
+            complex_items[comp.index] = items
+        self._complex_items = complex_items
+
+        ligand_list = [items[0] for items in complex_items.values()]
+        receptor_list = [items[1] for items in complex_items.values()]
+        site_list = [items[2] for items in complex_items.values()]
         self.dd_ligands.items = ligand_list
         self.dd_receptor.items = receptor_list
         self.dd_site.items = site_list
@@ -139,52 +164,40 @@ class DockingMenu():
         self.dd_receptor.max_displayed_items = len(receptor_list)
         self.dd_site.max_displayed_items = len(site_list)
 
-        # Ligands should allow multiple selections
-        for item in self.dd_ligands.items:
-            item.close_on_selected = False
-
-        # Reselect previously selected ligands
-        self.dd_ligands._selected_items = []
-        for comp in self._selected_ligands:
-            dd_item = next((item for item in self.dd_ligands.items if item.complex.index == comp.index), None)
-            if dd_item:
-                dd_item.selected = True
-                self.dd_ligands._selected_items.append(dd_item)
-
-        if not any([item.selected for item in self.dd_ligands.items]):
-            self.dd_ligands.use_permanent_title = True
-            self.dd_ligands.permanent_title = "None"
-            self._selected_ligands = []
-
-        # Reselect previously selected receptor
-        if self._selected_receptor:
-            new_receptor_item = next(
-                (item for item in self.dd_receptor.items if item.complex.index == self._selected_receptor.index), None)
-            if new_receptor_item:
-                new_receptor_item.selected = True
-
-        if not any([item.selected for item in self.dd_receptor.items]):
-            self.dd_receptor.use_permanent_title = True
-            self.dd_receptor.permanent_title = "None"
-            self._selected_receptor = None
-
+        # Reselect previously selected ligands and receptors
+        self._selected_ligands = self._reselect_items(self.dd_ligands, self._selected_ligands, 0)
+        self._selected_receptors = self._reselect_items(self.dd_receptor, self._selected_receptors, 1)
         # Reselect previously selected site.
-        if self._selected_site:
-            new_site_item = next(
-                (item for item in self.dd_site.items if item.complex.index == self._selected_site.index), None)
-            if new_site_item:
-                new_site_item.selected = True
-
-        if not any([item.selected for item in self.dd_site.items]):
-            self.dd_site.use_permanent_title = True
-            self.dd_site.permanent_title = "None"
-            self._selected_site = None
+        self._selected_site = self._reselect_item(self.dd_site, self._selected_site, 2)
 
         self.refresh_run_btn_unusable(update=False)
-        self._plugin.update_menu(self._menu)
+        self._plugin.update_content(self.dd_ligands, self.dd_receptor, self.dd_site, self._run_button)
+
+    def _reselect_items(self, dropdown, selected_complexes, item_column):
+        """Select the dropdown items of previously selected complexes that are still in the workspace."""
+        dropdown._selected_items = []
+        for comp in selected_complexes:
+            items = self._complex_items.get(comp.index)
+            if items:
+                items[item_column].selected = True
+                dropdown._selected_items.append(items[item_column])
+        if not dropdown._selected_items:
+            dropdown.use_permanent_title = True
+            dropdown.permanent_title = "None"
+        return [ddi.complex for ddi in dropdown._selected_items]
+
+    def _reselect_item(self, dropdown, selected_complex, item_column):
+        """Select the dropdown item of a previously selected complex, if it is still in the workspace."""
+        items = self._complex_items.get(selected_complex.index) if selected_complex else None
+        if items:
+            items[item_column].selected = True
+            return items[item_column].complex
+        dropdown.use_permanent_title = True
+        dropdown.permanent_title = "None"
+        return None
 
     def handle_ligand_selected(self, dropdown, item):
-        self.multi_select_dropdown(dropdown, item)
+        self.multi_select_dropdown(dropdown, item, 'Ligand')
 
         dropdown.use_permanent_title = len(dropdown._selected_items) > 1
         if not dropdown._selected_items:
@@ -203,21 +216,22 @@ class DockingMenu():
         self._plugin.update_menu(self._menu)
 
     def handle_receptor_selected(self, dropdown, item):
-        # If selected complex was previously selected, we are actually unselecting it.
-        unselecting_complex = self._selected_receptor and item.complex.index == self._selected_receptor.index
-        if unselecting_complex:
-            Logs.message(f"Receptor {item.complex.index} Deselected.")
-        else:
-            Logs.message(f"Receptor {item.complex.index} Selected.")
-        self._selected_receptor = None if unselecting_complex else item.complex
+        # Selecting more than one receptor docks against all of them.
+        self.multi_select_dropdown(dropdown, item, 'Receptor')
+        self._selected_receptors = [ddi.complex for ddi in dropdown._selected_items]
 
-        if self._selected_receptor:
+        if len(self._selected_receptors) > 1:
+            dropdown.use_permanent_title = True
+            dropdown.permanent_title = ','.join(comp.full_name for comp in self._selected_receptors)
+            self._receptor_txt._text_value = f'{len(self._selected_receptors)} receptors'
+        elif self._selected_receptor:
             dropdown.use_permanent_title = False
             receptor_text = ''
-            if len(item.complex.full_name) <= 4:
-                receptor_text = item.complex.full_name
+            full_name = self._selected_receptor.full_name
+            if len(full_name) <= 4:
+                receptor_text = full_name
             else:
-                receptor_text = item.complex.full_name[:8] + '...'
+                receptor_text = full_name[:8] + '...'
             self._receptor_txt._text_value = receptor_text
         else:
             self._receptor_txt._text_value = "Receptor"
@@ -280,10 +294,10 @@ class DockingMenu():
         self._plugin.update_menu(self._menu)
 
     def update_icons(self):
-        self._ligand_icon._file_path = ICONS['ligand_white' if self._selected_ligands else 'ligand_gray']
-        self._receptor_icon._file_path = ICONS['receptor_white' if self._selected_receptor else 'receptor_gray']
+        self._ligand_icon._file_path = icon_path('ligand_white' if self._selected_ligands else 'ligand_gray')
+        self._receptor_icon._file_path = icon_path('receptor_white' if self._selected_receptor else 'receptor_gray')
         can_dock = self._selected_ligands and self._selected_receptor and self._selected_site
-        self._check_arrow._file_path = ICONS['can_dock' if can_dock else 'cannot_dock']
+        self._check_arrow._file_path = icon_path('can_dock' if can_dock else 'cannot_dock')
 
     def build_menu(self):
         # panels
@@ -292,15 +306,15 @@ class DockingMenu():
         self._panel_separator = root.find_node("MiddleLine")
 
         # images
-        self._check_arrow = root.find_node("CheckArrow").add_new_image(ICONS['cannot_dock'])
-        self._ligand_icon = root.find_node("LigandIcon").add_new_image(ICONS['ligand_gray'])
-        self._receptor_icon = root.find_node("ReceptorIcon").add_new_image(ICONS['receptor_gray'])
+        self._check_arrow = root.find_node("CheckArrow").add_new_image(icon_path('cannot_dock'))
+        self._ligand_icon = root.find_node("LigandIcon").add_new_image(icon_path('ligand_gray'))
+        self._receptor_icon = root.find_node("ReceptorIcon").add_new_image(icon_path('receptor_gray'))
 
         slider_oval = root.find_node("SizeOval")
-        slider_oval.add_new_image(file_path=ICONS['DarkOval'])
+        slider_oval.add_new_image(file_path=icon_path('DarkOval'))
 
         refresh_icon = root.find_node("RefreshIcon")
-        refresh_icon.add_new_image(file_path=ICONS['refresh'])
+        refresh_icon.add_new_image(file_path=icon_path('refresh'))
 
         # text
         self._txt2 = root.find_node("ModesInput").get_content()
@@ -325,6 +339,17 @@ class DockingMenu():
         pose_add_btn = root.find_node("PoseAdd").get_content()
         pose_add_btn.register_pressed_callback(self.pose_added_callback)
 
+        # In place scoring is only available for engines that support it.
+        ln_preview = root.find_node("Preview")
+        ln_preview.enabled = hasattr(self._plugin, 'preview_scores')
+        self._score_button = root.find_node("ScoreButton").get_content()
+        self._score_button.register_pressed_callback(self.score_button_pressed_callback)
+        self._minimize_button = root.find_node("MinimizeButton").get_content()
+        self._minimize_button.register_pressed_callback(self.minimize_button_pressed_callback)
+
+        jobs_button = root.find_node("JobsButton").get_content()
+        jobs_button.register_pressed_callback(self.jobs_button_pressed_callback)
+
         location_refresh_btn = root.find_node("LocationRefresh").get_content()
         location_refresh_btn.register_pressed_callback(self.loc_refresh_pressed_callback)
 
@@ -357,6 +382,32 @@ class DockingMenu():
     async def run_button_pressed_callback(self, button):
         await self._run_docking()
 
+    def jobs_button_pressed_callback(self, button):
+        self._plugin.jobs_menu.enable()
+
+    @async_callback
+    async def score_button_pressed_callback(self, button):
+        await self._run_preview(button, minimize=False)
+
+    @async_callback
+    async def minimize_button_pressed_callback(self, button):
+        await self._run_preview(button, minimize=True)
+
+    async def _run_preview(self, button, minimize):
+        if not self._selected_receptor or not self._selected_ligands:
+            self._plugin.send_notification(NotificationTypes.warning, "Please select a receptor and at least one ligand")
+            return
+        button.unusable = True
+        self._plugin.update_content(button)
+        try:
+            await self._plugin.preview_scores(self._selected_receptor, self._selected_ligands, minimize=minimize)
+        except Exception as e:
+            message = f'{type(e).__name__}: {next(iter(e.args), "Error Occurred. Please Check Logs.")}'
+            Logs.error(message)
+            self._plugin.send_notification(NotificationTypes.error, message)
+        button.unusable = False
+        self._plugin.update_content(button)
+
     def modes_changed(self, input):
         try:
             self._modes = int(input.input_text)
@@ -407,16 +458,16 @@ class DockingMenu():
             self.draw_site_sphere(comp, radius)
             self._plugin.update_menu(self._menu)
 
-    def multi_select_dropdown(self, dropdown, item):
+    def multi_select_dropdown(self, dropdown, item, kind='Ligand'):
         if not hasattr(dropdown, '_selected_items'):
             dropdown._selected_items = []
 
         selected_items = dropdown._selected_items
         if item not in selected_items:
-            Logs.message(f"Ligand {item.complex.index} Selected")
+            Logs.message(f"{kind} {item.complex.index} Selected")
             selected_items.append(item)
         else:
-            Logs.message(f"Ligand {item.complex.index} Deselected")
+            Logs.message(f"{kind} {item.complex.index} Deselected")
             selected_items.remove(item)
             item.selected = False
 
@@ -439,6 +490,61 @@ class DockingMenu():
         self._plugin.update_menu(self._menu)
 
 
+class JobsMenu:
+    """List of the docking jobs of the session, with their status and progress."""
+
+    def __init__(self, plugin):
+        self._plugin = plugin
+        self._menu = nanome.ui.Menu(index=2, title='Docking Jobs')
+        self._menu.width = 1
+        self._menu.height = 0.8
+        self._menu.enabled = False
+        self._menu.register_closed_callback(self.close_menu)
+        self._job_list = self._menu.root.create_child_node().add_new_list()
+        self._job_list.display_rows = 6
+        # job id -> (row, status label, cancel button)
+        self._rows = {}
+
+    def enable(self):
+        self.update(list(self._plugin.jobs))
+        self._menu.enabled = True
+        self._plugin.update_menu(self._menu)
+
+    def close_menu(self, menu):
+        self._menu.enabled = False
+
+    def update(self, jobs):
+        """Show jobs, most recent first. Rows are reused for jobs already listed."""
+        rows = {}
+        for job in reversed(jobs):
+            row, label, cancel_button = self._rows.get(job.job_id) or self._create_row(job)
+            label.text_value = self.describe(job)
+            cancel_button.unusable = not job.running
+            rows[job.job_id] = (row, label, cancel_button)
+        self._rows = rows
+        self._job_list.items = [row for row, _, _ in rows.values()]
+        if self._menu.enabled:
+            self._plugin.update_content(self._job_list)
+
+    @staticmethod
+    def describe(job):
+        status = job.detail or job.status.capitalize()
+        if job.running and job.total:
+            status = f'{status} {round(job.progress * 100)}%'
+        return f'#{job.job_id} {job.description}: {status}'
+
+    def _create_row(self, job):
+        row = nanome.ui.LayoutNode()
+        row.layout_orientation = nanome.ui.LayoutNode.LayoutTypes.horizontal
+        label = row.create_child_node().add_new_label()
+        label.text_max_size = 0.3
+        button_node = row.create_child_node()
+        button_node.set_size_ratio(0.2)
+        cancel_button = button_node.add_new_button('Cancel')
+        cancel_button.register_pressed_callback(lambda button: job.cancel())
+        return row, label, cancel_button
+
+
 class SettingsMenu:
 
     def __init__(self, plugin):
@@ -450,20 +556,27 @@ class SettingsMenu:
         menu_root = self._menu.root
         self._menu.register_closed_callback(self.close_menu)
         self.setting_slider_oval = menu_root.find_node("ExhaustOval")
-        self.setting_slider_oval.add_new_image(file_path=ICONS['DarkOval'])
+        self.setting_slider_oval.add_new_image(file_path=icon_path('DarkOval'))
         self._exhaustiveness_txt = menu_root.find_node("ExhaustValue").get_content()
         self._display_score_btn = menu_root.find_node("VisualScoresButton").get_content()
         self._exhaust_slider = menu_root.find_node("ExhaustSlider").get_content()
         self._visual_scores = False
+        self._color_scores_btn = menu_root.find_node("ColorScoresButton").get_content()
+        self._color_scores = False
 
         self._btn_deterministic = menu_root.find_node("btn_deterministic_results").get_content()
         self._btn_deterministic.toggle_on_press = True
         self._btn_deterministic.register_pressed_callback(self.btn_deterministic_pressed_callback)
 
+        self._btn_progressive = menu_root.find_node("btn_progressive_results").get_content()
+        self._btn_progressive.toggle_on_press = True
+        self._btn_progressive.register_pressed_callback(self.btn_progressive_pressed_callback)
+
         self._exhaust_slider.register_released_callback(self.exhaust_slider_released_callback)
         self._exhaust_slider.current_value = self._exhaustiveness
         self._exhaustiveness_txt.text_value = str(self._exhaustiveness)
         self._display_score_btn.register_pressed_callback(self.visual_scores_button_pressed_callback)
+        self._color_scores_btn.register_pressed_callback(self.color_scores_button_pressed_callback)
 
     def enable(self):
         self._menu.enabled = True
@@ -485,9 +598,20 @@ class SettingsMenu:
         await self._plugin.toggle_atom_labels(self._visual_scores)
         self._plugin.update_content(button)
 
+    @async_callback
+    async def color_scores_button_pressed_callback(self, button):
+        self._color_scores = not self._color_scores
+        Logs.message(f"Color Scores set to {self._color_scores}")
+        button.selected = self._color_scores
+        await self._plugin.toggle_score_colors(self._color_scores)
+        self._plugin.update_content(button)
+
     def btn_deterministic_pressed_callback(self, btn):
         Logs.message(f"Deterministic Runs set to {btn.selected}")
 
+    def btn_progressive_pressed_callback(self, btn):
+        Logs.message(f"Progressive Results set to {btn.selected}")
+
     def close_menu(self, menu):
         Logs.message("closing advanced menu")
 
@@ -495,5 +619,7 @@ class SettingsMenu:
         return {
             'exhaustiveness': self._exhaustiveness,
             'visual_scores': self._visual_scores,
-            'deterministic': self._btn_deterministic.selected
+            'color_scores': self._color_scores,
+            'deterministic': self._btn_deterministic.selected,
+            'progressive': self._btn_progressive.selected,
         }
@@ -0,0 +1,110 @@
+"""Opt-in profiling of docking jobs.
+
+Set $DOCKING_PROFILE_DIR, or pass --profile-dir to run.py, to profile every docking pass with cProfile
+and tracemalloc. Each pass writes a directory named after its start time and job id, containing:
+
+- profile.prof: cProfile stats, for pstats or snakeviz.
+- profile.txt: the functions with the most cumulative time.
+- memory.json: peak traced memory, and the lines that allocated the most memory still held at the end of the pass.
+
+Only the newest $DOCKING_PROFILE_KEEP job directories are kept. When profiling is disabled, jobs only pay for
+a single check.
+
+cProfile and tracemalloc see everything running in the plugin process, so while one job is profiled,
+jobs started alongside it are not profiled, and the profile includes their work.
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import shutil
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from nanome.util import Logs
+
+DOCKING_PROFILE_DIR = os.environ.get('DOCKING_PROFILE_DIR')
+DOCKING_PROFILE_KEEP = max(int(os.environ.get('DOCKING_PROFILE_KEEP', 20)), 1)
+# Frames of traceback stored by tracemalloc for each allocation.
+TRACEMALLOC_FRAMES = 1
+# Number of functions and allocating lines listed in the summaries.
+PROFILE_SUMMARY_LINES = 30
+
+_profiling = False
+
+
+class JobProfile:
+    """cProfile and tracemalloc measurements of one docking pass."""
+
+    def __init__(self, job_id, profile_dir):
+        self.job_id = job_id
+        started = time.strftime('%Y%m%d-%H%M%S')
+        self.path = os.path.join(profile_dir, f'{started}_{job_id}')
+        self._profiler = cProfile.Profile()
+        self._stop_tracemalloc = False
+        self._start_time = None
+
+    def start(self):
+        self._start_time = time.time()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self._stop_tracemalloc = True
+        tracemalloc.reset_peak()
+        self._profiler.enable()
+
+    def stop(self):
+        self._profiler.disable()
+        current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        if self._stop_tracemalloc:
+            tracemalloc.stop()
+        top_allocations = [
+            {'location': str(stat.traceback), 'size_bytes': stat.size, 'count': stat.count}
+            for stat in snapshot.statistics('lineno')[:PROFILE_SUMMARY_LINES]]
+        memory = {
+            'job_id': self.job_id,
+            'duration': round(time.time() - self._start_time, 4),
+            'peak_bytes': peak_bytes,
+            'current_bytes': current_bytes,
+            'top_allocations': top_allocations,
+        }
+        os.makedirs(self.path, exist_ok=True)
+        self._profiler.dump_stats(os.path.join(self.path, 'profile.prof'))
+        summary = io.StringIO()
+        pstats.Stats(self._profiler, stream=summary).sort_stats('cumulative').print_stats(PROFILE_SUMMARY_LINES)
+        with open(os.path.join(self.path, 'profile.txt'), 'w') as f:
+            f.write(summary.getvalue())
+        with open(os.path.join(self.path, 'memory.json'), 'w') as f:
+            json.dump(memory, f, indent=2)
+
+
+def prune_profiles(profile_dir, keep=DOCKING_PROFILE_KEEP):
+    """Remove all but the newest keep job directories."""
+    job_dirs = sorted(
+        name for name in os.listdir(profile_dir) if os.path.isdir(os.path.join(profile_dir, name)))
+    for name in job_dirs[:max(len(job_dirs) - keep, 0)]:
+        shutil.rmtree(os.path.join(profile_dir, name), ignore_errors=True)
+
+
+@contextmanager
+def profile_job(job_id, profile_dir=None, keep=DOCKING_PROFILE_KEEP):
+    """Profile the body when profiling is enabled, yielding the directory the profile is written to, or None."""
+    global _profiling
+    profile_dir = profile_dir or DOCKING_PROFILE_DIR
+    if not profile_dir or _profiling:
+        yield None
+        return
+    _profiling = True
+    profile = JobProfile(job_id, profile_dir)
+    profile.start()
+    try:
+        yield profile.path
+    finally:
+        _profiling = False
+        try:
+            profile.stop()
+            prune_profiles(profile_dir, keep)
+        except OSError as e:
+            Logs.warning(f'Unable to write job profile: {e}')
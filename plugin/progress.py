@@ -0,0 +1,38 @@
+class CombinedProgress:
+    """Loading bar progress of a job run by several engines at once.
+
+    Each engine reports to its own EngineProgress, and on_update is called with the sum over all engines.
+    """
+
+    def __init__(self, on_update):
+        self._on_update = on_update
+        self._engines = []
+
+    def engine(self, host):
+        """Progress for one more engine. host receives messages that aren't progress."""
+        engine_progress = EngineProgress(self, host)
+        self._engines.append(engine_progress)
+        return engine_progress
+
+    def update(self):
+        total = sum(engine.total for engine in self._engines)
+        if total:
+            self._on_update(sum(engine.current for engine in self._engines), total)
+
+
+class EngineProgress:
+    """Stands in for the plugin as the host of an engine, collecting the progress it reports."""
+
+    def __init__(self, combined, host):
+        self._combined = combined
+        self._host = host
+        self.current = 0
+        self.total = 0
+
+    def update_loading_bar(self, current, total):
+        self.current = current
+        self.total = total
+        self._combined.update()
+
+    def update_run_btn_text(self, new_text):
+        self._host.update_run_btn_text(new_text)
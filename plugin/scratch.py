@@ -0,0 +1,118 @@
+"""Scratch space for files that only live for a single docking job.
+
+Job directories are placed on a RAM-backed filesystem when one is available (/dev/shm on Linux),
+so intermediate PDB, PDBQT, GPF, DPF, log and output files never touch the disk.
+Usage is checked against a per-job and a per-host quota whenever a new file is allocated.
+Host usage is measured by walking every job directory, so a measurement is reused for
+SCRATCH_HOST_USAGE_INTERVAL seconds rather than repeated for every allocation.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from nanome.util import Logs
+
+from plugin.utils import path_size
+
+RAM_BACKED_DIR = '/dev/shm'
+# Directory job scratch directories are created in. Shared by all plugin processes on the host.
+SCRATCH_DIR = os.environ.get('DOCKING_SCRATCH_DIR')
+SCRATCH_JOB_QUOTA_MB = int(os.environ.get('SCRATCH_JOB_QUOTA_MB', 1024))
+SCRATCH_HOST_QUOTA_MB = int(os.environ.get('SCRATCH_HOST_QUOTA_MB', 4096))
+# Seconds a measurement of host scratch usage is reused for by quota checks.
+SCRATCH_HOST_USAGE_INTERVAL = float(os.environ.get('SCRATCH_HOST_USAGE_INTERVAL', 1))
+
+
+class ScratchQuotaExceeded(Exception):
+    pass
+
+
+def default_scratch_root():
+    """RAM-backed directory if it is available, otherwise the regular temp directory."""
+    if os.path.isdir(RAM_BACKED_DIR) and os.access(RAM_BACKED_DIR, os.W_OK):
+        return os.path.join(RAM_BACKED_DIR, 'nanome_docking')
+    return os.path.join(tempfile.gettempdir(), 'nanome_docking')
+
+
+class ScratchSpace:
+    """Hands out job scratch directories under a shared root, with size quotas."""
+
+    def __init__(
+            self, root=None, job_quota_mb=SCRATCH_JOB_QUOTA_MB, host_quota_mb=SCRATCH_HOST_QUOTA_MB,
+            host_usage_interval=SCRATCH_HOST_USAGE_INTERVAL):
+        self.root = root or SCRATCH_DIR or default_scratch_root()
+        self.job_quota_bytes = job_quota_mb * 1024 * 1024
+        self.host_quota_bytes = host_quota_mb * 1024 * 1024
+        self.host_usage_interval = host_usage_interval
+        # (time, bytes) of the last measurement of host usage.
+        self._host_usage = None
+        self._host_usage_lock = threading.Lock()
+
+    def job(self):
+        os.makedirs(self.root, exist_ok=True)
+        return ScratchDir(self)
+
+    def usage(self, max_age=0):
+        """Bytes used by all job directories on this host, reusing a measurement up to max_age seconds old."""
+        with self._host_usage_lock:
+            if self._host_usage and time.time() - self._host_usage[0] < max_age:
+                return self._host_usage[1]
+            usage = path_size(self.root) if os.path.isdir(self.root) else 0
+            self._host_usage = (time.time(), usage)
+            return usage
+
+
+class ScratchDir:
+    """Scratch directory of a single job. Removed on cleanup, or when used as a context manager."""
+
+    def __init__(self, space):
+        self.space = space
+        self.path = tempfile.mkdtemp(dir=space.root, prefix='job_')
+        self.peak_bytes = 0
+        self._cleaned_up = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
+
+    def file(self, suffix='', prefix='tmp'):
+        """Create an empty file and return its path. No handle is left open."""
+        self.check_quota()
+        fd, path = tempfile.mkstemp(dir=self.path, prefix=prefix, suffix=suffix)
+        os.close(fd)
+        return path
+
+    def mkdir(self, prefix='tmp'):
+        """Create an empty directory and return its path."""
+        self.check_quota()
+        return tempfile.mkdtemp(dir=self.path, prefix=prefix)
+
+    def usage(self):
+        """Bytes currently used by this job, also recorded in peak_bytes.
+
+        Called after every engine stage, so output written after the last allocation is counted.
+        """
+        usage = path_size(self.path) if os.path.isdir(self.path) else 0
+        self.peak_bytes = max(self.peak_bytes, usage)
+        return usage
+
+    def check_quota(self):
+        """Raise ScratchQuotaExceeded if this job or all jobs on the host use too much space."""
+        usage = self.usage()
+        if usage > self.space.job_quota_bytes:
+            raise ScratchQuotaExceeded(f'Job scratch usage of {usage} bytes exceeds quota')
+        host_usage = self.space.usage(self.space.host_usage_interval)
+        if host_usage > self.space.host_quota_bytes:
+            raise ScratchQuotaExceeded(f'Host scratch usage of {host_usage} bytes exceeds quota')
+
+    def cleanup(self):
+        if self._cleaned_up:
+            return
+        self._cleaned_up = True
+        self.usage()
+        Logs.debug(f'Scratch directory {os.path.basename(self.path)} peaked at {self.peak_bytes} bytes')
+        shutil.rmtree(self.path, ignore_errors=True)
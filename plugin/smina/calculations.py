@@ -1,10 +1,59 @@
+import asyncio
 import time
 import os
-import tempfile
+import weakref
 from functools import partial
-from nanome.util import Logs, Process
+from nanome.util import Logs, Process, Vector3
+
+from plugin.utils import SdfTailer, match_sdf_record, sdf_property, sdf_title_stems, split_sdf_by_title
+from plugin.workers import worker_pool
 
 SMINA_PATH = os.path.join(os.getcwd(), 'plugin', 'smina', 'smina_binary')
+# Number of ligands passed to a single smina process. Larger batches parse the receptor and set up
+# the grid fewer times, smaller batches allow more processes to run side by side.
+SMINA_BATCH_SIZE = max(int(os.environ.get('SMINA_BATCH_SIZE', 8)), 1)
+# Number of smina processes allowed to run on this host at the same time, across all jobs of the plugin process.
+# Docking workers in $DOCKING_WORKERS add their slots on top of these.
+SMINA_PARALLEL_BATCHES = max(int(os.environ.get('SMINA_PARALLEL_BATCHES', 1)), 1)
+# Seconds allowed for scoring or minimizing ligands in their current placement.
+PREVIEW_TIMEOUT = int(os.environ.get('PREVIEW_TIMEOUT', 30))
+# Seconds between reads of the output of running multi-frame ligands, 0 disables pushing partial results.
+RESULT_TAIL_INTERVAL = float(os.environ.get('RESULT_TAIL_INTERVAL', 2))
+# Fraction of the docking timeout that may additionally be spent retrying ligands that timed out.
+TIMEOUT_RETRY_BUDGET = float(os.environ.get('TIMEOUT_RETRY_BUDGET', 0.5))
+
+# Event loop -> semaphores shared by every DockingCalculations running on it.
+_engine_slots = weakref.WeakKeyDictionary()
+_local_slots = weakref.WeakKeyDictionary()
+
+
+class BatchTimeoutError(TimeoutError):
+    """A docking batch timed out. results maps the ligands smina had already finished to their output sdf."""
+
+    def __init__(self, results):
+        super().__init__("Smina calculation timed out.")
+        self.results = results
+
+
+def parallel_batches():
+    """Number of smina processes that can run at the same time, locally and on docking workers."""
+    return SMINA_PARALLEL_BATCHES + worker_pool().capacity
+
+
+def engine_slots():
+    """Semaphore limiting the docking batches run by all jobs, to parallel_batches()."""
+    loop = asyncio.get_event_loop()
+    if loop not in _engine_slots:
+        _engine_slots[loop] = asyncio.Semaphore(parallel_batches())
+    return _engine_slots[loop]
+
+
+def local_slots():
+    """Semaphore limiting the docking batches run on this host, to SMINA_PARALLEL_BATCHES."""
+    loop = asyncio.get_event_loop()
+    if loop not in _local_slots:
+        _local_slots[loop] = asyncio.Semaphore(SMINA_PARALLEL_BATCHES)
+    return _local_slots[loop]
 
 
 class DockingCalculations():
@@ -13,54 +62,266 @@ class DockingCalculations():
         self.plugin = plugin
         self.requires_site = True
         self.loading_bar_counter = 0
+        self.exit_codes = []
 
     async def start_docking(
-        self, receptor_pdb, ligand_pdbs, site_pdb, temp_dir, exhaustiveness=None,
-            modes=None, autobox=None, deterministic=None, timeout=None, **kwargs):
+        self, receptor_pdb, ligand_pdbs, site_box, scratch, exhaustiveness=None,
+            modes=None, autobox=None, deterministic=None, timeout=None, workspace=None, on_poses=None, **kwargs):
         # Start docking process
         start_time = time.time()
         self.loading_bar_counter = 0
-        log_file = tempfile.NamedTemporaryFile(delete=False, dir=temp_dir)
-        smina_output_sdfs = []
-
-        receptor_size_kb = os.path.getsize(receptor_pdb.name) / 1000
-        for i, ligand_pdb in enumerate(ligand_pdbs):
-            ligand_size_kb = os.path.getsize(ligand_pdb.name) / 1000
-            # Read first line to get the number of frames
-            nummdl_line = ligand_pdb.readline().decode()
-            if nummdl_line.startswith("NUMMDL"):
-                frame_count = int(nummdl_line.split()[1])
-            else:
-                Logs.warning("NUMMDL line not found in PDB file. Assuming 1 frame.")
-                frame_count = 1
-            output_sdf = tempfile.NamedTemporaryFile(delete=False, prefix="output", suffix=".sdf", dir=temp_dir)
+        self.exit_codes = []
+        # ligand -> search settings, for ligands that only finished with reduced settings.
+        self.degraded_ligands = {}
+        self.scratch = scratch
+        self.on_poses = on_poses
+        log_file = scratch.file(suffix='.log')
+
+        # Identical ligand files only need to be docked once.
+        unique_ligands = list(dict.fromkeys(ligand_pdbs))
+        self.frame_counts = {ligand_pdb: self._get_frame_count(ligand_pdb) for ligand_pdb in unique_ligands}
+        self.total_frame_count = sum(self.frame_counts.values())
+        smina_params = {
+            'exhaustiveness': exhaustiveness,
+            'modes': modes,
+            'autobox': autobox,
+            'deterministic': deterministic,
+            'timeout': timeout,
+        }
+
+        def output_deps(ligand_pdb, params=smina_params):
+            return [ligand_pdb, receptor_pdb, site_box.key(), params['exhaustiveness'], modes, params['autobox']]
+
+        results = {}
+        pending = unique_ligands
+        if deterministic and workspace:
+            # Seeded runs are reproducible, so results can be reused while inputs are unchanged.
+            pending = []
+            for ligand_pdb in unique_ligands:
+                cached_sdf = workspace.lookup('smina_output', output_deps(ligand_pdb), '.sdf')
+                if cached_sdf:
+                    results[ligand_pdb] = cached_sdf
+                else:
+                    pending.append(ligand_pdb)
+
+        receptor_size_kb = os.path.getsize(receptor_pdb) / 1000
+        ligand_size_kb = sum(os.path.getsize(ligand_pdb) for ligand_pdb in pending) / 1000
+        log_extra = {'receptor_size_kb': receptor_size_kb, 'ligand_size_kb': ligand_size_kb}
+        Logs.message("Smina Calculation started.", extra=log_extra)
+
+        batches = [pending[i:i + SMINA_BATCH_SIZE] for i in range(0, len(pending), SMINA_BATCH_SIZE)]
+        semaphore = engine_slots()
+        batch_slots = parallel_batches()
+
+        timed_out = []
+        pending_frame_count = sum(self.frame_counts[ligand_pdb] for ligand_pdb in pending) or 1
+
+        def batch_timeout(batch, max_timeout=None):
+            # Every batch gets the share of the timeout of its frames, scaled by how many batches run at once.
+            if not timeout:
+                return None
+            share = sum(self.frame_counts[ligand_pdb] for ligand_pdb in batch) / pending_frame_count
+            batch_timeout = timeout * min(share * batch_slots, 1)
+            return min(batch_timeout, max_timeout) if max_timeout else batch_timeout
+
+        async def dock_batch(batch, params, batch_timeout):
+            async with semaphore:
+                try:
+                    batch_results, exit_code = await self._run_batch(
+                        batch, receptor_pdb, site_box, log_file, {**params, 'timeout': batch_timeout})
+                except BatchTimeoutError as e:
+                    # Only ligands smina hadn't finished before it was stopped need another try.
+                    unfinished = [ligand_pdb for ligand_pdb in batch if ligand_pdb not in e.results]
+                    Logs.warning(f"Docking {len(unfinished)} ligand(s) timed out.")
+                    timed_out.extend(unfinished)
+                    batch_results, exit_code = e.results, None
+            for ligand_pdb, output_sdf in batch_results.items():
+                if deterministic and workspace and exit_code == 0:
+                    output_sdf = workspace.artifact(
+                        'smina_output', output_deps(ligand_pdb, params), partial(os.replace, output_sdf), '.sdf')
+                results[ligand_pdb] = output_sdf
             if len(ligand_pdbs) > 1:
-                self.plugin.update_run_btn_text(f"Running... ({i + 1}/{len(ligand_pdbs)})")
-
-            log_extra = {'receptor_size_kb': receptor_size_kb, 'ligand_size_kb': ligand_size_kb}
-            Logs.message("Smina Calculation started.", extra=log_extra)
-            await self.run_smina(
-                ligand_pdb, receptor_pdb, site_pdb, output_sdf, log_file,
-                exhaustiveness, modes, autobox, frame_count, deterministic, timeout=timeout)
-            smina_output_sdfs.append(output_sdf)
+                self.plugin.update_run_btn_text(f"Running... ({len(results)}/{len(unique_ligands)})")
+
+        async def dock_batches(batches, params, max_timeout=None):
+            tasks = [
+                asyncio.ensure_future(dock_batch(batch, params, batch_timeout(batch, max_timeout)))
+                for batch in batches]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+        await dock_batches(batches, smina_params)
+
+        # Retry ligands that timed out one at a time with cheaper searches, until the retry budget is spent.
+        deadline = start_time + timeout * (1 + TIMEOUT_RETRY_BUDGET) if timeout else 0
+        for retry_exhaustiveness, retry_autobox in self.retry_settings(exhaustiveness, autobox):
+            if not timed_out or time.time() >= deadline:
+                break
+            retry_ligands = list(timed_out)
+            timed_out.clear()
+            Logs.warning(
+                f"Retrying {len(retry_ligands)} ligand(s) with exhaustiveness {retry_exhaustiveness} "
+                f"and autobox {retry_autobox}.")
+            retry_params = {**smina_params, 'exhaustiveness': retry_exhaustiveness, 'autobox': retry_autobox}
+            await dock_batches([[ligand_pdb] for ligand_pdb in retry_ligands], retry_params, deadline - time.time())
+            for ligand_pdb in retry_ligands:
+                if ligand_pdb in results:
+                    self.degraded_ligands[ligand_pdb] = {
+                        'exhaustiveness': retry_exhaustiveness, 'autobox': retry_autobox}
+
         end_time = time.time()
         Logs.message("Smina Calculation finished in {} seconds.".format(round(end_time - start_time, 2)))
         if len(ligand_pdbs) > 1:
             self.plugin.update_run_btn_text("Running...")
-        return smina_output_sdfs
+        if not results:
+            raise TimeoutError("Smina calculation timed out.")
+        # Ligands that timed out even with reduced settings have no result.
+        return [results.get(ligand_pdb) for ligand_pdb in ligand_pdbs]
+
+    @staticmethod
+    def pose_score(record):
+        """Affinity of a pose in smina output, lower is better."""
+        affinity = sdf_property(record, 'minimizedAffinity')
+        return float(affinity) if affinity else None
+
+    @staticmethod
+    def retry_settings(exhaustiveness, autobox):
+        """Cheaper (exhaustiveness, autobox) settings to retry timed out ligands with, least reduced first."""
+        settings = []
+        if exhaustiveness and exhaustiveness > 1:
+            settings.append((max(exhaustiveness // 4, 1), autobox))
+        if autobox and autobox > 1:
+            settings.append((1, max(autobox // 2, 1)))
+        return settings
 
-    async def run_smina(self, ligand_pdb, receptor_pdb, site_pdb, output_sdf, log_file,
+    async def _run_batch(self, batch, receptor_pdb, site_box, log_file, smina_params):
+        """Dock a batch of ligands with one smina process, and split the output per ligand.
+
+        Returns dict mapping each ligand to its output sdf, and the smina exit code.
+        Raises BatchTimeoutError with the output of the ligands that finished if smina timed out.
+        """
+        output_sdf = self.scratch.file(prefix="output", suffix=".sdf")
+        # Smina writes the poses of each frame once it is done, so multi-frame ligands can be shown early.
+        tailed = [ligand_pdb for ligand_pdb in batch if self.frame_counts.get(ligand_pdb, 1) > 1]
+        tail_task = None
+        finished = asyncio.Event()
+        if self.on_poses and tailed and RESULT_TAIL_INTERVAL > 0:
+            tail_task = asyncio.ensure_future(self._tail_output(output_sdf, batch, tailed, finished))
+        try:
+            exit_code = await self.run_smina(
+                batch, receptor_pdb, site_box, output_sdf, log_file, ligand_count=self.total_frame_count,
+                **smina_params)
+        except TimeoutError:
+            raise BatchTimeoutError(self._finished_output(output_sdf, batch))
+        finally:
+            if tail_task:
+                finished.set()
+                await asyncio.gather(tail_task, return_exceptions=True)
+            self.scratch.usage()
+        if len(batch) == 1:
+            return {batch[0]: output_sdf}, exit_code
+
+        # Smina titles each pose with the name of the file the ligand was read from.
+        batch_results = split_sdf_by_title(output_sdf, batch, self.scratch.path)
+        if batch_results is not None:
+            return batch_results, exit_code
+
+        Logs.warning("Unable to match smina batch output to ligands, docking ligands individually.")
+        batch_results = {}
+        for ligand_pdb in batch:
+            try:
+                results, exit_code = await self._run_batch(
+                    [ligand_pdb], receptor_pdb, site_box, log_file, smina_params)
+            except BatchTimeoutError:
+                raise BatchTimeoutError(batch_results)
+            batch_results.update(results)
+        return batch_results, exit_code
+
+    def _finished_output(self, output_sdf, batch):
+        """Split output of ligands a stopped smina process had finished into one sdf per ligand.
+
+        Smina docks the ligands of a batch in order, so every ligand before the last one with poses is finished.
+        """
+        if len(batch) == 1:
+            return {}
+        stems = sdf_title_stems(batch)
+        records = {ligand_pdb: [] for ligand_pdb in batch}
+        # The tailer skips the record smina was writing when it was stopped.
+        for record in SdfTailer(output_sdf).read_records():
+            source = match_sdf_record(record, stems)
+            if source is None:
+                return {}
+            records[source].append(record)
+        started = [i for i, ligand_pdb in enumerate(batch) if records[ligand_pdb]]
+        if not started:
+            return {}
+        results = {}
+        for ligand_pdb in batch[:started[-1]]:
+            results[ligand_pdb] = self.scratch.file(prefix=f'{stems[ligand_pdb]}_', suffix='.sdf')
+            with open(results[ligand_pdb], 'w') as f:
+                f.writelines(records[ligand_pdb])
+        return results
+
+    async def _tail_output(self, output_sdf, batch, tailed, finished):
+        """Pass poses of tailed ligands to on_poses while smina is still writing output_sdf."""
+        tailer = SdfTailer(output_sdf)
+        stems = sdf_title_stems(batch)
+        records = {ligand_pdb: [] for ligand_pdb in tailed}
+        while not finished.is_set():
+            try:
+                await asyncio.wait_for(finished.wait(), RESULT_TAIL_INTERVAL)
+                return
+            except asyncio.TimeoutError:
+                pass
+            updated = []
+            for record in tailer.read_records():
+                source = batch[0] if len(batch) == 1 else match_sdf_record(record, stems)
+                if source in records:
+                    records[source].append(record)
+                    updated.append(source)
+            for ligand_pdb in dict.fromkeys(updated):
+                partial_sdf = self.scratch.file(prefix="partial", suffix=".sdf")
+                with open(partial_sdf, 'w') as f:
+                    f.writelines(records[ligand_pdb])
+                try:
+                    await self.on_poses(ligand_pdb, partial_sdf)
+                except Exception:
+                    Logs.error('Unable to show partial docking results')
+
+    @staticmethod
+    def _get_frame_count(ligand_pdb):
+        # Read first line to get the number of frames
+        with open(ligand_pdb) as f:
+            nummdl_line = f.readline()
+        if nummdl_line.startswith("NUMMDL"):
+            return int(nummdl_line.split()[1])
+        Logs.warning("NUMMDL line not found in PDB file. Assuming 1 frame.")
+        return 1
+
+    async def run_smina(self, ligand_pdbs, receptor_pdb, site_box, output_sdf, log_file,
                         exhaustiveness=None, modes=None, autobox=None, ligand_count=1,
                         deterministic=False, timeout=None, **kwargs):
-        smina_args = [
-            '-r', receptor_pdb.name,
-            '-l', ligand_pdb.name,
-            '--autobox_ligand', site_pdb.name,
-            '--out', output_sdf.name,
-            '--log', log_file.name,
+        """Run smina on one or more ligand files, writing all poses to output_sdf."""
+        if isinstance(ligand_pdbs, str):
+            ligand_pdbs = [ligand_pdbs]
+        smina_args = ['-r', receptor_pdb]
+        for ligand_pdb in ligand_pdbs:
+            smina_args.extend(['-l', ligand_pdb])
+        # Same box --autobox_ligand would read from the site file, padded by autobox on every side.
+        center = site_box.center
+        size = site_box.size + Vector3(1, 1, 1) * (2 * float(autobox))
+        for axis, center_coord, size_coord in zip('xyz', center.unpack(), size.unpack()):
+            smina_args.extend([
+                f'--center_{axis}', str(round(center_coord, 3)),
+                f'--size_{axis}', str(round(size_coord, 3))])
+        smina_args += [
+            '--out', output_sdf,
+            '--log', log_file,
             '--exhaustiveness', str(exhaustiveness),
             '--num_modes', str(modes),
-            '--autobox_add', str(autobox),
             '--atom_term_data'
         ]
 
@@ -69,21 +330,71 @@ class DockingCalculations():
             seed = '0'
             smina_args.extend(['--seed', seed])
 
-        self.loading_bar_counter = 0
+        on_output = partial(self.handle_loading_bar, ligand_count)
+        files = ([receptor_pdb, *ligand_pdbs], [output_sdf, log_file])
+        return await self._run_process(smina_args, timeout, on_output, files=files)
+
+    async def score_poses(self, receptor_pdb, ligand_pdbs, scratch, minimize=False, timeout=PREVIEW_TIMEOUT):
+        """Score ligands in their current placement, without searching for new poses.
+
+        With minimize, ligands are locally optimized before scoring. Returns an output sdf per ligand.
+        Raises RuntimeError if smina fails, rather than returning output without poses.
+        """
+        mode = '--minimize' if minimize else '--score_only'
+
+        async def score(ligand_pdb):
+            output_sdf = scratch.file(prefix="preview", suffix=".sdf")
+            smina_args = ['-r', receptor_pdb, '-l', ligand_pdb, mode, '--out', output_sdf, '--atom_term_data']
+            exit_code = await self._run_process(smina_args, timeout)
+            if exit_code != 0:
+                raise RuntimeError(f'Smina failed to score {os.path.basename(ligand_pdb)}, exit code {exit_code}')
+            return output_sdf
+
+        tasks = [asyncio.ensure_future(score(ligand_pdb)) for ligand_pdb in ligand_pdbs]
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _run_process(self, smina_args, timeout=None, on_output=None, files=None):
+        """Run smina, stopping it if cancelled. Raises TimeoutError if it runs longer than timeout.
+
+        files are the (input paths, output paths) of a docking batch, which is then run on a docking worker
+        if one is free, or locally once a local slot is free.
+        """
+        if files:
+            exit_code = await worker_pool().run('smina', smina_args, *files, timeout=timeout, on_output=on_output)
+            if exit_code is None:
+                async with local_slots():
+                    exit_code = await self._run_local(smina_args, timeout, on_output)
+        else:
+            exit_code = await self._run_local(smina_args, timeout, on_output)
+        Logs.message('Smina exit code: {}'.format(exit_code))
+        self.exit_codes.append(exit_code)
+        if exit_code == Process.TIMEOUT_CODE:
+            raise TimeoutError("Smina calculation timed out.")
+        return exit_code
+
+    async def _run_local(self, smina_args, timeout=None, on_output=None):
         p = Process(SMINA_PATH, smina_args, output_text=True, buffer_lines=False, label="Smina")
         if timeout:
             p.timeout = timeout
         p.on_error = Logs.warning
-        p.on_output = partial(self.handle_loading_bar, ligand_count)
-        exit_code = await p.start()
-        Logs.message('Smina exit code: {}'.format(exit_code))
-        if exit_code == Process.TIMEOUT_CODE:
-            raise TimeoutError("Smina calculation timed out.")
+        if on_output:
+            p.on_output = on_output
+        try:
+            exit_code = await p.start()
+        except asyncio.CancelledError:
+            # Cancelling the wait doesn't end the process itself.
+            p.stop()
+            raise
+        return exit_code
 
     def handle_loading_bar(self, frame_count, msg):
         """Render loading bar from stdout on the menu.
 
-        :param frame_count: int: number of frames in the ligand, used to calculate number of frames to render.
+        :param frame_count: int: number of frames being docked, used to calculate number of frames to render.
         :param msg: Unbuffered character from stdout.
 
         stdout has a loading bar of asterisks. Every asterisk represents about 2% completed.
@@ -95,4 +406,4 @@ class DockingCalculations():
         for char in msg:
             if char == '*':
                 self.loading_bar_counter += 1
-        self.plugin.update_loading_bar(self.loading_bar_counter, total_stars)
+        self.plugin.update_loading_bar(min(self.loading_bar_counter, total_stars), total_stars)
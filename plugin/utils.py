@@ -1,8 +1,25 @@
+import hashlib
+import os
+import tempfile
+
 from nanome.util import Vector3
 
+SDF_RECORD_DELIMITER = '$$$$'
+# Coordinates are rounded to this many decimals (Angstrom) when fingerprinting molecules.
+FINGERPRINT_DECIMALS = 2
 
-def get_complex_center(complex):
-    """Calculate the center of a complex."""
+
+def path_size(path):
+    """Size in bytes of a file, or of all files in a directory."""
+    if os.path.isdir(path):
+        return sum(
+            os.path.getsize(os.path.join(dirpath, filename))
+            for dirpath, _, filenames in os.walk(path) for filename in filenames)
+    return os.path.getsize(path)
+
+
+def get_complex_bounds(complex):
+    """Calculate the minimum and maximum corners of the box around all atoms of a complex."""
     inf = float('inf')
     min_pos = Vector3(inf, inf, inf)
     max_pos = Vector3(-inf, -inf, -inf)
@@ -15,4 +32,230 @@ def get_complex_center(complex):
         max_pos.y = max(max_pos.y, atom.position.y)
         max_pos.z = max(max_pos.z, atom.position.z)
 
+    return min_pos, max_pos
+
+
+def get_complex_center(complex):
+    """Calculate the center of a complex."""
+    min_pos, max_pos = get_complex_bounds(complex)
     return (min_pos + max_pos) * 0.5
+
+
+class SiteBox:
+    """Box around the atoms of a docking site, in the coordinates the site is written to PDB with.
+
+    Computed from the site complex in memory, so engines don't have to read a site file to find it.
+    """
+
+    def __init__(self, min_pos, max_pos):
+        self.min_pos = min_pos
+        self.max_pos = max_pos
+
+    @classmethod
+    def from_complex(cls, complex):
+        return cls(*get_complex_bounds(complex))
+
+    @property
+    def center(self):
+        return (self.min_pos + self.max_pos) * 0.5
+
+    @property
+    def size(self):
+        return self.max_pos - self.min_pos
+
+    def key(self, decimals=3):
+        """Rounded corners, to use as a cache dependency."""
+        return tuple(round(coord, decimals) for coord in (*self.min_pos.unpack(), *self.max_pos.unpack()))
+
+
+def molecule_fingerprint(molecule, decimals=FINGERPRINT_DECIMALS):
+    """Hash of a molecule's elements, bond graph, and rounded atom coordinates.
+
+    Independent of atom order and naming, so equal fingerprints mean the same structure in the same place.
+    """
+    atom_keys = {}
+    for atom in molecule.atoms:
+        # Adding 0.0 turns -0.0 into 0.0
+        coords = tuple(round(coord, decimals) + 0.0 for coord in atom.position.unpack())
+        atom_keys[id(atom)] = (atom.symbol, coords)
+    ranks = {atom_id: rank for rank, atom_id in enumerate(sorted(atom_keys, key=atom_keys.get))}
+
+    bonds = []
+    for bond in molecule.bonds:
+        atom_ranks = sorted((ranks[id(bond.atom1)], ranks[id(bond.atom2)]))
+        bonds.append((*atom_ranks, getattr(bond.kind, 'value', bond.kind)))
+
+    sha = hashlib.sha1()
+    sha.update(repr(sorted(atom_keys.values())).encode())
+    sha.update(repr(sorted(bonds)).encode())
+    return sha.hexdigest()
+
+
+def get_pdbqt_atom_types(pdbqt_file):
+    """Get the set of AutoDock atom types used in a pdbqt file."""
+    atom_types = set()
+    with open(pdbqt_file) as f:
+        for line in f:
+            if line.startswith(('ATOM', 'HETATM')):
+                atom_type = line[77:79].strip()
+                if atom_type:
+                    atom_types.add(atom_type)
+    return atom_types
+
+
+def get_pdbqt_model_count(pdbqt_file):
+    """Number of molecules in a pdbqt file. Files without MODEL records hold at most one."""
+    model_count = 0
+    has_atoms = False
+    with open(pdbqt_file) as f:
+        for line in f:
+            if line.startswith('MODEL'):
+                model_count += 1
+            elif line.startswith(('ATOM', 'HETATM')):
+                has_atoms = True
+    return model_count or int(has_atoms)
+
+
+def iter_sdf_records(sdf_file):
+    """Yield the text of each record in an sdf file, including its $$$$ delimiter."""
+    with open(sdf_file) as f:
+        yield from iter_sdf_lines(f)
+
+
+def iter_sdf_lines(sdf_lines):
+    """Yield the text of each record in lines of sdf text, including its $$$$ delimiter."""
+    lines = []
+    for line in sdf_lines:
+        lines.append(line)
+        if line.strip() == SDF_RECORD_DELIMITER:
+            yield ''.join(lines)
+            lines = []
+    if any(line.strip() for line in lines):
+        yield ''.join(lines)
+
+
+class SdfTailer:
+    """Read records from an sdf file that is still being written. Only complete records are returned."""
+
+    def __init__(self, sdf_file):
+        self.sdf_file = sdf_file
+        self._offset = 0
+        self._lines = []
+
+    def read_records(self):
+        """Return records completed since the last call."""
+        if not os.path.exists(self.sdf_file):
+            return []
+        records = []
+        with open(self.sdf_file) as f:
+            f.seek(self._offset)
+            for line in iter(f.readline, ''):
+                # A line without newline is still being written, read it again next time.
+                if not line.endswith('\n'):
+                    break
+                self._offset = f.tell()
+                self._lines.append(line)
+                if line.strip() == SDF_RECORD_DELIMITER:
+                    records.append(''.join(self._lines))
+                    self._lines = []
+        return records
+
+
+def sdf_title_stems(source_files):
+    """Map source files to the name smina puts in the title of their records."""
+    return {source: os.path.splitext(os.path.basename(source))[0] for source in source_files}
+
+
+def match_sdf_record(record, stems):
+    """Source file whose name appears in the title of record, or None."""
+    title = record.split('\n', 1)[0]
+    return next((source for source, stem in stems.items() if stem in title), None)
+
+
+def split_sdf_by_title(sdf_file, source_files, output_dir):
+    """Split a multi-ligand sdf into one file per source file.
+
+    Records are matched to the source file whose name appears in the record title.
+    Returns dict of source file -> sdf path, or None if any record can not be matched.
+    """
+    stems = sdf_title_stems(source_files)
+    records = {source: [] for source in source_files}
+    for record in iter_sdf_records(sdf_file):
+        source = match_sdf_record(record, stems)
+        if source is None:
+            return None
+        records[source].append(record)
+
+    split_files = {}
+    for source, source_records in records.items():
+        fd, path = tempfile.mkstemp(dir=output_dir, prefix=f'{stems[source]}_', suffix='.sdf')
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(source_records)
+        split_files[source] = path
+    return split_files
+
+
+def sdf_property(record, name):
+    """Value of the data item called name in an sdf record, or None. Multi-line values are joined by newlines."""
+    lines = iter(record.split('\n'))
+    for line in lines:
+        if line.startswith('>') and f'<{name}>' in line:
+            value = []
+            for value_line in lines:
+                if not value_line.strip():
+                    break
+                value.append(value_line.strip())
+            return '\n'.join(value)
+    return None
+
+
+def tag_sdf_record(record, name, value):
+    """Add a data item to an sdf record, keeping its $$$$ delimiter last."""
+    body = record.rstrip()
+    if body.endswith(SDF_RECORD_DELIMITER):
+        body = body[:-len(SDF_RECORD_DELIMITER)].rstrip()
+    # Data items are separated by a blank line, the first one directly follows the molecule block.
+    separator = '\n' if body.endswith('M  END') else '\n\n'
+    return f'{body}{separator}> <{name}>\n{value}\n\n{SDF_RECORD_DELIMITER}\n'
+
+
+def split_sdf_frames(records, pose_score, modes=None):
+    """Group the records of docking output into the poses of each docked frame.
+
+    Engines write the poses of each frame best scoring first, so a frame ends after modes poses,
+    or where the score improves again.
+    """
+    frames = []
+    last_score = None
+    for record in records:
+        score = pose_score(record)
+        new_frame = (
+            not frames or (modes and len(frames[-1]) >= modes)
+            or (score is not None and last_score is not None and score < last_score))
+        if new_frame:
+            frames.append([])
+        frames[-1].append(record)
+        last_score = score
+    return frames
+
+
+def merge_ranked_sdfs(sources, output_file, pose_score, limit=None):
+    """Write the records of several sdf files to output_file, best scoring first within each frame.
+
+    sources is a list of (tag, sdf path) holding poses of the same frames. Every record is tagged with the tag
+    of its source, and records pose_score can't score are placed last. Keeps at most limit records per frame.
+    """
+    frames = []
+    for tag, sdf_file in sources:
+        for i, records in enumerate(split_sdf_frames(iter_sdf_records(sdf_file), pose_score, limit)):
+            if i == len(frames):
+                frames.append([])
+            for record in records:
+                score = pose_score(record)
+                frames[i].append(((score is None, score or 0.0), tag_sdf_record(record, 'receptor', tag)))
+    with open(output_file, 'w') as f:
+        for tagged in frames:
+            # Stable, so poses with equal scores keep their source order.
+            tagged.sort(key=lambda scored: scored[0])
+            f.writelines(record for _, record in tagged[:limit])
+    return output_file
@@ -0,0 +1,391 @@
+"""Docking workers, to run engine processes on other hosts than the plugin.
+
+A worker is started with `run.py --worker`, and listens for runs over TCP. The plugin ships the input
+files of a run along with its arguments, the worker runs the engine in a scratch directory, streams
+its output back while it runs, and returns the output files once it exits.
+
+Workers are listed in $DOCKING_WORKERS as comma separated host:port addresses. Runs go to the least busy
+worker with a free slot, and are run locally when no worker is free or reachable.
+
+Messages are JSON objects, each prefixed with its length as a 4 byte big-endian integer.
+Requests carry the shared secret in $DOCKING_WORKER_TOKEN, and workers refuse to start without one.
+Workers rebuild the engine arguments from the flags in ENGINE_FLAGS, and files can only be given
+by the names of files shipped with the run, so a plugin can't make them touch other files.
+"""
+import asyncio
+import base64
+import hmac
+import json
+import os
+import struct
+import time
+
+from nanome.util import Logs
+
+from plugin.scratch import ScratchSpace
+
+DOCKING_WORKERS = [address for address in os.environ.get('DOCKING_WORKERS', '').split(',') if address]
+DOCKING_WORKER_PORT = int(os.environ.get('DOCKING_WORKER_PORT', 9200))
+# Address workers listen on. Set to 0.0.0.0 to accept plugins on other hosts.
+DOCKING_WORKER_HOST = os.environ.get('DOCKING_WORKER_HOST', '127.0.0.1')
+# Shared secret sent by plugins with every run, and required by workers.
+DOCKING_WORKER_TOKEN = os.environ.get('DOCKING_WORKER_TOKEN', '')
+# Engine processes a worker runs at the same time.
+DOCKING_WORKER_SLOTS = max(int(os.environ.get('DOCKING_WORKER_SLOTS', 1)), 1)
+# Seconds before a worker that could not be reached is tried again.
+WORKER_RETRY_INTERVAL = float(os.environ.get('WORKER_RETRY_INTERVAL', 30))
+# Seconds allowed for connecting to a worker.
+WORKER_CONNECT_TIMEOUT = float(os.environ.get('WORKER_CONNECT_TIMEOUT', 5))
+# Seconds a worker may take beyond the timeout of a run before the plugin gives up on it and runs locally,
+# and the limit for runs without a timeout.
+WORKER_RUN_GRACE = float(os.environ.get('WORKER_RUN_GRACE', 30))
+WORKER_MAX_RUN_TIME = float(os.environ.get('WORKER_MAX_RUN_TIME', 3600))
+# Largest message read from the other side, runs ship their input and output files in one message.
+WORKER_MAX_MESSAGE_MB = int(os.environ.get('WORKER_MAX_MESSAGE_MB', 256))
+
+# Flags plugins may pass to each engine, and the type of their value.
+# INPUT and OUTPUT values name files shipped with the run, None marks flags without a value.
+INPUT = 'input'
+OUTPUT = 'output'
+ENGINE_FLAGS = {
+    'smina': {
+        '-r': INPUT,
+        '-l': INPUT,
+        '--out': OUTPUT,
+        '--log': OUTPUT,
+        **{f'--{name}_{axis}': float for name in ['center', 'size'] for axis in 'xyz'},
+        '--exhaustiveness': int,
+        '--num_modes': int,
+        '--seed': int,
+        '--atom_term_data': None,
+    },
+}
+
+# Exit code of runs stopped for taking longer than their timeout, same as nanome's Process.
+TIMEOUT_CODE = -9
+
+_header = struct.Struct('>I')
+
+
+async def send_message(writer, message):
+    data = json.dumps(message).encode()
+    writer.write(_header.pack(len(data)) + data)
+    await writer.drain()
+
+
+async def read_message(reader, max_bytes=None):
+    """Next message from reader, or None once the other side closed the connection.
+
+    Raises ValueError if the message is longer than max_bytes, without reading it.
+    """
+    if max_bytes is None:
+        max_bytes = WORKER_MAX_MESSAGE_MB * 1024 * 1024
+    try:
+        header = await reader.readexactly(_header.size)
+        size = _header.unpack(header)[0]
+        if size > max_bytes:
+            raise ValueError(f'Message of {size} bytes exceeds limit of {max_bytes} bytes')
+        data = await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        return None
+    return json.loads(data)
+
+
+def encode_file(path):
+    with open(path, 'rb') as f:
+        return base64.b64encode(f.read()).decode()
+
+
+def decode_file(path, content):
+    with open(path, 'wb') as f:
+        f.write(base64.b64decode(content))
+
+
+def is_run_file_name(name):
+    """Whether name is a relative path that stays inside the run directory."""
+    return bool(name) and not os.path.isabs(name) and '..' not in name.replace('\\', '/').split('/')
+
+
+def engine_args(engine, args, inputs, outputs):
+    """Rebuild the arguments of a run from the flags allowed for engine.
+
+    Raises ValueError for unknown flags, bad values, and files that were not shipped with the run.
+    """
+    flags = ENGINE_FLAGS.get(engine, {})
+    args = list(args)
+    checked = []
+    while args:
+        flag = args.pop(0)
+        if not isinstance(flag, str) or flag not in flags:
+            raise ValueError(f'Flag {flag} is not allowed')
+        kind = flags[flag]
+        checked.append(flag)
+        if kind is None:
+            continue
+        if not args:
+            raise ValueError(f'Flag {flag} is missing its value')
+        value = args.pop(0)
+        if kind == INPUT or kind == OUTPUT:
+            if not isinstance(value, str) or value not in (inputs if kind == INPUT else outputs):
+                raise ValueError(f'{value} of flag {flag} is not an {kind} file of the run')
+            checked.append(value)
+        else:
+            try:
+                checked.append(str(kind(value)))
+            except (TypeError, ValueError):
+                raise ValueError(f'Bad value {value} for flag {flag}')
+    return checked
+
+
+class WorkerAddress:
+    """Worker the plugin can send runs to."""
+
+    def __init__(self, address, slots=DOCKING_WORKER_SLOTS):
+        host, _, port = address.rpartition(':')
+        self.host = host or 'localhost'
+        self.port = int(port) if port else DOCKING_WORKER_PORT
+        self.slots = slots
+        self.in_use = 0
+        self.down_until = 0
+
+    def __repr__(self):
+        return f'{self.host}:{self.port}'
+
+    @property
+    def available(self):
+        return self.in_use < self.slots and time.time() >= self.down_until
+
+
+class WorkerPool:
+    """Workers registered with the plugin process."""
+
+    def __init__(self, addresses=(), slots=DOCKING_WORKER_SLOTS, token=DOCKING_WORKER_TOKEN):
+        self.slots = slots
+        self.token = token
+        self.workers = []
+        for address in addresses:
+            self.register(address)
+
+    def __len__(self):
+        return len(self.workers)
+
+    @property
+    def capacity(self):
+        """Runs the registered workers can take at the same time."""
+        return sum(worker.slots for worker in self.workers)
+
+    def register(self, address):
+        worker = WorkerAddress(address, self.slots)
+        self.workers.append(worker)
+        return worker
+
+    def acquire(self):
+        """Least busy worker with a free slot, or None."""
+        available = [worker for worker in self.workers if worker.available]
+        if not available:
+            return None
+        worker = min(available, key=lambda worker: worker.in_use / worker.slots)
+        worker.in_use += 1
+        return worker
+
+    async def run(self, engine, args, input_paths, output_paths, timeout=None, on_output=None):
+        """Run engine with args on a free worker.
+
+        Paths in args that are listed in input_paths are shipped to the worker, and files at output_paths
+        are written back once the run finishes. Returns the exit code, or None if the run should be done locally,
+        because no worker is free or the worker failed.
+        """
+        worker = self.acquire()
+        if worker is None:
+            return None
+        try:
+            return await self._run(worker, engine, args, input_paths, output_paths, timeout, on_output)
+        except (OSError, asyncio.TimeoutError, ValueError) as e:
+            Logs.warning(f'Docking worker {worker} failed, running locally: {e}')
+            worker.down_until = time.time() + WORKER_RETRY_INTERVAL
+            return None
+        finally:
+            worker.in_use -= 1
+
+    async def _run(self, worker, engine, args, input_paths, output_paths, timeout, on_output):
+        # Files keep their names, smina titles poses with the name of the ligand file.
+        names = {}
+        for i, path in enumerate([*input_paths, *output_paths]):
+            names[path] = f'{i}/{os.path.basename(path)}'
+        request = {
+            'type': 'run',
+            'token': self.token,
+            'engine': engine,
+            'args': [names.get(arg, arg) for arg in args],
+            'inputs': {names[path]: encode_file(path) for path in input_paths},
+            'outputs': [names[path] for path in output_paths],
+            'timeout': timeout,
+        }
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(worker.host, worker.port), WORKER_CONNECT_TIMEOUT)
+        try:
+            await send_message(writer, request)
+            Logs.debug(f'Running {engine} on docking worker {worker}')
+            # A worker that stalls without closing the connection would otherwise hold the run forever.
+            deadline = timeout + WORKER_RUN_GRACE if timeout else WORKER_MAX_RUN_TIME
+            message = await asyncio.wait_for(self._read_run(reader, on_output), deadline)
+        finally:
+            # Closing the connection stops the run on the worker if this was cancelled.
+            writer.close()
+        outputs = message['outputs']
+        for path in output_paths:
+            if names[path] in outputs:
+                decode_file(path, outputs[names[path]])
+        return message['exit_code']
+
+    @staticmethod
+    async def _read_run(reader, on_output):
+        """Handle messages of a run until the worker is done, and return the done message."""
+        while True:
+            message = await read_message(reader)
+            if message is None:
+                raise ConnectionError('Connection closed during run')
+            if message['type'] == 'output' and on_output:
+                on_output(message['text'])
+            elif message['type'] == 'stderr':
+                Logs.warning(message['text'])
+            elif message['type'] == 'error':
+                raise ValueError(message['message'])
+            elif message['type'] == 'done':
+                return message
+
+
+_pool = None
+
+
+def worker_pool():
+    """Pool of the workers in $DOCKING_WORKERS, shared by all jobs of the plugin process."""
+    global _pool
+    if _pool is None:
+        _pool = WorkerPool(DOCKING_WORKERS)
+    return _pool
+
+
+class Worker:
+    """Runs engine processes for plugins connecting to it.
+
+    engines maps the engine names plugins may request to their executables,
+    and only runs carrying token are accepted.
+    """
+
+    def __init__(self, engines, slots=DOCKING_WORKER_SLOTS, scratch_space=None, token=DOCKING_WORKER_TOKEN):
+        self.engines = engines
+        self.token = token
+        self.slots = asyncio.Semaphore(slots)
+        self.scratch_space = scratch_space or ScratchSpace()
+        self.server = None
+
+    async def start(self, host=DOCKING_WORKER_HOST, port=DOCKING_WORKER_PORT):
+        if not self.token:
+            raise ValueError('Docking workers need a shared token, set $DOCKING_WORKER_TOKEN')
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def serve(self, host=DOCKING_WORKER_HOST, port=DOCKING_WORKER_PORT):
+        await self.start(host, port)
+        Logs.message(f'Docking worker listening on {host}:{self.port}')
+        async with self.server:
+            await self.server.serve_forever()
+
+    def close(self):
+        if self.server:
+            self.server.close()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            try:
+                request = await read_message(reader)
+            except ValueError as e:
+                await send_message(writer, {'type': 'error', 'message': str(e)})
+                return
+            if request is None:
+                return
+            error = self.check_request(request)
+            if error:
+                Logs.warning(f'Docking worker refused run: {error}')
+                await send_message(writer, {'type': 'error', 'message': error})
+                return
+            async with self.slots:
+                await self.run(request, reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            Logs.warning('Docking worker lost connection to plugin')
+        except Exception:
+            Logs.error('Docking worker run failed')
+        finally:
+            writer.close()
+
+    def check_request(self, request):
+        """Reason to refuse request, or None. Replaces the arguments of accepted requests with the checked ones."""
+        if not isinstance(request, dict) or request.get('type') != 'run':
+            return 'Unknown request type'
+        token = request.get('token')
+        if not isinstance(token, str) or not hmac.compare_digest(token.encode(), self.token.encode()):
+            return 'Invalid token'
+        if request.get('engine') not in self.engines:
+            return f"Unknown engine {request.get('engine')}"
+        inputs = request.get('inputs')
+        outputs = request.get('outputs')
+        args = request.get('args')
+        timeout = request.get('timeout')
+        if not isinstance(inputs, dict) or not isinstance(outputs, list) or not isinstance(args, list):
+            return 'Malformed request'
+        if timeout is not None and not isinstance(timeout, (int, float)):
+            return 'Malformed request'
+        for name in [*inputs, *outputs]:
+            if not isinstance(name, str) or not is_run_file_name(name):
+                return f'File {name} is outside of the run directory'
+        try:
+            request['args'] = engine_args(request['engine'], args, inputs, outputs)
+        except ValueError as e:
+            return str(e)
+        return None
+
+    async def run(self, request, reader, writer):
+        with self.scratch_space.job() as scratch:
+            for name, content in request['inputs'].items():
+                path = os.path.join(scratch.path, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                decode_file(path, content)
+            for name in request['outputs']:
+                os.makedirs(os.path.dirname(os.path.join(scratch.path, name)), exist_ok=True)
+
+            process = await asyncio.create_subprocess_exec(
+                self.engines[request['engine']], *request['args'], cwd=scratch.path,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+            async def forward(stream, message_type):
+                while True:
+                    chunk = await stream.read(1024)
+                    if not chunk:
+                        return
+                    await send_message(writer, {'type': message_type, 'text': chunk.decode(errors='replace')})
+
+            run = asyncio.ensure_future(asyncio.gather(
+                process.wait(), forward(process.stdout, 'output'), forward(process.stderr, 'stderr')))
+            # The plugin closes the connection to cancel the run.
+            disconnect = asyncio.ensure_future(reader.read())
+            done, _ = await asyncio.wait([run, disconnect], timeout=request.get('timeout'),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if process.returncode is None:
+                process.kill()
+            await asyncio.gather(run, return_exceptions=True)
+            await process.wait()
+            disconnect.cancel()
+            if disconnect in done:
+                return
+            exit_code = process.returncode if done else TIMEOUT_CODE
+            outputs = {}
+            for name in request['outputs']:
+                path = os.path.join(scratch.path, name)
+                if os.path.exists(path):
+                    outputs[name] = encode_file(path)
+            await send_message(writer, {'type': 'done', 'exit_code': exit_code, 'outputs': outputs})
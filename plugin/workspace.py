@@ -0,0 +1,186 @@
+"""Session-lived storage for prepared docking artifacts.
+
+Artifacts are stored under a name derived from the stage that produced them and the
+inputs they depend on, so pressing Run again only rebuilds stages whose inputs changed.
+Paths of artifacts can be used directly as dependencies of later stages.
+Each docking job uses the workspace through a JobWorkspace, which counts the artifacts that job reused.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from nanome.util import Logs
+
+from plugin.utils import path_size
+
+SESSION_WORKSPACE_MAX_MB = int(os.environ.get('SESSION_WORKSPACE_MAX_MB', 500))
+
+
+def file_digest(path):
+    """sha1 hexdigest of a file's contents."""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class SessionWorkspace:
+    """Directory of artifacts reused across docking runs in a session."""
+
+    def __init__(self, max_mb=SESSION_WORKSPACE_MAX_MB):
+        self._temp_dir = tempfile.TemporaryDirectory(prefix='docking_session_')
+        self.path = self._temp_dir.name
+        self.max_bytes = max_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self._last_used = {}
+        self._locks = defaultdict(threading.Lock)
+        self._locks_lock = threading.Lock()
+
+    def job(self):
+        return JobWorkspace(self)
+
+    @staticmethod
+    def key(stage, *deps):
+        sha = hashlib.sha1(stage.encode())
+        for dep in deps:
+            sha.update(b'\0')
+            sha.update(repr(dep).encode())
+        return sha.hexdigest()
+
+    def intern(self, stage, write, suffix=''):
+        """Store content produced by write(path), addressed by its own digest.
+
+        Returns the same path every time identical content is written.
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix=f'{stage}_', suffix=f'.partial{suffix}')
+        os.close(fd)
+        write(temp_path)
+        path = os.path.join(self.path, f'{stage}_{file_digest(temp_path)}{suffix}')
+        if os.path.exists(path):
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, path)
+        self._last_used[path] = time.time()
+        return path
+
+    def exists(self, stage, deps, suffix=''):
+        """Whether the artifact for stage and deps has already been built."""
+        return os.path.exists(os.path.join(self.path, f'{stage}_{self.key(stage, *deps)}{suffix}'))
+
+    def lookup(self, stage, deps, suffix='', counts=None):
+        """Return path to an already built artifact, or None."""
+        if not self.exists(stage, deps, suffix):
+            return None
+        path, _ = self._reserve(stage, deps, suffix, counts)
+        return path
+
+    def artifact(self, stage, deps, build, suffix='', counts=None):
+        """Return path to the artifact for stage and deps, calling build(path) if it is missing.
+
+        Safe to call from worker threads, concurrent builds of the same artifact are serialized.
+        Hits and misses are counted on the workspace, and on counts if given.
+        """
+        with self._key_lock(stage, deps, suffix):
+            path, temp_path = self._reserve(stage, deps, suffix, counts)
+            if temp_path:
+                try:
+                    build(temp_path)
+                except BaseException:
+                    _remove(temp_path)
+                    raise
+                self._commit(stage, temp_path, path)
+        return path
+
+    def _key_lock(self, stage, deps, suffix):
+        with self._locks_lock:
+            return self._locks[(stage, self.key(stage, *deps), suffix)]
+
+    def _reserve(self, stage, deps, suffix, counts=None):
+        """Return artifact path, and the path to build it at if it does not exist yet."""
+        key = self.key(stage, *deps)
+        path = os.path.join(self.path, f'{stage}_{key}{suffix}')
+        self._last_used[path] = time.time()
+        exists = os.path.exists(path)
+        with self._locks_lock:
+            for stats in [self, counts] if counts else [self]:
+                if exists:
+                    stats.hits += 1
+                else:
+                    stats.misses += 1
+        if exists:
+            Logs.debug(f'Reusing {stage} artifact {os.path.basename(path)}')
+            return path, None
+        # Keep suffix on the partial file, some tools pick their output format from it.
+        temp_path = os.path.join(self.path, f'{stage}_{key}.partial{suffix}')
+        _remove(temp_path)
+        return path, temp_path
+
+    def _commit(self, stage, temp_path, path):
+        if not os.path.exists(temp_path):
+            raise FileNotFoundError(f'{stage} stage did not produce an artifact')
+        os.replace(temp_path, path)
+
+    def artifact_dir(self, stage, deps, build, counts=None):
+        """Like artifact, for stages that produce a directory of files."""
+        def build_dir(temp_path):
+            os.makedirs(temp_path)
+            build(temp_path)
+        return self.artifact(stage, deps, build_dir, counts=counts)
+
+    def evict(self, keep=()):
+        """Delete least recently used artifacts until the workspace fits in max_bytes."""
+        sizes = {path: path_size(path) for path in self._last_used if os.path.exists(path)}
+        total = sum(sizes.values())
+        for path in sorted(sizes, key=self._last_used.get):
+            if total <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            _remove(path)
+            total -= sizes[path]
+            del self._last_used[path]
+
+    def cleanup(self):
+        self._last_used = {}
+        self._temp_dir.cleanup()
+
+
+class JobWorkspace:
+    """Session workspace as used by one docking job, counting the artifacts the job reused and built.
+
+    Jobs run side by side, so the counts of the session workspace mix all of them.
+    """
+
+    def __init__(self, workspace):
+        self.workspace = workspace
+        self.path = workspace.path
+        self.hits = 0
+        self.misses = 0
+
+    def intern(self, stage, write, suffix=''):
+        return self.workspace.intern(stage, write, suffix)
+
+    def exists(self, stage, deps, suffix=''):
+        return self.workspace.exists(stage, deps, suffix)
+
+    def lookup(self, stage, deps, suffix=''):
+        return self.workspace.lookup(stage, deps, suffix, counts=self)
+
+    def artifact(self, stage, deps, build, suffix=''):
+        return self.workspace.artifact(stage, deps, build, suffix, counts=self)
+
+    def artifact_dir(self, stage, deps, build):
+        return self.workspace.artifact_dir(stage, deps, build, counts=self)
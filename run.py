@@ -1,9 +1,8 @@
 import argparse
+import asyncio
 import os
 import nanome
-from plugin.Docking import Autodock4Docking, SminaDocking
-
-default_algorithm = os.environ.get('ALGORITHM', 'smina').lower()
+from plugin.backends import backend_names, get_backend
 
 default_algorithm = os.environ.get('ALGORITHM', 'smina').lower()
 
@@ -12,20 +11,39 @@ def main():
     parser = argparse.ArgumentParser(description='Parse Arguments to determine flavor of Docking to instantiate')
     parser.add_argument(
         '--algorithm',
-        choices=['smina', 'autodock4'],
+        choices=backend_names(),
         default=default_algorithm,
         help='Docking algorithm to use')
+    parser.add_argument(
+        '--worker',
+        action='store_true',
+        help='Run smina for docking plugins on other hosts, instead of running the plugin')
+    parser.add_argument(
+        '--worker-port',
+        type=int,
+        default=None,
+        help='Port the worker listens on, defaults to $DOCKING_WORKER_PORT or 9200')
+    parser.add_argument(
+        '--worker-host',
+        default=None,
+        help='Address the worker listens on, defaults to $DOCKING_WORKER_HOST or 127.0.0.1')
+    parser.add_argument(
+        '--profile-dir',
+        default=None,
+        help='Write cProfile and tracemalloc profiles of every docking job to this directory')
 
     args, _ = parser.parse_known_args()
-    plugin_class = None
-    name = ''
-    algo = args.algorithm
-    if algo == "smina":
-        name = "Smina"
-        plugin_class = SminaDocking
-    elif algo == "autodock4":
-        name = "Autodock4"
-        plugin_class = Autodock4Docking
+    if args.profile_dir:
+        # Read when the plugin modules are imported, and inherited by session processes.
+        os.environ['DOCKING_PROFILE_DIR'] = os.path.abspath(args.profile_dir)
+    if args.worker:
+        run_worker(args.worker_port, args.worker_host)
+        return
+
+    # Only the chosen engine is imported.
+    backend = get_backend(args.algorithm)
+    name = backend.display_name
+    plugin_class = backend.plugin_class
 
     # Create the plugin, register Docking as the class to instantiate, and start listening
     plugin_name = f'{name} Docking'
@@ -37,5 +55,12 @@ def main():
     plugin.run()
 
 
+def run_worker(port=None, host=None):
+    from plugin.smina.calculations import SMINA_PATH
+    from plugin.workers import DOCKING_WORKER_HOST, DOCKING_WORKER_PORT, Worker
+    worker = Worker({'smina': SMINA_PATH})
+    asyncio.run(worker.serve(host or DOCKING_WORKER_HOST, port or DOCKING_WORKER_PORT))
+
+
 if __name__ == "__main__":
     main()
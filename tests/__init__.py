@@ -0,0 +1,9 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+# Plugins built by the tests write job history, keep it out of the developer's home directory.
+_job_history_dir = tempfile.mkdtemp(prefix='docking_test_history_')
+os.environ['JOB_HISTORY_DIR'] = _job_history_dir
+atexit.register(shutil.rmtree, _job_history_dir, ignore_errors=True)
@@ -1,10 +1,19 @@
 import asyncio
 import os
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 from unittest.mock import MagicMock, patch
 from nanome.api.structure import Complex
+from nanome.util import Vector3
 
+from plugin.autodock4.calculations import DockingCalculations
 from plugin.Docking import Autodock4Docking
+from plugin.scratch import ScratchSpace
+from plugin.utils import SiteBox
+from plugin.workspace import SessionWorkspace
 
 fixtures_dir = os.path.join(os.getcwd(), 'tests', 'fixtures')
 
@@ -49,3 +58,196 @@ class Autodock4DockingTestCase(unittest.TestCase):
         )
         comp = result[0]
         self.assertEqual(len(list(comp.molecules)), mode_count)
+
+
+class Autodock4CancelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.scratch = ScratchSpace(root=self.temp_dir.name).job()
+        self.workspace = SessionWorkspace()
+        self.calculations = DockingCalculations(MagicMock())
+
+    def tearDown(self):
+        self.scratch.cleanup()
+        self.workspace.cleanup()
+        self.temp_dir.cleanup()
+
+    def test_cancel_kills_preparation_processes(self):
+        processes = []
+        started = threading.Event()
+        start_process = self.calculations._start_process
+
+        def record_process(*args, **kwargs):
+            process = start_process(*args, **kwargs)
+            processes.append(process)
+            started.set()
+            return process
+
+        def prepare(pdb_file):
+            # Stands in for prepare_receptor and prepare_ligand.
+            self.calculations._run_subprocess([sys.executable, '-c', 'import time; time.sleep(30)'])
+
+        self.calculations._start_process = record_process
+        self.calculations._prepare_receptor = prepare
+        self.calculations._prepare_ligands = prepare
+        loop = asyncio.get_event_loop()
+        task = asyncio.ensure_future(self.calculations.start_docking(
+            'receptor.pdb', ['ligand.pdb'], SiteBox(Vector3(0, 0, 0), Vector3(1, 1, 1)), self.scratch,
+            self.workspace))
+        loop.run_until_complete(loop.run_in_executor(None, started.wait, 5))
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            loop.run_until_complete(task)
+
+        self.assertTrue(processes)
+        for process in processes:
+            self.assertEqual(process.wait(timeout=5), -9)
+        # Threads that had not started their process yet don't start it after the cancel.
+        with self.assertRaises(RuntimeError):
+            self.calculations._run_subprocess([sys.executable, '-c', ''])
+
+
+# Stands in for vina in batch mode: writes <ligand name>_out.pdbqt to --dir for every ligand,
+# except ligands called missing, and prints a loading bar for each.
+FAKE_VINA = """
+import os, sys
+args = sys.argv[1:]
+output_dir = args[args.index('--dir') + 1]
+ligands = args[args.index('--batch') + 1:args.index('--dir')]
+for ligand in ligands:
+    name = os.path.splitext(os.path.basename(ligand))[0]
+    print('*' * 51, end='', flush=True)
+    if name != 'missing':
+        with open(os.path.join(output_dir, name + '_out.pdbqt'), 'w') as f:
+            f.write(name)
+"""
+
+
+class Autodock4VinaBatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.scratch = ScratchSpace(root=self.temp_dir.name).job()
+        self.workspace = SessionWorkspace()
+        self.calculations = DockingCalculations(MagicMock())
+        self.calculations.scratch = self.scratch
+        self.calculations.temp_dir = self.scratch.path
+        self.calculations.workspace = self.workspace
+        self.calculations._loop = asyncio.get_event_loop()
+        self.grid_dir = self.scratch.mkdir(prefix='grid_')
+        self.vina_args = []
+        start_process = self.calculations._start_process
+
+        def start_fake_vina(args, **kwargs):
+            self.vina_args.append(args)
+            return start_process([sys.executable, '-c', FAKE_VINA, *args[1:]], **kwargs)
+        self.calculations._start_process = start_fake_vina
+
+    def tearDown(self):
+        self.scratch.cleanup()
+        self.workspace.cleanup()
+        self.temp_dir.cleanup()
+
+    def ligand(self, name):
+        return os.path.join(self.scratch.path, f'{name}.pdbqt')
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def test_results_follow_ligand_order(self):
+        ligands = [self.ligand('b'), self.ligand('a'), self.ligand('b')]
+        results = self.calculations._dock_ligands(self.grid_dir, ligands, 1, 1, False)
+        self.assertEqual([self.read(path) for path in results], ['b', 'a', 'b'])
+        # Duplicate ligands are docked once, and share their result.
+        self.assertEqual(results[0], results[2])
+        batch = self.vina_args[0]
+        self.assertEqual(batch[batch.index('--batch') + 1:batch.index('--dir')], ligands[:2])
+        self.assertEqual(self.calculations.exit_codes, [0])
+
+    def test_cached_ligands_not_docked(self):
+        cached, new = self.ligand('cached'), self.ligand('new')
+        deps = self.calculations._vina_deps(self.grid_dir, cached, 1, 1)
+        self.workspace.artifact('vina_output', deps, lambda path: self.write(path, 'cached'), '.pdbqt')
+
+        results = self.calculations._dock_ligands(self.grid_dir, [cached, new], 1, 1, True)
+        self.assertEqual([self.read(path) for path in results], ['cached', 'new'])
+        self.assertNotIn(cached, self.vina_args[0])
+        self.assertIn('--seed', self.vina_args[0])
+
+        # Once every ligand is cached, vina is not run at all.
+        self.calculations._dock_ligands(self.grid_dir, [new, cached], 1, 1, True)
+        self.assertEqual(len(self.vina_args), 1)
+
+    def test_missing_output(self):
+        results = self.calculations._dock_ligands(
+            self.grid_dir, [self.ligand('a'), self.ligand('missing')], 1, 1, False)
+        self.assertEqual(self.read(results[0]), 'a')
+        # Ligands without output get an empty result, which converts to no poses.
+        self.assertEqual(self.read(results[1]), '')
+
+        # Seeded results are cached, so a missing output is an error rather than an empty result.
+        with self.assertRaises(RuntimeError):
+            self.calculations._dock_ligands(self.grid_dir, [self.ligand('missing')], 1, 1, True)
+
+
+class Autodock4ObabelConvertTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.scratch = ScratchSpace(root=self.temp_dir.name).job()
+        self.calculations = DockingCalculations(MagicMock())
+        self.calculations.scratch = self.scratch
+        self.calculations.temp_dir = self.scratch.path
+        self.pdbqt_files = []
+        for name, model_count in [('a', 2), ('b', 1)]:
+            pdbqt_file = os.path.join(self.scratch.path, f'{name}.pdbqt')
+            with open(pdbqt_file, 'w') as f:
+                for _ in range(model_count):
+                    f.write('MODEL\nATOM      1  C1  LIG A   1      10.000  11.000  12.000\nENDMDL\n')
+            self.pdbqt_files.append(pdbqt_file)
+        self.commands = []
+
+    def tearDown(self):
+        self.scratch.cleanup()
+        self.temp_dir.cleanup()
+
+    def fake_obabel(self, dropped=()):
+        """Stand in for obabel, titling each record with the file and model it was read from."""
+        def run_subprocess(args, **kwargs):
+            self.commands.append(args)
+            inputs = [arg for arg in args if arg.endswith('.pdbqt')]
+            records = [
+                f'{os.path.basename(pdbqt_file)} {model}\n$$$$\n' for pdbqt_file in inputs
+                for model in range(2 if pdbqt_file.endswith('a.pdbqt') else 1)
+                if (os.path.basename(pdbqt_file), model) not in dropped]
+            output = next((arg[2:] for arg in args if arg.startswith('-O')), None)
+            if output:
+                with open(output, 'w') as f:
+                    f.writelines(records)
+            return subprocess.CompletedProcess(args, 0, ''.join(records), None)
+        self.calculations._run_subprocess = run_subprocess
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_single_obabel_call(self):
+        self.fake_obabel()
+        converted = self.calculations._obabel_convert(self.pdbqt_files)
+        self.assertEqual(len(self.commands), 1)
+        self.assertEqual(self.read(converted[self.pdbqt_files[0]]), 'a.pdbqt 0\n$$$$\na.pdbqt 1\n$$$$\n')
+        self.assertEqual(self.read(converted[self.pdbqt_files[1]]), 'b.pdbqt 0\n$$$$\n')
+
+    def test_dropped_records_converted_per_file(self):
+        # obabel skips the second model of a, which would shift the poses of b into a.
+        self.fake_obabel(dropped=[('a.pdbqt', 1)])
+        converted = self.calculations._obabel_convert(self.pdbqt_files)
+        self.assertEqual(len(self.commands), 3)
+        self.assertEqual(self.read(converted[self.pdbqt_files[0]]), 'a.pdbqt 0\n$$$$\n')
+        self.assertEqual(self.read(converted[self.pdbqt_files[1]]), 'b.pdbqt 0\n$$$$\n')
@@ -0,0 +1,333 @@
+"""Load test of many docking sessions in one process, against simulated Nanome clients.
+
+Every session is a SminaDocking instance whose network is a SimulatedClient. The client keeps a workspace of
+complexes, answers requests after a delay, emits complex added/removed events like Nanome does, and counts the
+messages the plugin sends. Sessions replay a scenario: load a receptor, then for every run add ligands, select
+them in the menu, press Run, wait for the job to finish and remove the ligands and docked poses again. Runs dock
+ligand_counts ligands in turn, so sessions overlap with jobs of different sizes.
+
+Engines are SimulatedEngine, which takes seconds_per_frame for every ligand frame and writes poses of the ligand
+itself, so the harness measures the plugin (requests, preparation, post-processing, uploads and menu updates)
+rather than smina. Smina can't run here in any case, nanome only runs processes through the process manager of
+a running plugin.
+
+Reports end-to-end job latency, event loop lag, and messages sent per job:
+
+    python -m tests.load_harness --sessions 20 --runs 3 --ligand-counts 1,4,8
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from collections import Counter
+
+from nanome.api.structure import Complex
+
+from plugin.Docking import SminaDocking
+from plugin.job_store import JobStore, percentile
+from plugin.smina.calculations import DockingCalculations
+from plugin.utils import tag_sdf_record
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+# Seconds between event loop lag samples.
+LAG_SAMPLE_INTERVAL = 0.01
+
+# Request ids are shared by every plugin instance in the process, so they must be unique across clients.
+_request_ids = itertools.count()
+
+
+class SimulatedClient:
+    """Stands in for the network connection of a plugin instance to a Nanome client."""
+
+    def __init__(self, latency=0.005):
+        self.latency = latency
+        self.plugin = None
+        self.complexes = {}
+        self.messages = Counter()
+        self._indices = itertools.count(1)
+
+    def attach(self, plugin):
+        self.plugin = plugin
+        plugin._network = self
+        # Set by nanome when a session connects, along with a process manager the harness doesn't use.
+        plugin._menus = {}
+
+    @property
+    def message_count(self):
+        return sum(self.messages.values())
+
+    def send(self, code, arg, expects_response):
+        self.messages[getattr(code, 'name', code)] += 1
+        request_id = next(_request_ids)
+        if expects_response:
+            response = self.respond(getattr(code, 'name', code), arg)
+            asyncio.get_event_loop().call_later(self.latency, self.plugin._call, request_id, response)
+        return request_id
+
+    def respond(self, message, arg):
+        if message == 'complex_list_request':
+            return [self._copy(comp, deep=False) for comp in self.complexes.values()]
+        if message == 'complexes_request':
+            return [self._copy(self.complexes[index]) if index in self.complexes else None for index in arg]
+        if message == 'add_to_workspace':
+            created = [self.add_complex(comp) for comp in arg]
+            return [self._copy(comp) for comp in created]
+        if message == 'structures_deep_update':
+            for comp in arg:
+                if comp.index in self.complexes:
+                    self.complexes[comp.index] = self._copy(comp)
+            return None
+        return None
+
+    def add_complex(self, comp):
+        """Add comp to the workspace, like loading it in Nanome."""
+        comp = self._copy(comp)
+        comp.index = next(self._indices)
+        self.complexes[comp.index] = comp
+        asyncio.get_event_loop().call_later(self.latency, self.plugin.on_complex_added)
+        return comp
+
+    def remove_complex(self, index):
+        if self.complexes.pop(index, None) is not None:
+            asyncio.get_event_loop().call_later(self.latency, self.plugin.on_complex_removed)
+
+    @staticmethod
+    def _copy(comp, deep=True):
+        # Complexes pass through the network, so the plugin never shares objects with the client.
+        copy = comp._deep_copy() if deep else comp._shallow_copy()
+        copy.index = comp.index
+        copy.position = comp.position
+        copy.rotation = comp.rotation
+        return copy
+
+
+class SimulatedEngine(DockingCalculations):
+    """Docking engine that takes seconds_per_frame per ligand frame, and returns the ligand itself as its poses."""
+
+    def __init__(self, plugin, seconds_per_frame=0.05, rng=None):
+        super().__init__(plugin)
+        self.seconds_per_frame = seconds_per_frame
+        self.rng = rng or random.Random()
+
+    async def start_docking(self, receptor_pdb, ligand_pdbs, site_box, scratch, modes=None, **kwargs):
+        self.exit_codes = []
+        self.degraded_ligands = {}
+        frame_counts = [self._get_frame_count(ligand_pdb) for ligand_pdb in ligand_pdbs]
+        total = sum(frame_counts)
+        docked = 0
+        output_sdfs = []
+        for ligand_pdb, frame_count in zip(ligand_pdbs, frame_counts):
+            for _ in range(frame_count):
+                await asyncio.sleep(self.seconds_per_frame)
+                docked += 1
+                self.plugin.update_loading_bar(docked, total)
+            output_sdf = scratch.file(prefix='output', suffix='.sdf')
+            self.write_poses(ligand_pdb, output_sdf, modes or 1)
+            output_sdfs.append(output_sdf)
+            self.exit_codes.append(0)
+            if len(ligand_pdbs) > 1:
+                self.plugin.update_run_btn_text(f"Running... ({len(output_sdfs)}/{len(ligand_pdbs)})")
+        return output_sdfs
+
+    def write_poses(self, ligand_pdb, output_sdf, modes):
+        """Write the first frame of ligand_pdb as modes poses, with smina style score properties."""
+        atoms = []
+        with open(ligand_pdb) as f:
+            for line in f:
+                if line.startswith('ENDMDL'):
+                    break
+                if line.startswith(('ATOM', 'HETATM')):
+                    symbol = line[76:78].strip() or line[12:16].strip()[0]
+                    atoms.append((float(line[30:38]), float(line[38:46]), float(line[46:54]), symbol))
+        name = os.path.splitext(os.path.basename(ligand_pdb))[0]
+        with open(output_sdf, 'w') as f:
+            for _ in range(modes):
+                lines = [f'{name}\n', '  simulated\n', '\n', f'{len(atoms):3d}  0  0  0  0  0  0  0  0  0999 V2000\n']
+                for x, y, z, symbol in atoms:
+                    lines.append(f'{x:10.4f}{y:10.4f}{z:10.4f} {symbol:<3} 0  0  0  0  0  0  0  0  0  0  0  0\n')
+                lines.extend(['M  END\n', '$$$$\n'])
+                record = tag_sdf_record(''.join(lines), 'minimizedAffinity', f'{self.rng.uniform(-10, -4):.5f}')
+                terms = ' '.join(
+                    f'<{x},{y},{z}> 0 0 {self.rng.uniform(-0.5, 0.5):.4f} 0 0' for x, y, z, _ in atoms)
+                record = tag_sdf_record(record, 'atomic_interaction_terms', terms)
+                f.write(record)
+
+
+class LoadTestReport:
+    """Measurements of a load test run."""
+
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.job_latencies = []
+        self.job_messages = []
+        self.job_statuses = Counter()
+        self.message_types = Counter()
+        self.loop_lags = []
+        self.duration = 0.0
+
+    def summary(self):
+        def stats(values, digits=4):
+            return {
+                'p50': round(percentile(values, 50), digits) if values else None,
+                'p95': round(percentile(values, 95), digits) if values else None,
+                'max': round(max(values), digits) if values else None,
+            }
+        return {
+            'sessions': self.sessions,
+            'jobs': len(self.job_latencies),
+            'duration': round(self.duration, 2),
+            'job_statuses': dict(self.job_statuses),
+            'job_latency': stats(self.job_latencies),
+            'loop_lag': stats(self.loop_lags),
+            'messages_per_job': stats(self.job_messages, 1),
+            'message_types': dict(self.message_types.most_common()),
+        }
+
+
+async def monitor_loop_lag(lags, interval=LAG_SAMPLE_INTERVAL):
+    """Record how much later than requested sleeps of interval wake up, until cancelled."""
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - start - interval)
+
+
+class Session:
+    """A plugin instance with its simulated client, replaying a user's session."""
+
+    def __init__(self, receptor, ligand, report, job_history_dir, latency=0.005, seconds_per_frame=0.05, rng=None):
+        self.rng = rng or random.Random()
+        self.report = report
+        self.ligand = ligand
+        self.client = SimulatedClient(latency)
+        self.plugin = SminaDocking()
+        self.client.attach(self.plugin)
+        self.plugin.job_store = JobStore(directory=job_history_dir)
+        self.plugin._create_engine = lambda host: SimulatedEngine(host, seconds_per_frame, self.rng)
+        self.receptor = receptor
+
+    async def settle(self):
+        """Wait for workspace events sent so far to reach the menu."""
+        await asyncio.sleep(self.client.latency * 2)
+        await self.plugin.complex_list_refresher.wait()
+
+    def menu_item(self, dropdown, comp):
+        return next(item for item in dropdown.items if item.complex.index == comp.index)
+
+    async def run(self, ligand_counts):
+        plugin = self.plugin
+        menu = plugin.menu
+        plugin.start()
+        await plugin.on_run()
+        receptor = self.client.add_complex(self.receptor)
+        await self.settle()
+        menu.handle_receptor_selected(menu.dd_receptor, self.menu_item(menu.dd_receptor, receptor))
+        try:
+            for ligand_count in ligand_counts:
+                await self.run_job(ligand_count)
+        finally:
+            await plugin.jobs.wait()
+            plugin.on_stop()
+
+    async def run_job(self, ligand_count):
+        plugin = self.plugin
+        menu = plugin.menu
+        ligands = []
+        for _ in range(ligand_count):
+            # Moved slightly, so ligands are not deduplicated.
+            ligand = self.ligand._deep_copy()
+            offset = self.rng.uniform(-0.5, 0.5)
+            for atom in ligand.atoms:
+                atom.position.x += offset
+            ligands.append(self.client.add_complex(ligand))
+        await self.settle()
+        for ligand in ligands:
+            menu.handle_ligand_selected(menu.dd_ligands, self.menu_item(menu.dd_ligands, ligand))
+        # Selecting the site draws a shape, which nanome sends through the last plugin instance created.
+        menu._selected_site = menu._reselect_item(menu.dd_site, ligands[0], 2)
+
+        messages_before = Counter(self.client.messages)
+        start_time = time.time()
+        await menu.run_button_pressed_callback(menu._run_button)
+        docking_job = list(plugin.jobs)[-1]
+        # Progressive jobs replace their task when they start refining.
+        while docking_job.running:
+            await asyncio.gather(docking_job.task, return_exceptions=True)
+        self.report.job_latencies.append(time.time() - start_time)
+        self.report.job_statuses[docking_job.status] += 1
+        await plugin.job_list_refresher.wait()
+        messages = self.client.messages - messages_before
+        self.report.job_messages.append(sum(messages.values()))
+        self.report.message_types.update(messages)
+
+        for ligand in ligands:
+            self.client.remove_complex(ligand.index)
+        for result in docking_job.results:
+            if result is not None:
+                self.client.remove_complex(result.index)
+        await self.settle()
+
+
+async def run_load_test(
+        sessions=10, ligand_counts=(1, 2, 4), runs=None, latency=0.005, seconds_per_frame=0.05,
+        stagger=1.0, seed=0):
+    """Run sessions side by side, each starting at a random time within stagger seconds.
+
+    Every session runs runs jobs (default one per ligand count), docking ligand_counts ligands in turn.
+    Returns a LoadTestReport.
+    """
+    rng = random.Random(seed)
+    receptor = Complex.io.from_sdf(path=os.path.join(fixtures_dir, '5ceo_receptor.sdf'))
+    ligand = Complex.io.from_sdf(path=os.path.join(fixtures_dir, '5ceo_ligand.sdf'))
+    runs = runs or len(ligand_counts)
+    report = LoadTestReport(sessions)
+
+    async def run_session(session):
+        await asyncio.sleep(rng.uniform(0, stagger))
+        counts = [ligand_counts[(i + rng.randrange(len(ligand_counts))) % len(ligand_counts)] for i in range(runs)]
+        await session.run(counts)
+
+    lag_monitor = asyncio.ensure_future(monitor_loop_lag(report.loop_lags))
+    start_time = time.time()
+    with tempfile.TemporaryDirectory() as job_history_dir:
+        session_list = [
+            Session(receptor, ligand, report, job_history_dir, latency, seconds_per_frame, random.Random(rng.random()))
+            for _ in range(sessions)]
+        try:
+            await asyncio.gather(*[run_session(session) for session in session_list])
+        finally:
+            lag_monitor.cancel()
+    report.duration = time.time() - start_time
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test docking sessions against simulated Nanome clients')
+    parser.add_argument('--sessions', type=int, default=10, help='Sessions running side by side')
+    parser.add_argument('--runs', type=int, default=None, help='Jobs per session, defaults to one per ligand count')
+    parser.add_argument(
+        '--ligand-counts', default='1,2,4', help='Comma separated number of ligands docked by the runs of a session')
+    parser.add_argument('--latency', type=float, default=0.005, help='Seconds before the client answers a request')
+    parser.add_argument(
+        '--seconds-per-frame', type=float, default=0.05, help='Seconds the simulated engine takes per ligand frame')
+    parser.add_argument('--stagger', type=float, default=1.0, help='Seconds over which sessions start')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help='Show plugin logs')
+    args = parser.parse_args()
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    ligand_counts = [int(count) for count in args.ligand_counts.split(',')]
+    report = asyncio.run(run_load_test(
+        args.sessions, ligand_counts, args.runs, args.latency, args.seconds_per_frame, args.stagger, args.seed))
+    print(json.dumps(report.summary(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,14 @@
 import asyncio
 import os
+import tempfile
 import unittest
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 from nanome.api.structure import Complex
+from nanome.util import Vector3
 
 from plugin.Docking import SminaDocking
+from plugin.scratch import ScratchSpace
+from plugin.utils import SiteBox
 
 fixtures_dir = os.path.join(os.getcwd(), 'tests', 'fixtures')
 
@@ -49,3 +53,186 @@ class SminaDockingTestCase(unittest.TestCase):
         )
         comp = result[0]
         self.assertEqual(len(list(comp.molecules)), mode_count)
+
+
+class SminaTailOutputTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin_smina = SminaDocking()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.scratch = ScratchSpace(root=self.temp_dir.name).job()
+
+    def tearDown(self):
+        self.scratch.cleanup()
+        self.temp_dir.cleanup()
+        self.plugin_smina.workspace.cleanup()
+
+    @patch('plugin.smina.calculations.RESULT_TAIL_INTERVAL', 0.01)
+    def test_poses_pushed_while_docking(self):
+        calculations = self.plugin_smina._calculations
+        ligand_pdb = os.path.join(self.temp_dir.name, 'ligand.pdb')
+        calculations.scratch = self.scratch
+        calculations.frame_counts = {ligand_pdb: 2}
+        calculations.total_frame_count = 2
+        pushed = []
+
+        async def on_poses(ligand, partial_sdf):
+            with open(partial_sdf) as f:
+                pushed.append((ligand, f.read().count('$$$$')))
+        calculations.on_poses = on_poses
+
+        async def run_smina(batch, receptor_pdb, site_box, output_sdf, *args, **kwargs):
+            # Poses of the first frame are written before the second frame is done.
+            record = 'ligand\n  smina\n\nM  END\n$$$$\n'
+            with open(output_sdf, 'w') as f:
+                f.write(record * 2)
+            await asyncio.sleep(0.1)
+            with open(output_sdf, 'a') as f:
+                f.write(record * 2)
+            return 0
+        calculations.run_smina = run_smina
+
+        loop = asyncio.get_event_loop()
+        results, exit_code = loop.run_until_complete(
+            calculations._run_batch([ligand_pdb], 'receptor.pdb', None, 'log', {}))
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(pushed, [(ligand_pdb, 2)])
+        self.assertIn(ligand_pdb, results)
+
+
+class SminaTimeoutRetryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin_smina = SminaDocking()
+        self.plugin_smina._network = MagicMock()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.scratch = ScratchSpace(root=self.temp_dir.name).job()
+        self.ligand_pdbs = []
+        for name in ['fast', 'slow', 'stuck']:
+            ligand_pdb = os.path.join(self.temp_dir.name, f'{name}.pdb')
+            with open(ligand_pdb, 'w') as f:
+                f.write('NUMMDL    1\n')
+            self.ligand_pdbs.append(ligand_pdb)
+        self.receptor_pdb = self.ligand_pdbs[0]
+        self.site_box = SiteBox(Vector3(0, 0, 0), Vector3(1, 1, 1))
+
+    def tearDown(self):
+        self.scratch.cleanup()
+        self.temp_dir.cleanup()
+        self.plugin_smina.workspace.cleanup()
+
+    def test_timed_out_ligands_retried_with_reduced_settings(self):
+        calculations = self.plugin_smina._calculations
+        fast, slow, stuck = self.ligand_pdbs
+        runs = []
+
+        async def run_smina(batch, receptor_pdb, site_box, output_sdf, *args, exhaustiveness=None, **kwargs):
+            runs.append((list(batch), exhaustiveness))
+            if stuck in batch or (slow in batch and exhaustiveness == 8):
+                raise TimeoutError
+            return 0
+        calculations.run_smina = run_smina
+
+        with patch('plugin.smina.calculations.SMINA_BATCH_SIZE', 1):
+            loop = asyncio.get_event_loop()
+            results = loop.run_until_complete(calculations.start_docking(
+                self.receptor_pdb, self.ligand_pdbs, self.site_box, self.scratch,
+                exhaustiveness=8, modes=1, autobox=4, timeout=30))
+
+        self.assertIsNotNone(results[0])
+        self.assertIsNotNone(results[1])
+        self.assertIsNone(results[2])
+        self.assertEqual(calculations.degraded_ligands, {slow: {'exhaustiveness': 2, 'autobox': 4}})
+        # The stuck ligand is tried once with every setting.
+        self.assertEqual([exh for batch, exh in runs if batch == [stuck]], [8, 2, 1])
+
+    def test_finished_ligands_of_timed_out_batch_kept(self):
+        calculations = self.plugin_smina._calculations
+        fast, slow, stuck = self.ligand_pdbs
+        runs = []
+
+        async def run_smina(batch, receptor_pdb, site_box, output_sdf, *args, exhaustiveness=None, **kwargs):
+            runs.append((list(batch), exhaustiveness))
+            with open(output_sdf, 'w') as f:
+                for ligand_pdb in batch:
+                    f.write(f'{os.path.basename(ligand_pdb)}\n\n\n$$$$\n')
+                if stuck in batch and exhaustiveness == 8:
+                    # Stopped while writing the first pose of the last ligand.
+                    f.write('stuck.pdb\n')
+                    raise TimeoutError
+            return 0
+        calculations.run_smina = run_smina
+
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(calculations.start_docking(
+            self.receptor_pdb, [fast, slow, stuck, stuck], self.site_box, self.scratch,
+            exhaustiveness=8, modes=1, autobox=4, timeout=30))
+
+        # Only the ligand smina was working on is retried, the others keep their full search results.
+        self.assertEqual(runs, [([fast, slow, stuck], 8), ([stuck], 2)])
+        self.assertEqual(calculations.degraded_ligands, {stuck: {'exhaustiveness': 2, 'autobox': 4}})
+        for ligand_pdb, output_sdf in zip([fast, slow], results):
+            with open(output_sdf) as f:
+                self.assertEqual(f.read(), f'{os.path.basename(ligand_pdb)}\n\n\n$$$$\n')
+        self.assertEqual(results[2], results[3])
+        self.assertIsNotNone(results[2])
+
+    def test_all_ligands_timed_out(self):
+        calculations = self.plugin_smina._calculations
+
+        async def run_smina(*args, **kwargs):
+            raise TimeoutError
+        calculations.run_smina = run_smina
+
+        loop = asyncio.get_event_loop()
+        with self.assertRaises(TimeoutError):
+            loop.run_until_complete(calculations.start_docking(
+                self.receptor_pdb, self.ligand_pdbs[1:], self.site_box, self.scratch,
+                exhaustiveness=8, modes=1, autobox=4, timeout=30))
+
+
+class SminaScorePosesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin_smina = SminaDocking()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.scratch = ScratchSpace(root=self.temp_dir.name).job()
+
+    def tearDown(self):
+        self.scratch.cleanup()
+        self.temp_dir.cleanup()
+        self.plugin_smina.workspace.cleanup()
+
+    def test_failed_scoring_raises(self):
+        calculations = self.plugin_smina._calculations
+        calculations._run_process = AsyncMock(side_effect=[0, 1])
+        loop = asyncio.get_event_loop()
+        with self.assertRaises(RuntimeError) as context:
+            loop.run_until_complete(calculations.score_poses(
+                'receptor.pdb', ['ligand_a.pdb', 'ligand_b.pdb'], self.scratch))
+        self.assertIn('ligand_b.pdb', str(context.exception))
+
+        calculations._run_process = AsyncMock(return_value=0)
+        output_sdfs = loop.run_until_complete(calculations.score_poses('receptor.pdb', ['ligand_a.pdb'], self.scratch))
+        self.assertEqual(len(output_sdfs), 1)
+
+
+class SminaSiteBoxTestCase(unittest.TestCase):
+
+    def test_search_box_padded_by_autobox(self):
+        plugin_smina = SminaDocking()
+        calculations = plugin_smina._calculations
+        calculations._run_process = AsyncMock(return_value=0)
+        site_box = SiteBox(Vector3(-1, 0, 2), Vector3(3, 2, 4))
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(calculations.run_smina(
+            'ligand.pdb', 'receptor.pdb', site_box, 'output.sdf', 'log', exhaustiveness=8, modes=1, autobox=4))
+        smina_args = calculations._run_process.call_args[0][0]
+        box_args = dict(zip(smina_args[::2], smina_args[1::2]))
+        self.assertEqual(box_args['--center_x'], '1.0')
+        self.assertEqual(box_args['--center_z'], '3.0')
+        self.assertEqual(box_args['--size_x'], '12.0')
+        self.assertEqual(box_args['--size_y'], '10.0')
+        self.assertNotIn('--autobox_ligand', smina_args)
+        plugin_smina.workspace.cleanup()
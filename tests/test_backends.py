@@ -0,0 +1,39 @@
+import sys
+import unittest
+
+from plugin.backends import backend_names, get_backend, register_backend, _backends
+
+
+class BackendRegistryTestCase(unittest.TestCase):
+
+    def test_builtin_backends(self):
+        self.assertEqual(backend_names()[:2], ['smina', 'autodock4'])
+        self.assertEqual(get_backend('smina').display_name, 'Smina')
+        with self.assertRaises(ValueError):
+            get_backend('unknown')
+
+    def test_engine_imported_on_first_use(self):
+        register_backend('test_engine', 'Test', 'plugin.Docking:Docking', 'tests.test_backends:FakeCalculations')
+        try:
+            backend = get_backend('test_engine')
+            self.assertIs(backend.calculations_class, FakeCalculations)
+        finally:
+            del _backends['test_engine']
+
+    def test_plugin_import_does_not_load_engines(self):
+        sys.modules.pop('plugin.autodock4.calculations', None)
+        import plugin.Docking  # noqa: F401
+        self.assertNotIn('plugin.autodock4.calculations', sys.modules)
+        plugin_instance = plugin.Docking.Autodock4Docking()
+        try:
+            self.assertNotIn('plugin.autodock4.calculations', sys.modules)
+            self.assertFalse(plugin_instance._calculations.requires_site)
+            self.assertIn('plugin.autodock4.calculations', sys.modules)
+        finally:
+            plugin_instance.workspace.cleanup()
+
+
+class FakeCalculations:
+
+    def __init__(self, plugin):
+        self.plugin = plugin
@@ -0,0 +1,549 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from functools import partial
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from nanome.api.structure import Complex
+
+from plugin.Docking import Docking, SminaDocking, PROGRESSIVE_EXHAUSTIVENESS, SCORE_COLOR_TABLE
+from plugin.scratch import ScratchSpace
+from plugin.utils import iter_sdf_records, sdf_property
+
+fixtures_dir = os.path.join(os.getcwd(), 'tests', 'fixtures')
+
+
+class DeduplicateLigandsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.ligand_sdf = f'{fixtures_dir}/5ceo_ligand.sdf'
+
+    def _load_ligand(self):
+        return Complex.io.from_sdf(path=self.ligand_sdf)
+
+    def test_identical_ligands_docked_once(self):
+        ligand1 = self._load_ligand()
+        ligand2 = self._load_ligand()
+        moved_ligand = self._load_ligand()
+        for atom in moved_ligand.atoms:
+            atom.position.x += 1.0
+
+        unique_ligands, ligand_map = Docking.deduplicate_ligands([ligand1, moved_ligand, ligand2])
+        self.assertEqual(unique_ligands, [ligand1, moved_ligand])
+        self.assertEqual(ligand_map, [0, 1, 0])
+
+    def test_duplicate_frames_removed(self):
+        ligand = self._load_ligand()
+        duplicate_frame = next(self._load_ligand().molecules)
+        ligand.add_molecule(duplicate_frame)
+        self.assertEqual(len(list(ligand.molecules)), 2)
+
+        unique_ligands, ligand_map = Docking.deduplicate_ligands([ligand])
+        self.assertEqual(len(list(unique_ligands[0].molecules)), 1)
+        self.assertEqual(ligand_map, [0])
+
+
+class ToggleAtomLabelsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = Docking()
+        self.plugin._network = MagicMock()
+        self.docked_complex = Complex.io.from_sdf(path=f'{fixtures_dir}/5ceo_ligand.sdf')
+        self.docked_complex.index = 10
+        self.atoms = list(self.docked_complex.atoms)
+        for atom in self.atoms[:3]:
+            atom.label_text = '-0.123'
+        self.plugin.docked_complex_indices = [10]
+        self.plugin.score_label_atoms = {10: self.atoms[:3]}
+
+    def tearDown(self):
+        self.plugin.workspace.cleanup()
+
+    @patch('nanome.api.plugin_instance.PluginInstance.request_complexes')
+    @patch('nanome.api.plugin_instance.PluginInstance.update_structures_shallow')
+    def test_only_changed_label_atoms_sent(self, update_shallow_mock, request_complexes_mock):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.plugin.toggle_atom_labels(True))
+        request_complexes_mock.assert_not_called()
+        sent_atoms = update_shallow_mock.call_args[0][0]
+        self.assertEqual(sent_atoms, self.atoms[:3])
+        self.assertTrue(all(atom.labeled for atom in sent_atoms))
+
+        # Toggling to the current state sends nothing.
+        update_shallow_mock.reset_mock()
+        loop.run_until_complete(self.plugin.toggle_atom_labels(True))
+        update_shallow_mock.assert_not_called()
+
+
+class ScoreColorsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = SminaDocking()
+        self.plugin._network = MagicMock()
+        self.docked_complex = Complex.io.from_sdf(path=f'{fixtures_dir}/5ceo_ligand.sdf')
+        self.docked_complex.index = 10
+        molecule = next(self.docked_complex.molecules)
+        self.atoms = list(molecule.atoms)
+        for atom, score in zip(self.atoms, [-2.0, 1.0, 0.0]):
+            atom.score = score
+        molecule.min_atom_score = -2.0
+        molecule.max_atom_score = 1.0
+
+    def tearDown(self):
+        self.plugin.workspace.cleanup()
+
+    def test_scores_mapped_to_gradient(self):
+        original_color = self.atoms[0].atom_color
+        self.plugin.color_scores(self.docked_complex)
+        half = (len(SCORE_COLOR_TABLE) - 1) // 2
+        self.assertIs(self.atoms[0].score_color, SCORE_COLOR_TABLE[0])
+        self.assertIs(self.atoms[1].score_color, SCORE_COLOR_TABLE[half + half // 2])
+        self.assertIs(self.atoms[2].score_color, SCORE_COLOR_TABLE[half])
+        self.assertFalse(hasattr(self.atoms[3], 'score_color'))
+        # Colors are only applied when enabled.
+        self.assertIs(self.atoms[0].atom_color, original_color)
+        self.plugin.color_scores(self.docked_complex, enabled=True)
+        self.assertIs(self.atoms[0].atom_color, SCORE_COLOR_TABLE[0])
+
+    @patch('nanome.api.plugin_instance.PluginInstance.update_structures_shallow')
+    def test_only_changed_color_atoms_sent(self, update_shallow_mock):
+        self.plugin.color_scores(self.docked_complex)
+        self.plugin.docked_complex_indices = [10]
+        self.plugin.score_color_atoms = {
+            10: [(atom, atom.default_color, atom.score_color) for atom in self.atoms[:3]]}
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.plugin.toggle_score_colors(True))
+        sent_atoms = update_shallow_mock.call_args[0][0]
+        self.assertEqual(sent_atoms, self.atoms[:3])
+        self.assertIs(self.atoms[0].atom_color, SCORE_COLOR_TABLE[0])
+
+        update_shallow_mock.reset_mock()
+        loop.run_until_complete(self.plugin.toggle_score_colors(True))
+        update_shallow_mock.assert_not_called()
+        loop.run_until_complete(self.plugin.toggle_score_colors(False))
+        self.assertIs(self.atoms[0].atom_color, self.atoms[0].default_color)
+
+
+class AddResultToWorkspaceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = Docking()
+        self.plugin._network = MagicMock()
+        self.plugin.update_loading_bar = MagicMock()
+        self.receptor = Complex.io.from_sdf(path=f'{fixtures_dir}/5ceo_receptor.sdf')
+        self.results = [Complex.io.from_sdf(path=f'{fixtures_dir}/5ceo_ligand.sdf') for _ in range(5)]
+        self.atom_count = sum(1 for _ in self.results[0].atoms)
+
+    def tearDown(self):
+        self.plugin.workspace.cleanup()
+        self.plugin.complex_list_refresher.cancel()
+        asyncio.get_event_loop().run_until_complete(self.plugin.complex_list_refresher.wait())
+
+    def test_chunk_complexes(self):
+        chunks = Docking.chunk_complexes(self.results, self.atom_count * 2)
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        # Complexes larger than the limit still get uploaded, one per chunk.
+        chunks = Docking.chunk_complexes(self.results, 1)
+        self.assertEqual([len(chunk) for chunk in chunks], [1] * 5)
+
+    @patch('plugin.Docking.UPLOAD_CHUNK_ATOM_COUNT', 1)
+    @patch('nanome.api.plugin_instance.PluginInstance.update_structures_shallow')
+    @patch('nanome.api.plugin_instance.PluginInstance.add_to_workspace')
+    def test_upload_in_chunks(self, add_to_workspace_mock, update_shallow_mock):
+        next_index = iter(range(100, 200))
+
+        async def add_to_workspace(complexes):
+            for comp in complexes:
+                comp.index = next(next_index)
+            return complexes
+        add_to_workspace_mock.side_effect = add_to_workspace
+
+        host = MagicMock()
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.plugin.add_result_to_workspace(self.results, self.receptor, self.receptor, host))
+        self.assertEqual(add_to_workspace_mock.call_count, 5)
+        self.assertEqual(update_shallow_mock.call_count, 5)
+        self.assertEqual(sorted(self.plugin.docked_complex_indices), list(range(100, 105)))
+        # Progress goes to the job uploading the results, not the loading bar shared by all jobs.
+        host.update_loading_bar.assert_called_with(5, 5)
+        self.plugin.update_loading_bar.assert_not_called()
+
+
+class ProgressiveDockingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = Docking()
+        self.plugin._network = MagicMock()
+        self.plugin.settings_menu.get_settings = MagicMock(return_value={'exhaustiveness': 10, 'progressive': True})
+        self.receptor = Complex.io.from_sdf(path=f'{fixtures_dir}/5ceo_receptor.sdf')
+        self.ligand = Complex.io.from_sdf(path=f'{fixtures_dir}/5ceo_ligand.sdf')
+        self.preliminary = [Complex.io.from_sdf(path=f'{fixtures_dir}/5ceo_ligand.sdf')]
+
+    def tearDown(self):
+        self.plugin.workspace.cleanup()
+
+    def test_coarse_pass_then_refined_in_place(self):
+        self.plugin._run_job = AsyncMock(side_effect=[self.preliminary, []])
+        loop = asyncio.get_event_loop()
+        result = loop.run_until_complete(
+            self.plugin.run_docking(self.receptor, [self.ligand], self.receptor, {'modes': 5}))
+        self.assertEqual(result, self.preliminary)
+        loop.run_until_complete(self.plugin.refine_task)
+
+        coarse_call, refine_call = self.plugin._run_job.call_args_list
+        coarse_params = coarse_call[0][3]
+        self.assertEqual(coarse_params['exhaustiveness'], PROGRESSIVE_EXHAUSTIVENESS)
+        self.assertEqual(coarse_params['progressive_pass'], 'coarse')
+        self.assertEqual(refine_call[0][3]['exhaustiveness'], 10)
+        self.assertIs(refine_call[1]['replace'], self.preliminary)
+
+    def test_new_run_cancels_refinement(self):
+        async def run_job(*args, replace=None):
+            if replace:
+                await asyncio.sleep(60)
+            return self.preliminary
+        self.plugin._run_job = run_job
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.plugin.run_docking(self.receptor, [self.ligand], self.receptor, {'modes': 5}))
+        first_refine_task = self.plugin.refine_task
+        loop.run_until_complete(self.plugin.run_docking(self.receptor, [self.ligand], self.receptor, {'modes': 5}))
+        loop.run_until_complete(asyncio.sleep(0))
+        self.assertTrue(first_refine_task.done())
+        self.plugin.cancel_refinement()
+        loop.run_until_complete(asyncio.gather(self.plugin.refine_task, return_exceptions=True))
+
+    @patch('nanome.api.plugin_instance.PluginInstance.update_structures_shallow')
+    @patch('nanome.api.plugin_instance.PluginInstance.request_complexes')
+    @patch('nanome.api.plugin_instance.PluginInstance.update_structures_deep')
+    @patch('nanome.api.plugin_instance.PluginInstance.request_complex_list')
+    def test_replace_results_keeps_index(self, request_complex_list_mock, update_deep_mock, request_complexes_mock, _):
+        self.preliminary[0].index = 42
+        refined = Complex.io.from_sdf(path=f'{fixtures_dir}/5ceo_ligand.sdf')
+        request_complex_list_mock.return_value = self._future(self.preliminary)
+        update_deep_mock.return_value = self._future(None)
+        request_complexes_mock.return_value = self._future([refined])
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.plugin.replace_results([refined], self.preliminary, self.receptor, self.receptor))
+        self.assertEqual(refined.index, 42)
+        update_deep_mock.assert_called_once_with([refined])
+        request_complexes_mock.assert_called_once_with([42])
+
+    @staticmethod
+    def _future(result):
+        fut = asyncio.Future()
+        fut.set_result(result)
+        return fut
+
+
+class PreviewScoresTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = SminaDocking()
+        self.plugin._network = MagicMock()
+        self.plugin.update_loading_bar = MagicMock()
+        self.receptor = Complex.io.from_sdf(path=f'{fixtures_dir}/5ceo_receptor.sdf')
+        self.ligand = Complex.io.from_sdf(path=f'{fixtures_dir}/5ceo_ligand.sdf')
+        self.ligand.index = 2
+        # Smina output for the ligand, with a score for every atom.
+        with open(f'{fixtures_dir}/5ceo_ligand.sdf') as f:
+            sdf = f.read().rstrip('\n')
+        terms = ' '.join(f'<0,0,0> C 0 0 0 {-0.1 * i:.3f}' for i in range(32))
+        sdf += f'\n\n> <minimizedAffinity>\n-7.5\n\n> <atomic_interaction_terms>\n{terms}\n\n$$$$\n'
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.output_sdf = os.path.join(self.temp_dir.name, 'preview.sdf')
+        with open(self.output_sdf, 'w') as f:
+            f.write(sdf)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+        self.plugin.workspace.cleanup()
+        self.plugin.complex_list_refresher.cancel()
+        asyncio.get_event_loop().run_until_complete(self.plugin.complex_list_refresher.wait())
+
+    @staticmethod
+    def _future(result):
+        fut = asyncio.Future()
+        fut.set_result(result)
+        return fut
+
+    @patch('nanome.api.plugin_instance.PluginInstance.update_structures_shallow')
+    @patch('nanome.api.plugin_instance.PluginInstance.update_structures_deep')
+    @patch('nanome.api.plugin_instance.PluginInstance.request_complex_list')
+    @patch('nanome.api.plugin_instance.PluginInstance.add_to_workspace')
+    @patch('nanome.api.plugin_instance.PluginInstance.request_complexes')
+    def test_preview_added_then_replaced(
+            self, request_complexes_mock, add_to_workspace_mock, request_complex_list_mock, update_deep_mock, _):
+        calculations = self.plugin._calculations
+        calculations.score_poses = AsyncMock(return_value=[self.output_sdf])
+
+        async def add_to_workspace(complexes):
+            for comp in complexes:
+                comp.index = 30
+            return complexes
+        add_to_workspace_mock.side_effect = add_to_workspace
+        request_complexes_mock.return_value = self._future([self.receptor, self.ligand])
+
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(self.plugin.preview_scores(self.receptor, [self.ligand], minimize=True))
+        self.assertEqual(results[0].full_name, f'{self.ligand.full_name} (Minimized)')
+        self.assertEqual(next(results[0].molecules).associateds[0]['Minimized Affinity'], '-7.5')
+        self.assertEqual(calculations.score_poses.call_args[1]['minimize'], True)
+        self.assertEqual(self.plugin.preview_complexes[2].index, 30)
+        update_deep_mock.assert_not_called()
+
+        # Scoring the same ligand again updates its preview complex instead of adding another one.
+        preview = self.plugin.preview_complexes[2]
+        request_complex_list_mock.return_value = self._future([self.receptor, self.ligand, preview])
+        update_deep_mock.return_value = self._future(None)
+        request_complexes_mock.side_effect = [
+            self._future([self.receptor, self.ligand]), self._future([preview])]
+        results = loop.run_until_complete(self.plugin.preview_scores(self.receptor, [self.ligand]))
+        self.assertEqual(add_to_workspace_mock.call_count, 1)
+        self.assertEqual(results[0].index, 30)
+        self.assertEqual(results[0].full_name, f'{self.ligand.full_name} (Scored)')
+
+
+class EnsembleDockingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = SminaDocking()
+        self.plugin._network = MagicMock()
+        self.plugin.update_loading_bar = MagicMock()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.scratch = ScratchSpace(root=self.temp_dir.name).job()
+        self.receptors = []
+        for index, name in enumerate(['conformer_a', 'conformer_b']):
+            receptor = Complex()
+            receptor.index = index
+            receptor.name = name
+            self.receptors.append(receptor)
+
+    def tearDown(self):
+        self.scratch.cleanup()
+        self.temp_dir.cleanup()
+        self.plugin.workspace.cleanup()
+
+    def _output_sdf(self, name, scores):
+        output_sdf = os.path.join(self.temp_dir.name, f'{name}.sdf')
+        with open(output_sdf, 'w') as f:
+            for score in scores:
+                f.write(f'{name}\n  smina\n\nM  END\n> <minimizedAffinity>\n{score}\n\n$$$$\n')
+        return output_sdf
+
+    def test_poses_ranked_across_receptors(self):
+        outputs = {
+            'receptor_a.pdb': [self._output_sdf('a', [-6.0, -4.0])],
+            'receptor_b.pdb': [self._output_sdf('b', [-8.0, -5.0])],
+        }
+
+        async def start_docking(engine, receptor_pdb, *args, **kwargs):
+            return outputs[receptor_pdb]
+
+        engine_class = self.plugin._calculations.__class__
+        engines = []
+        with patch.object(engine_class, 'start_docking', autospec=True, side_effect=start_docking):
+            loop = asyncio.get_event_loop()
+            merged_sdfs = loop.run_until_complete(self.plugin._dock_ensemble(
+                engines, self.receptors, list(outputs), ['ligand.pdb'], None, self.scratch, 60, {'modes': 3}))
+
+        self.assertEqual(len(engines), 2)
+        self.assertIsNot(engines[0], engines[1])
+        records = list(iter_sdf_records(merged_sdfs[0]))
+        self.assertEqual([sdf_property(record, 'minimizedAffinity') for record in records], ['-8.0', '-6.0', '-5.0'])
+        self.assertEqual(
+            [sdf_property(record, 'receptor') for record in records], ['conformer_b', 'conformer_a', 'conformer_b'])
+
+    def test_modes_kept_per_frame(self):
+        # Two frames of one ligand, with two poses each.
+        outputs = {
+            'receptor_a.pdb': [self._output_sdf('a', [-9.0, -8.0, -5.0, -4.0])],
+            'receptor_b.pdb': [self._output_sdf('b', [-7.0, -6.0, -6.5, -3.0])],
+        }
+
+        async def start_docking(engine, receptor_pdb, *args, **kwargs):
+            return outputs[receptor_pdb]
+
+        engine_class = self.plugin._calculations.__class__
+        with patch.object(engine_class, 'start_docking', autospec=True, side_effect=start_docking):
+            loop = asyncio.get_event_loop()
+            merged_sdfs = loop.run_until_complete(self.plugin._dock_ensemble(
+                [], self.receptors, list(outputs), ['ligand.pdb'], None, self.scratch, 60, {'modes': 2}))
+        records = list(iter_sdf_records(merged_sdfs[0]))
+        self.assertEqual([sdf_property(record, 'minimizedAffinity') for record in records], ['-9.0', '-8.0', '-6.5', '-5.0'])
+
+    def test_timed_out_receptor_skipped(self):
+        output_sdf = self._output_sdf('a', [-6.0])
+
+        async def start_docking(engine, receptor_pdb, *args, **kwargs):
+            if receptor_pdb == 'receptor_b.pdb':
+                raise TimeoutError
+            return [output_sdf]
+
+        engine_class = self.plugin._calculations.__class__
+        with patch.object(engine_class, 'start_docking', autospec=True, side_effect=start_docking):
+            loop = asyncio.get_event_loop()
+            merged_sdfs = loop.run_until_complete(self.plugin._dock_ensemble(
+                [], self.receptors, ['receptor_a.pdb', 'receptor_b.pdb'], ['ligand.pdb'], None, self.scratch, 60, {}))
+        records = list(iter_sdf_records(merged_sdfs[0]))
+        self.assertEqual([sdf_property(record, 'receptor') for record in records], ['conformer_a'])
+
+
+class PartialPosesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = SminaDocking()
+        self.plugin._network = MagicMock()
+        self.plugin.update_loading_bar = MagicMock()
+        self.plugin.job_store = MagicMock()
+        self.receptor = Complex.io.from_sdf(path=f'{fixtures_dir}/5ceo_receptor.sdf')
+        self.ligand = Complex.io.from_sdf(path=f'{fixtures_dir}/5ceo_ligand.sdf')
+        # Smina output for the first frame of the ligand.
+        with open(f'{fixtures_dir}/5ceo_ligand.sdf') as f:
+            sdf = f.read().rstrip('\n')
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.partial_sdf = os.path.join(self.temp_dir.name, 'partial.sdf')
+        with open(self.partial_sdf, 'w') as f:
+            terms = ' '.join('<0,0,0> C 0 0 0 0' for _ in range(32))
+            f.write(f'{sdf}\n\n> <minimizedAffinity>\n-7.5\n\n> <atomic_interaction_terms>\n{terms}\n\n$$$$\n')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+        self.plugin.workspace.cleanup()
+        self.plugin.complex_list_refresher.cancel()
+        asyncio.get_event_loop().run_until_complete(self.plugin.complex_list_refresher.wait())
+
+    @staticmethod
+    def _future(result):
+        fut = asyncio.Future()
+        fut.set_result(result)
+        return fut
+
+    def _run_job(self, error):
+        partial_sdf = self.partial_sdf
+
+        class Engine:
+            exit_codes = []
+
+            async def start_docking(self, receptor_pdb, ligand_pdbs, site_box, scratch, on_poses=None, **kwargs):
+                await on_poses(ligand_pdbs[0], partial_sdf)
+                raise error
+
+        async def add_to_workspace(complexes):
+            for comp in complexes:
+                comp.index = 30
+            return complexes
+
+        self.plugin._create_engine = lambda host: Engine()
+        with patch('nanome.api.plugin_instance.PluginInstance.request_complexes') as request_complexes_mock, \
+                patch('nanome.api.plugin_instance.PluginInstance.add_to_workspace', side_effect=add_to_workspace), \
+                patch('nanome.api.plugin_instance.PluginInstance.update_structures_shallow'), \
+                patch('nanome.api.plugin_instance.PluginInstance.remove_from_workspace') as remove_mock:
+            request_complexes_mock.return_value = self._future([self.receptor, self.receptor, self.ligand])
+            loop = asyncio.get_event_loop()
+            if isinstance(error, TimeoutError):
+                loop.run_until_complete(self.plugin._run_job(self.receptor, [self.ligand], self.receptor, {'modes': 1}))
+            else:
+                with self.assertRaises(type(error)):
+                    loop.run_until_complete(self.plugin._run_job(self.receptor, [self.ligand], self.receptor, {'modes': 1}))
+        return remove_mock
+
+    def test_partial_poses_removed_on_timeout(self):
+        remove_mock = self._run_job(TimeoutError())
+        removed = remove_mock.call_args[0][0]
+        self.assertEqual([comp.index for comp in removed], [30])
+        self.assertEqual(self.plugin.job_store.append.call_args[0][0].status, 'timeout')
+
+    def test_partial_poses_removed_on_error(self):
+        remove_mock = self._run_job(RuntimeError('engine failed'))
+        self.assertEqual([comp.index for comp in remove_mock.call_args[0][0]], [30])
+
+
+class SessionJobDockingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = SminaDocking()
+        self.plugin._network = MagicMock()
+        self.plugin.update_menu = MagicMock()
+        self.plugin.update_content = MagicMock()
+        self.plugin.update_node = MagicMock()
+        self.plugin.job_store = MagicMock()
+        self.plugin.settings_menu.get_settings = MagicMock(return_value={'exhaustiveness': 8})
+        self.receptor = Complex.io.from_sdf(path=f'{fixtures_dir}/5ceo_receptor.sdf')
+        self.ligand = Complex.io.from_sdf(path=f'{fixtures_dir}/5ceo_ligand.sdf')
+
+    def tearDown(self):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.plugin.jobs.wait())
+        self.plugin.job_list_refresher.cancel()
+        loop.run_until_complete(self.plugin.job_list_refresher.wait())
+        self.plugin.workspace.cleanup()
+
+    def test_jobs_run_side_by_side(self):
+        release = asyncio.Event()
+        running_hosts = []
+
+        async def run_docking_job(
+                job, scratch, workspace, engines, placeholders, receptor, ligands, site, params, replace, host):
+            running_hosts.append(host)
+            host.update_loading_bar(len(running_hosts), 4)
+            await release.wait()
+            job.finish('success')
+            return [receptor]
+
+        self.plugin._run_docking_job = run_docking_job
+        loop = asyncio.get_event_loop()
+        first = self.plugin.start_job([self.receptor], [self.ligand], self.receptor, {'modes': 1})
+        second = self.plugin.start_job([self.receptor], [self.ligand], self.receptor, {'modes': 1})
+        loop.run_until_complete(asyncio.sleep(0.01))
+
+        # Both jobs dock at the same time, each reporting to its own progress.
+        self.assertEqual(running_hosts, [first, second])
+        self.assertEqual((first.progress, second.progress), (0.25, 0.5))
+        self.assertEqual([job.status for job in self.plugin.jobs], ['running', 'running'])
+
+        second.cancel()
+        release.set()
+        loop.run_until_complete(self.plugin.jobs.wait())
+        self.assertEqual(first.status, 'success')
+        self.assertEqual(first.results, [self.receptor])
+        self.assertEqual(second.status, 'cancelled')
+        self.assertEqual(self.plugin.job_store.append.call_count, 2)
+
+    def test_overlapping_jobs_count_own_cache_hits(self):
+        first_built = asyncio.Event()
+        release = asyncio.Event()
+
+        async def run_docking_job(
+                job, scratch, workspace, engines, placeholders, receptor, ligands, site, params, replace, host):
+            job.params = params
+            write = partial(self._write, 'grid')
+            if params['modes'] == 1:
+                workspace.artifact('grid', ['receptor'], write)
+                first_built.set()
+                await release.wait()
+            else:
+                await first_built.wait()
+                # Reuses the grid of the first job, which is still running.
+                workspace.artifact('grid', ['receptor'], write)
+                workspace.artifact('grid', ['other receptor'], write)
+                workspace.artifact('grid', ['other receptor'], write)
+                release.set()
+            job.finish('success')
+            return []
+
+        self.plugin._run_docking_job = run_docking_job
+        loop = asyncio.get_event_loop()
+        self.plugin.start_job([self.receptor], [self.ligand], self.receptor, {'modes': 1})
+        self.plugin.start_job([self.receptor], [self.ligand], self.receptor, {'modes': 2})
+        loop.run_until_complete(self.plugin.jobs.wait())
+
+        records = {call.args[0].params['modes']: call.args[0] for call in self.plugin.job_store.append.call_args_list}
+        self.assertEqual((records[1].cache_hits, records[1].cache_misses), (0, 1))
+        self.assertEqual((records[2].cache_hits, records[2].cache_misses), (2, 1))
+
+    @staticmethod
+    def _write(text, path):
+        with open(path, 'w') as f:
+            f.write(text)
@@ -0,0 +1,76 @@
+import unittest
+import asyncio
+from unittest.mock import MagicMock
+
+from nanome.api.structure import Complex
+
+from plugin.Docking import SminaDocking
+
+
+def make_complex(index, name):
+    comp = Complex()
+    comp.index = index
+    comp.name = name
+    return comp
+
+
+class DockingMenuTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = SminaDocking()
+        self.plugin.start()
+        self.plugin._network = MagicMock()
+        self.plugin.update_content = MagicMock()
+        self.plugin.update_menu = MagicMock()
+        self.menu = self.plugin.menu
+
+    def tearDown(self):
+        self.plugin.workspace.cleanup()
+
+    def test_unchanged_complex_list_sends_nothing(self):
+        complexes = [make_complex(i, f'comp{i}') for i in range(3)]
+        self.menu.change_complex_list(complexes)
+        self.menu.change_complex_list([make_complex(i, f'comp{i}') for i in range(3)])
+        self.assertEqual(self.plugin.update_content.call_count, 1)
+        self.plugin.update_menu.assert_not_called()
+
+    def test_items_reused_and_selection_kept(self):
+        complexes = [make_complex(i, f'comp{i}') for i in range(3)]
+        self.menu.change_complex_list(complexes)
+        ligand_item = self.menu.dd_ligands.items[1]
+        self.menu._selected_ligands = [complexes[1]]
+        self.menu._selected_receptor = complexes[2]
+
+        # Remove complex 0, add complex 3
+        new_complexes = [make_complex(i, f'comp{i}') for i in range(1, 4)]
+        self.menu.change_complex_list(new_complexes)
+        self.assertEqual([item.complex.index for item in self.menu.dd_ligands.items], [1, 2, 3])
+        self.assertIs(self.menu.dd_ligands.items[0], ligand_item)
+        self.assertTrue(ligand_item.selected)
+        self.assertEqual([comp.index for comp in self.menu._selected_ligands], [1])
+        self.assertEqual(self.menu._selected_receptor.index, 2)
+        self.assertTrue(self.menu.dd_receptor.items[1].selected)
+
+        # Removing the selected receptor clears it.
+        self.menu.change_complex_list(new_complexes[:1])
+        self.assertIsNone(self.menu._selected_receptor)
+
+    def test_multiple_receptors_run_ensemble_docking(self):
+        complexes = [make_complex(i, f'comp{i}') for i in range(3)]
+        self.menu.change_complex_list(complexes)
+        for item in self.menu.dd_receptor.items[:2]:
+            self.menu.handle_receptor_selected(self.menu.dd_receptor, item)
+        self.assertEqual([comp.index for comp in self.menu._selected_receptors], [0, 1])
+        self.assertEqual(self.menu._selected_receptor.index, 0)
+
+        self.menu._selected_ligands = [complexes[2]]
+        self.menu._selected_site = complexes[0]
+        self.plugin.start_job = MagicMock()
+        asyncio.get_event_loop().run_until_complete(self.menu._run_docking())
+        receptors = self.plugin.start_job.call_args[0][0]
+        self.assertEqual([comp.index for comp in receptors], [0, 1])
+
+        # Deselecting one receptor goes back to regular docking.
+        self.menu.handle_receptor_selected(self.menu.dd_receptor, self.menu.dd_receptor.items[1])
+        asyncio.get_event_loop().run_until_complete(self.menu._run_docking())
+        self.assertEqual([comp.index for comp in self.plugin.start_job.call_args[0][0]], [0])
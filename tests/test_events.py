@@ -0,0 +1,55 @@
+import asyncio
+import unittest
+
+from plugin.events import EventCoalescer
+
+
+class EventCoalescerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.calls = []
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    async def _callback(self):
+        self.calls.append('started')
+        await asyncio.sleep(0.05)
+        self.calls.append('finished')
+
+    def test_burst_coalesced(self):
+        coalescer = EventCoalescer(self._callback, delay=0.01)
+
+        async def burst():
+            for _ in range(50):
+                coalescer.trigger()
+            await coalescer.wait()
+        self.loop.run_until_complete(burst())
+        self.assertEqual(self.calls, ['started', 'finished'])
+
+    def test_newer_trigger_cancels_in_flight(self):
+        coalescer = EventCoalescer(self._callback, delay=0.01)
+
+        async def superseded():
+            coalescer.trigger()
+            await asyncio.sleep(0.03)
+            coalescer.trigger()
+            await coalescer.wait()
+        self.loop.run_until_complete(superseded())
+        self.assertEqual(self.calls, ['started', 'started', 'finished'])
+
+    def test_suppress(self):
+        coalescer = EventCoalescer(self._callback, delay=0.01)
+
+        async def own_additions():
+            with coalescer.suppress():
+                for _ in range(10):
+                    coalescer.trigger()
+                await asyncio.sleep(0.05)
+                self.assertEqual(self.calls, [])
+            await coalescer.wait()
+        self.loop.run_until_complete(own_additions())
+        self.assertEqual(self.calls, ['started', 'finished'])
@@ -0,0 +1,63 @@
+import json
+import os
+import tempfile
+import unittest
+
+from plugin.job_store import DEFAULT_JOB_HISTORY_DIR, JobRecord, JobStore, percentile, size_bucket
+
+
+class JobStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.store = JobStore(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _record(self, algorithm='smina', frame_count=1, duration=1.0, status='success'):
+        record = JobRecord(algorithm, inputs={'ligand_frame_count': frame_count})
+        with record.stage('docking'):
+            pass
+        record.finish(status)
+        record.finished_at = record.started_at + duration
+        return record
+
+    def test_append_and_query(self):
+        self.store.append(self._record('smina'))
+        self.store.append(self._record('autodock4', status='timeout'))
+        self.assertEqual(len(self.store.query()), 2)
+        self.assertEqual(len(self.store.query(algorithm='smina')), 1)
+        timed_out = self.store.query(status='timeout')
+        self.assertEqual(timed_out[0]['algorithm'], 'autodock4')
+        self.assertIn('docking', timed_out[0]['stages'])
+
+    def test_rotation_keeps_history(self):
+        line_size = len(json.dumps(self._record().to_dict())) + 1
+        store = JobStore(self.temp_dir.name, max_bytes=int(line_size * 2.5), backup_count=2)
+        for _ in range(5):
+            store.append(self._record())
+        self.assertTrue(os.path.exists(f'{store.path}.1'))
+        self.assertTrue(os.path.exists(f'{store.path}.2'))
+        self.assertFalse(os.path.exists(f'{store.path}.3'))
+        self.assertEqual(len(store.query()), 5)
+
+    def test_latency_report(self):
+        for duration in range(1, 21):
+            self.store.append(self._record('smina', frame_count=3, duration=duration))
+        self.store.append(self._record('smina', frame_count=3, duration=500, status='error'))
+        report = self.store.latency_report()
+        self.assertEqual(len(report), 1)
+        row = report[0]
+        self.assertEqual(row['size_bucket'], '2-4')
+        self.assertEqual(row['count'], 20)
+        self.assertEqual(row['p50'], 10)
+        self.assertEqual(row['p95'], 19)
+
+    def test_helpers(self):
+        self.assertIsNone(percentile([], 50))
+        self.assertEqual(size_bucket(1), '1')
+        self.assertEqual(size_bucket(100), '65+')
+
+    def test_tests_keep_history_out_of_home(self):
+        self.assertNotEqual(JobStore().directory, DEFAULT_JOB_HISTORY_DIR)
@@ -0,0 +1,38 @@
+import unittest
+from unittest.mock import MagicMock
+
+from plugin.job_store import JobRecord
+from plugin.jobs import SessionJobs
+
+
+class SessionJobsTestCase(unittest.TestCase):
+
+    def test_jobs_have_own_progress_and_status(self):
+        on_change = MagicMock()
+        jobs = SessionJobs(on_change=on_change)
+        first = jobs.create('ligand to receptor')
+        second = jobs.create('ligand to receptor')
+        self.assertEqual((first.job_id, second.job_id), (1, 2))
+
+        first.update_loading_bar(5, 10)
+        second.update_run_btn_text('Running... (1/4)')
+        self.assertEqual(first.progress, 0.5)
+        self.assertEqual(second.progress, 0.0)
+        self.assertEqual(second.detail, 'Running... (1/4)')
+        on_change.assert_called_with(second)
+
+        record = JobRecord('smina')
+        record.finish('success')
+        first.add_record(record, refining=True)
+        self.assertEqual(first.status, 'refining')
+        first.add_record(record)
+        self.assertEqual(first.status, 'success')
+        self.assertEqual(jobs.running(), [second])
+
+    def test_oldest_finished_jobs_dropped(self):
+        jobs = SessionJobs(max_finished=2)
+        running = jobs.create('running')
+        for i in range(3):
+            jobs.create(f'job {i}').finish('success')
+        self.assertEqual([job.description for job in jobs], ['running', 'job 1', 'job 2'])
+        self.assertIs(jobs.get(running.job_id), running)
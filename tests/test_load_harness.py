@@ -0,0 +1,19 @@
+import asyncio
+import unittest
+
+from tests.load_harness import run_load_test
+
+
+class LoadHarnessTestCase(unittest.TestCase):
+
+    def test_sessions_run_side_by_side(self):
+        loop = asyncio.get_event_loop()
+        report = loop.run_until_complete(run_load_test(
+            sessions=2, ligand_counts=(1, 2), runs=2, latency=0.001, seconds_per_frame=0.01, stagger=0.05))
+        summary = report.summary()
+        self.assertEqual(summary['jobs'], 4)
+        self.assertEqual(summary['job_statuses'], {'success': 4})
+        # Every job uploads its results once, in a single chunk.
+        self.assertEqual(summary['message_types']['add_to_workspace'], 4)
+        self.assertGreater(summary['job_latency']['p50'], 0)
+        self.assertTrue(report.loop_lags)
@@ -0,0 +1,43 @@
+import json
+import os
+import tempfile
+import unittest
+
+from plugin.profiling import profile_job
+
+
+class ProfileJobTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.profile_dir = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_writes_profile_and_memory(self):
+        with profile_job('job1', self.profile_dir) as job_dir:
+            data = [bytearray(1024) for _ in range(1000)]
+            # Jobs started while one is profiled are not.
+            with profile_job('job2', self.profile_dir) as nested_dir:
+                self.assertIsNone(nested_dir)
+            del data
+        self.assertTrue(job_dir.endswith('_job1'))
+        self.assertEqual(sorted(os.listdir(job_dir)), ['memory.json', 'profile.prof', 'profile.txt'])
+        with open(os.path.join(job_dir, 'memory.json')) as f:
+            memory = json.load(f)
+        self.assertGreater(memory['peak_bytes'], 1000 * 1024)
+        self.assertTrue(memory['top_allocations'])
+        self.assertEqual(os.listdir(self.profile_dir), [os.path.basename(job_dir)])
+
+    def test_disabled(self):
+        with profile_job('job1', profile_dir=None) as job_dir:
+            self.assertIsNone(job_dir)
+
+    def test_oldest_profiles_removed(self):
+        for old_job in ['20000101-000000_a', '20000101-000001_b']:
+            os.makedirs(os.path.join(self.profile_dir, old_job))
+        with profile_job('job1', self.profile_dir, keep=2) as job_dir:
+            pass
+        self.assertEqual(
+            sorted(os.listdir(self.profile_dir)), ['20000101-000001_b', os.path.basename(job_dir)])
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from plugin import scratch as scratch_module
+from plugin.scratch import ScratchQuotaExceeded, ScratchSpace
+
+
+class ScratchSpaceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.space = ScratchSpace(
+            root=self.temp_dir.name, job_quota_mb=1, host_quota_mb=2, host_usage_interval=0)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_files_removed_on_exit(self):
+        with self.space.job() as scratch:
+            path = scratch.file(suffix='.sdf')
+            output_dir = scratch.mkdir(prefix='vina_')
+            self.assertTrue(path.endswith('.sdf'))
+            self.assertTrue(os.path.isdir(output_dir))
+            with open(path, 'w') as f:
+                f.write('x' * 100)
+        self.assertFalse(os.path.exists(scratch.path))
+        self.assertEqual(scratch.peak_bytes, 100)
+
+    def test_job_quota(self):
+        with self.space.job() as scratch:
+            with open(scratch.file(), 'wb') as f:
+                f.write(b'x' * (1024 * 1024 + 1))
+            with self.assertRaises(ScratchQuotaExceeded):
+                scratch.file()
+
+    def test_host_quota(self):
+        jobs = [self.space.job() for _ in range(3)]
+        for scratch in jobs:
+            with open(scratch.file(), 'wb') as f:
+                f.write(b'x' * 1024 * 1024)
+        with self.assertRaises(ScratchQuotaExceeded):
+            jobs[0].file()
+        for scratch in jobs:
+            scratch.cleanup()
+        self.assertEqual(self.space.usage(), 0)
+
+    def test_host_usage_reused_within_interval(self):
+        self.space.host_usage_interval = 60
+        scratch = self.space.job()
+        with mock.patch.object(scratch_module, 'path_size', wraps=scratch_module.path_size) as path_size:
+            for _ in range(5):
+                scratch.file()
+        host_walks = [call for call in path_size.call_args_list if call.args[0] == self.space.root]
+        self.assertEqual(len(host_walks), 1)
+        # Explicit measurements are always fresh.
+        with open(scratch.file(), 'wb') as f:
+            f.write(b'x' * 100)
+        self.assertEqual(self.space.usage(), 100)
+        scratch.cleanup()
+
+    def test_peak_includes_output_written_after_allocation(self):
+        with self.space.job() as scratch:
+            path = scratch.file()
+            with open(path, 'wb') as f:
+                f.write(b'x' * 100)
+            with open(path, 'ab') as f:
+                f.write(b'x' * 100)
+            scratch.usage()
+        self.assertEqual(scratch.peak_bytes, 200)
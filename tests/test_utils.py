@@ -0,0 +1,136 @@
+import os
+import tempfile
+import unittest
+
+from nanome.api.structure import Complex
+
+from plugin.utils import (
+    SdfTailer, SiteBox, get_complex_center, get_pdbqt_atom_types, get_pdbqt_model_count, iter_sdf_records,
+    merge_ranked_sdfs, sdf_property, split_sdf_by_title, split_sdf_frames)
+
+fixtures_dir = os.path.join(os.getcwd(), 'tests', 'fixtures')
+
+PDBQT_LINES = [
+    'REMARK  Name = ligand',
+    'ATOM      1  C1  LIG A   1      10.000  11.000  12.000  0.00  0.00    +0.010 C ',
+    'ATOM      2  N1  LIG A   1      10.500  11.000  12.000  0.00  0.00    -0.300 NA',
+    'HETATM    3  O1  LIG A   1      11.000  11.000  12.000  0.00  0.00    -0.400 OA',
+    'ATOM      4  H1  LIG A   1      11.500  11.000  12.000  0.00  0.00    +0.200 HD',
+]
+
+
+class UtilsTestCase(unittest.TestCase):
+
+    def test_get_pdbqt_atom_types(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.pdbqt', delete=False) as f:
+            f.write('\n'.join(PDBQT_LINES))
+        try:
+            self.assertEqual(get_pdbqt_atom_types(f.name), {'C', 'NA', 'OA', 'HD'})
+        finally:
+            os.remove(f.name)
+
+    def test_split_sdf_by_title(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ligands = [os.path.join(temp_dir, 'ligand_a.pdb'), os.path.join(temp_dir, 'ligand_b.pdb')]
+            records = [self._sdf_record(ligands[0]), self._sdf_record(ligands[1]), self._sdf_record(ligands[0])]
+            sdf_file = os.path.join(temp_dir, 'output.sdf')
+            with open(sdf_file, 'w') as f:
+                f.write(''.join(records))
+
+            split_files = split_sdf_by_title(sdf_file, ligands, temp_dir)
+            self.assertEqual(len(list(iter_sdf_records(split_files[ligands[0]]))), 2)
+            self.assertEqual(len(list(iter_sdf_records(split_files[ligands[1]]))), 1)
+            self.assertIsNone(split_sdf_by_title(sdf_file, ligands[:1], temp_dir))
+
+    def test_site_box_from_complex(self):
+        site = Complex.io.from_sdf(path=f'{fixtures_dir}/5ceo_ligand.sdf')
+        site_box = SiteBox.from_complex(site)
+        self.assertEqual(site_box.center.unpack(), get_complex_center(site).unpack())
+        for atom in site.atoms:
+            for coord, low, high in zip(atom.position.unpack(), site_box.min_pos.unpack(), site_box.max_pos.unpack()):
+                self.assertTrue(low <= coord <= high)
+        self.assertEqual(site_box.key(), SiteBox.from_complex(site).key())
+
+    def test_merge_ranked_sdfs(self):
+        def scored_record(title, score):
+            return self._sdf_record(title).replace('$$$$', f'> <minimizedAffinity>\n{score}\n\n$$$$')
+
+        def pose_score(record):
+            score = sdf_property(record, 'minimizedAffinity')
+            return float(score) if score else None
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            sources = []
+            for tag, records in [('rec_a', [scored_record('a1', -5.0), self._sdf_record('a2')]),
+                                 ('rec_b', [scored_record('b1', -7.5), scored_record('b2', -6.0)])]:
+                sdf_file = os.path.join(temp_dir, f'{tag}.sdf')
+                with open(sdf_file, 'w') as f:
+                    f.write(''.join(records))
+                sources.append((tag, sdf_file))
+
+            merged_file = merge_ranked_sdfs(sources, os.path.join(temp_dir, 'merged.sdf'), pose_score)
+            merged = list(iter_sdf_records(merged_file))
+            self.assertEqual([record.split('\n', 1)[0] for record in merged], ['b1', 'b2', 'a1', 'a2'])
+            self.assertEqual(
+                [sdf_property(record, 'receptor') for record in merged], ['rec_b', 'rec_b', 'rec_a', 'rec_a'])
+            self.assertTrue(all(record.endswith('$$$$\n') for record in merged))
+
+            merge_ranked_sdfs(sources, merged_file, pose_score, limit=2)
+            self.assertEqual(len(list(iter_sdf_records(merged_file))), 2)
+
+    def test_merge_ranked_sdfs_per_frame(self):
+        def scored_record(title, score):
+            return self._sdf_record(title).replace('$$$$', f'> <minimizedAffinity>\n{score}\n\n$$$$')
+
+        def pose_score(record):
+            return float(sdf_property(record, 'minimizedAffinity'))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            sources = []
+            # Two poses for each of the two frames of a ligand, docked against two receptors.
+            for tag, scores in [('rec_a', [-9.0, -8.0, -5.0, -4.0]), ('rec_b', [-7.0, -6.0, -6.5, -3.0])]:
+                sdf_file = os.path.join(temp_dir, f'{tag}.sdf')
+                with open(sdf_file, 'w') as f:
+                    f.write(''.join(scored_record(f'{tag}_{score}', score) for score in scores))
+                sources.append((tag, sdf_file))
+
+            merged_file = merge_ranked_sdfs(sources, os.path.join(temp_dir, 'merged.sdf'), pose_score, limit=2)
+            merged = list(iter_sdf_records(merged_file))
+            # The best frame doesn't crowd out the poses of the other one.
+            self.assertEqual([pose_score(record) for record in merged], [-9.0, -8.0, -6.5, -5.0])
+            self.assertEqual(
+                [sdf_property(record, 'receptor') for record in merged], ['rec_a', 'rec_a', 'rec_b', 'rec_a'])
+
+    def test_split_sdf_frames(self):
+        frames = split_sdf_frames([-3.0, -2.0, -4.0, -1.0, -0.5, None], lambda score: score, modes=2)
+        self.assertEqual(frames, [[-3.0, -2.0], [-4.0, -1.0], [-0.5, None]])
+
+    @staticmethod
+    def _sdf_record(title):
+        return f'{title}\n  smina\n\n  0  0  0  0  0  0  0  0  0  0999 V2000\nM  END\n$$$$\n'
+
+    def test_get_pdbqt_model_count(self):
+        models = ['MODEL 1', *PDBQT_LINES[1:], 'ENDMDL', 'MODEL 2', *PDBQT_LINES[1:], 'ENDMDL']
+        for lines, expected in [(PDBQT_LINES, 1), (models, 2), ([], 0)]:
+            with tempfile.NamedTemporaryFile('w', suffix='.pdbqt', delete=False) as f:
+                f.write('\n'.join(lines))
+            try:
+                self.assertEqual(get_pdbqt_model_count(f.name), expected)
+            finally:
+                os.remove(f.name)
+
+    def test_sdf_tailer(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            sdf_file = os.path.join(temp_dir, 'output.sdf')
+            tailer = SdfTailer(sdf_file)
+            self.assertEqual(tailer.read_records(), [])
+
+            record = self._sdf_record('ligand')
+            with open(sdf_file, 'w') as f:
+                f.write(record + record[:-3])
+            self.assertEqual(tailer.read_records(), [record])
+            # Record is only returned once its delimiter line is complete.
+            self.assertEqual(tailer.read_records(), [])
+            with open(sdf_file, 'a') as f:
+                f.write('$$\n')
+            self.assertEqual(tailer.read_records(), [record])
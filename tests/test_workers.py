@@ -0,0 +1,205 @@
+import asyncio
+import os
+import stat
+import sys
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from nanome.util import Vector3
+
+from plugin.scratch import ScratchSpace
+from plugin.smina.calculations import DockingCalculations
+from plugin.utils import SiteBox
+from plugin.workers import (
+    ENGINE_FLAGS, TIMEOUT_CODE, Worker, WorkerPool, encode_file, engine_args, read_message, send_message)
+
+# Stands in for smina: prints a loading bar, and copies the ligand file to the output file.
+FAKE_ENGINE = f"""#!{sys.executable}
+import sys, time
+def arg(name, default=None):
+    return sys.argv[sys.argv.index(name) + 1] if name in sys.argv else default
+time.sleep(float(arg('--sleep', 0)))
+print('*' * 51, flush=True)
+with open(arg('-l')) as f, open(arg('--out'), 'w') as out:
+    out.write(f.read())
+"""
+
+
+class WorkerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.engine = os.path.join(self.temp_dir.name, 'fake_engine')
+        with open(self.engine, 'w') as f:
+            f.write(FAKE_ENGINE)
+        os.chmod(self.engine, os.stat(self.engine).st_mode | stat.S_IEXEC)
+        self.ligand = os.path.join(self.temp_dir.name, 'ligand.pdb')
+        with open(self.ligand, 'w') as f:
+            f.write('HETATM\n')
+        self.output = os.path.join(self.temp_dir.name, 'output.sdf')
+
+        self.loop = asyncio.get_event_loop()
+        scratch_space = ScratchSpace(os.path.join(self.temp_dir.name, 'scratch'))
+        self.worker = Worker({'smina': self.engine}, scratch_space=scratch_space, token='secret')
+        self.loop.run_until_complete(self.worker.start('127.0.0.1', 0))
+        self.pool = WorkerPool([f'127.0.0.1:{self.worker.port}'], token='secret')
+
+    def tearDown(self):
+        self.worker.close()
+        self.loop.run_until_complete(self.worker.server.wait_closed())
+        self.temp_dir.cleanup()
+
+    def run_on_pool(self, *extra_args, engine='smina', timeout=None, on_output=None):
+        args = ['-l', self.ligand, '--out', self.output, *extra_args]
+        return self.loop.run_until_complete(
+            self.pool.run(engine, args, [self.ligand], [self.output], timeout=timeout, on_output=on_output))
+
+    def test_run_on_worker(self):
+        output = []
+        exit_code = self.run_on_pool(on_output=output.append)
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(''.join(output).count('*'), 51)
+        with open(self.output) as f:
+            self.assertEqual(f.read(), 'HETATM\n')
+        self.assertEqual(self.pool.workers[0].in_use, 0)
+        # Run directories are removed on the worker once the run finished.
+        self.assertEqual(os.listdir(self.worker.scratch_space.root), [])
+
+    def send_request(self, request=None, data=None, **changes):
+        """Send a run request straight to the worker, and return its reply."""
+        async def send():
+            reader, writer = await asyncio.open_connection('127.0.0.1', self.worker.port)
+            try:
+                if data is not None:
+                    writer.write(data)
+                else:
+                    message = request or {
+                        'type': 'run',
+                        'token': 'secret',
+                        'engine': 'smina',
+                        'args': ['-l', '0/ligand.pdb', '--out', '1/output.sdf'],
+                        'inputs': {'0/ligand.pdb': encode_file(self.ligand)},
+                        'outputs': ['1/output.sdf'],
+                        'timeout': None,
+                    }
+                    await send_message(writer, {**message, **changes})
+                return await read_message(reader)
+            finally:
+                writer.close()
+        return self.loop.run_until_complete(send())
+
+    def assertRefused(self, reply, reason):
+        self.assertEqual(reply['type'], 'error')
+        self.assertIn(reason, reply['message'])
+
+    def test_accepts_shipped_files(self):
+        reply = self.send_request()
+        self.assertEqual(reply['type'], 'output')
+
+    def test_refuses_bad_token(self):
+        self.assertRefused(self.send_request(token='wrong'), 'Invalid token')
+        self.assertRefused(self.send_request(token=None), 'Invalid token')
+
+    def test_refuses_unknown_flags(self):
+        reply = self.send_request(args=['-l', '0/ligand.pdb', '--out', '1/output.sdf', '--cpu', '64'])
+        self.assertRefused(reply, 'Flag --cpu is not allowed')
+        reply = self.send_request(args=['-l', '0/ligand.pdb', '--out', '1/output.sdf', '--exhaustiveness', 'x'])
+        self.assertRefused(reply, 'Bad value x')
+
+    def test_refuses_files_not_shipped(self):
+        reply = self.send_request(args=['-r', '/etc/passwd', '-l', '0/ligand.pdb', '--out', '1/output.sdf'])
+        self.assertRefused(reply, 'not an input file')
+        # Outputs can't overwrite the files of the run either.
+        reply = self.send_request(args=['-l', '0/ligand.pdb', '--out', '0/ligand.pdb'])
+        self.assertRefused(reply, 'not an output file')
+
+    def test_refuses_paths_outside_run_directory(self):
+        content = encode_file(self.ligand)
+        for name in ['/tmp/ligand.pdb', '../ligand.pdb', '0/../../ligand.pdb']:
+            reply = self.send_request(inputs={name: content}, args=['-l', name, '--out', '1/output.sdf'])
+            self.assertRefused(reply, 'outside of the run directory')
+            reply = self.send_request(outputs=[name], args=['-l', '0/ligand.pdb', '--out', name])
+            self.assertRefused(reply, 'outside of the run directory')
+
+    def test_refuses_large_messages(self):
+        reply = self.send_request(data=b'\xff\xff\xff\xff')
+        self.assertRefused(reply, 'exceeds limit')
+
+    def test_requires_token(self):
+        worker = Worker({'smina': self.engine}, token='')
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(worker.start('127.0.0.1', 0))
+
+    def test_listens_on_localhost_by_default(self):
+        worker = Worker({'smina': self.engine}, token='secret')
+        self.loop.run_until_complete(worker.start(port=0))
+        self.assertEqual(worker.server.sockets[0].getsockname()[0], '127.0.0.1')
+        worker.close()
+        self.loop.run_until_complete(worker.server.wait_closed())
+
+    def test_engine_args(self):
+        args = ['-l', 'a.pdb', '--center_x', '1.5', '--num_modes', '9', '--atom_term_data', '--out', 'b.sdf']
+        self.assertEqual(engine_args('smina', args, {'a.pdb': ''}, ['b.sdf']), args)
+        with self.assertRaises(ValueError):
+            engine_args('smina', ['--num_modes'], {}, [])
+
+    def test_timeout(self):
+        with patch.dict(ENGINE_FLAGS['smina'], {'--sleep': float}):
+            exit_code = self.run_on_pool('--sleep', '10', timeout=0.5)
+        self.assertEqual(exit_code, TIMEOUT_CODE)
+
+    def test_falls_back_when_unavailable(self):
+        # Unknown engines are refused by the worker.
+        self.assertIsNone(self.run_on_pool(engine='vina'))
+        self.assertFalse(self.pool.workers[0].available)
+
+        unreachable = WorkerPool(['127.0.0.1:1'])
+        exit_code = self.loop.run_until_complete(unreachable.run('smina', [], [], []))
+        self.assertIsNone(exit_code)
+        self.assertFalse(unreachable.workers[0].available)
+
+        self.assertIsNone(self.loop.run_until_complete(WorkerPool().run('smina', [], [], [])))
+
+    @patch('plugin.workers.WORKER_RUN_GRACE', 0.2)
+    def test_falls_back_when_worker_stalls(self):
+        async def accept_and_stall(reader, writer):
+            await reader.read()
+        stalled = self.loop.run_until_complete(asyncio.start_server(accept_and_stall, '127.0.0.1', 0))
+        pool = WorkerPool([f"127.0.0.1:{stalled.sockets[0].getsockname()[1]}"], token='secret')
+        try:
+            exit_code = self.loop.run_until_complete(asyncio.wait_for(
+                pool.run('smina', ['-l', self.ligand, '--out', self.output], [self.ligand], [self.output], timeout=0.1),
+                5))
+        finally:
+            stalled.close()
+            self.loop.run_until_complete(stalled.wait_closed())
+        self.assertIsNone(exit_code)
+        self.assertFalse(pool.workers[0].available)
+
+    def test_least_busy_worker(self):
+        pool = WorkerPool(['first:9200', 'second:9200'], slots=2)
+        self.assertEqual(pool.capacity, 4)
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertNotEqual(first, second)
+        pool.acquire()
+        pool.acquire()
+        self.assertIsNone(pool.acquire())
+
+    def test_smina_batch_runs_on_worker(self):
+        plugin = MagicMock()
+        calculations = DockingCalculations(plugin)
+        receptor = os.path.join(self.temp_dir.name, 'receptor.pdb')
+        with open(receptor, 'w') as f:
+            f.write('ATOM\n')
+        log_file = os.path.join(self.temp_dir.name, 'smina.log')
+        site_box = SiteBox(Vector3(0, 0, 0), Vector3(1, 1, 1))
+        with patch('plugin.smina.calculations.worker_pool', return_value=self.pool):
+            exit_code = self.loop.run_until_complete(calculations.run_smina(
+                self.ligand, receptor, site_box, self.output, log_file, exhaustiveness=1, modes=1, autobox=4))
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(calculations.exit_codes, [0])
+        plugin.update_loading_bar.assert_called_with(51, 51)
+        with open(self.output) as f:
+            self.assertEqual(f.read(), 'HETATM\n')
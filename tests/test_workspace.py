@@ -0,0 +1,88 @@
+import os
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from plugin.workspace import SessionWorkspace
+
+
+def write_text(text):
+    def write(path):
+        with open(path, 'w') as f:
+            f.write(text)
+    return write
+
+
+class SessionWorkspaceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = SessionWorkspace()
+
+    def tearDown(self):
+        self.workspace.cleanup()
+
+    def test_intern_is_content_addressed(self):
+        path1 = self.workspace.intern('ligand', write_text('ATOM'), '.pdb')
+        path2 = self.workspace.intern('ligand', write_text('ATOM'), '.pdb')
+        path3 = self.workspace.intern('ligand', write_text('HETATM'), '.pdb')
+        self.assertEqual(path1, path2)
+        self.assertNotEqual(path1, path3)
+        self.assertTrue(path1.endswith('.pdb'))
+        partials = [f for f in os.listdir(self.workspace.path) if 'partial' in f]
+        self.assertEqual(partials, [])
+
+    def test_artifact_only_rebuilds_changed_stages(self):
+        builds = []
+
+        def build(path):
+            builds.append(path)
+            write_text('maps')(path)
+
+        path1 = self.workspace.artifact('grid', ['receptor', 1], build)
+        path2 = self.workspace.artifact('grid', ['receptor', 1], build)
+        self.workspace.artifact('grid', ['receptor', 2], build)
+        self.assertEqual(path1, path2)
+        self.assertEqual(len(builds), 2)
+        self.assertEqual((self.workspace.hits, self.workspace.misses), (1, 2))
+
+    def test_job_counts_own_hits(self):
+        first_job = self.workspace.job()
+        second_job = self.workspace.job()
+        first_job.artifact('grid', ['receptor'], write_text('maps'))
+        second_job.artifact('grid', ['receptor'], write_text('maps'))
+        self.assertEqual(second_job.lookup('vina_output', ['ligand']), None)
+        self.assertEqual((first_job.hits, first_job.misses), (0, 1))
+        self.assertEqual((second_job.hits, second_job.misses), (1, 0))
+        self.assertEqual((self.workspace.hits, self.workspace.misses), (1, 1))
+
+    def test_failed_build_is_not_reused(self):
+        def build(path):
+            write_text('partial')(path)
+            raise RuntimeError('failed')
+
+        with self.assertRaises(RuntimeError):
+            self.workspace.artifact('vina_output', ['ligand'], build, '.pdbqt')
+        self.assertEqual(os.listdir(self.workspace.path), [])
+
+    def test_artifact_dir(self):
+        path = self.workspace.artifact_dir('grid', ['receptor'], lambda d: write_text('map')(os.path.join(d, 'receptor.A.map')))
+        self.assertTrue(os.path.isfile(os.path.join(path, 'receptor.A.map')))
+
+    def test_evict_least_recently_used(self):
+        self.workspace.max_bytes = 10
+        old_path = self.workspace.artifact('stage', [1], write_text('x' * 8))
+        new_path = self.workspace.artifact('stage', [2], write_text('x' * 8))
+        self.workspace.evict()
+        self.assertFalse(os.path.exists(old_path))
+        self.assertTrue(os.path.exists(new_path))
+
+    def test_concurrent_builds_of_same_artifact(self):
+        builds = []
+
+        def build(path):
+            builds.append(path)
+            write_text('pdbqt')(path)
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            paths = list(pool.map(lambda _: self.workspace.artifact('ligand_pdbqt', ['ligand'], build), range(8)))
+        self.assertEqual(len(set(paths)), 1)
+        self.assertEqual(len(builds), 1)